@@ -0,0 +1,49 @@
+import os
+import json
+
+import constants as cns
+from redis_operations import redis_call, redis_mget
+
+# seconds the dashboard counts of a user, and the approval counts of a company are cached
+DASHBOARD_CACHE_TTL = int(os.environ.get('DASHBOARD_CACHE_TTL', '600'))
+APPROVAL_CACHE_TTL = int(os.environ.get('APPROVAL_CACHE_TTL', '600'))
+
+def dashboard_key(user_id):
+	return cns.REDIS_DASHBOARD + '/' + str(user_id)
+
+def load_counts(cached):
+	if cached is None:
+		return None
+	return json.loads(cached)
+
+# return the cached dashboard counts of the user, or None if they aren't cached or Redis is unavailable
+def get_dashboard_counts(user_id):
+	return load_counts(redis_call('get', dashboard_key(user_id)))
+
+def set_dashboard_counts(user_id, counts):
+	redis_call('set', dashboard_key(user_id), json.dumps(counts), ex=DASHBOARD_CACHE_TTL)
+
+# this should be called whenever expenses or reports of the user are changed
+def invalidate_dashboard(*user_ids):
+	keys = [dashboard_key(user_id) for user_id in user_ids if user_id is not None]
+	if keys:
+		redis_call('delete', *keys)
+
+def approval_key(company_id):
+	return cns.REDIS_APPROVAL + '/' + str(company_id)
+
+# return the cached counts of reports in each status of the approval queue of the company, or None
+def get_approval_counts(company_id):
+	return load_counts(redis_call('get', approval_key(company_id)))
+
+# return the cached dashboard counts of the user and approval counts of the company in one round trip, e.g. for the home page of an approver
+def get_dashboard_and_approval_counts(user_id, company_id):
+	dashboard, approval = redis_mget([dashboard_key(user_id), approval_key(company_id)])
+	return load_counts(dashboard), load_counts(approval)
+
+def set_approval_counts(company_id, counts):
+	redis_call('set', approval_key(company_id), json.dumps(counts), ex=APPROVAL_CACHE_TTL)
+
+# this should be called whenever reports of the company are submitted, approved, rejected or deleted
+def invalidate_approval_counts(company_id):
+	redis_call('delete', approval_key(company_id))
@@ -11,9 +11,15 @@ SESSION_COMPANY_PLAN = 'COMPANY_PLAN'
 # Redis keys
 REDIS_LANGUAGE = 'EMPLOYEE_LANGUAGE'
 REDIS_MESSAGES = "MESSAGES" # dict for messages
+REDIS_DASHBOARD = "DASHBOARD" # counts on the dashboard of each user
+REDIS_APPROVAL = "APPROVAL" # counts of the approval queue of each company
+REDIS_SESSION = "SESSION" # server-side sessions
+REDIS_EVENTS = "EVENTS" # pub/sub channels of events shown on open pages
 
 # supported languages
 SUPPORTED_LANGUAGES = ['ja-JP', 'ja', 'en-US', 'en']
+# languages of message files
+MESSAGE_LANGUAGES = ['ja-JP', 'en-US']
 
 # constant values to be used in app
 # employee roles
@@ -34,6 +40,7 @@ TITLE_INDEX = 'TITLE_INDEX'
 TITLE_EXPENSE_LIST = 'TITLE_EXPENSE_LIST'
 TITLE_EXPENSE_NEW = 'TITLE_EXPENSE_NEW'
 TITLE_EXPENSE_DETAIL = 'TITLE_EXPENSE_DETAIL'
+TITLE_EXPENSE_IMPORT = 'TITLE_EXPENSE_IMPORT'
 TITLE_REPORT_LIST = 'TITLE_REPORT_LIST'
 TITLE_REPORT_NEW = 'TITLE_REPORT_NEW'
 TITLE_REPORT_DETAIL = 'TITLE_REPORT_DETAIL'
@@ -41,6 +48,7 @@ TITLE_APPROVE_LIST = 'TITLE_APPROVE_LIST'
 TITLE_EMPLOYEE_LIST = 'TITLE_EMPLOYEE_LIST'
 TITLE_EMPLOYEE_NEW = 'TITLE_EMPLOYEE_NEW'
 TITLE_EMPLOYEE_DETAIL = 'TITLE_EMPLOYEE_DETAIL'
+TITLE_ANALYTICS = 'TITLE_ANALYTICS'
 # report status
 STATUS_OPEN = 'STATUS_OPEN'
 STATUS_SUBMITTED = 'STATUS_SUBMITTED'
@@ -51,3 +59,8 @@ MSG_EMAIL_MISMATCH = 'MSG_EMAIL_MISMATCH'
 MSG_NO_EMAIL_PASSWORD = 'MSG_NO_EMAIL_PASSWORD'
 MSG_NO_EXPENSE_ID_MATCH = 'MSG_NO_EXPENSE_ID_MATCH'
 MSG_NO_REPORT_ID_MATCH = 'MSG_NO_REPORT_ID_MATCH'
+MSG_INVALID_EXPORT_PERIOD = 'MSG_INVALID_EXPORT_PERIOD'
+# outcomes of reports approved or rejected
+MSG_REPORT_APPROVED = 'MSG_REPORT_APPROVED'
+MSG_REPORT_REJECTED = 'MSG_REPORT_REJECTED'
+MSG_REPORT_UNCHANGED = 'MSG_REPORT_UNCHANGED'
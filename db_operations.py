@@ -1,53 +1,499 @@
 import os
+import re
+import time
+import logging
+import threading
+import itertools
+from contextlib import contextmanager
 import psycopg2
-from psycopg2 import InterfaceError
+from psycopg2 import InterfaceError, errors
+from psycopg2.extensions import connection as _connection, TRANSACTION_STATUS_IDLE
 from psycopg2.extras import DictCursor
+from flask import g, has_app_context, has_request_context, request
+
+from metrics import Counter, Histogram, COUNT_BUCKETS
+from profiling import add_time, COMPONENT_DB
+from queries import Query, QUERIES, PAGE_FIRST, PAGE_AFTER, PAGE_BEFORE, page_sql
+
+logger = logging.getLogger(__name__)
 
 # retrieve parametes for database from enrironment value
 DATABASE_URL = os.environ.get('DATABASE_URL')
 DATABASE_SCHEMA = os.environ.get('DATABASE_SCHEMA')
-DATABASE_CONNECTION = None
+DATABASE_SSLMODE = os.environ.get('DATABASE_SSLMODE', 'require') # disable for a local database
+
+# connection pool settings
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', '5')) # max number of connections per worker
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', '10')) # seconds to wait for a free connection
+DATABASE_POOL_MAX_IDLE = float(os.environ.get('DATABASE_POOL_MAX_IDLE', '300')) # seconds an idle connection is kept
+DATABASE_POOL_MAX_LIFETIME = float(os.environ.get('DATABASE_POOL_MAX_LIFETIME', '3600')) # seconds a connection is reused
+DATABASE_POOL_PING_INTERVAL = float(os.environ.get('DATABASE_POOL_PING_INTERVAL', '30')) # idle seconds before a checkout is pinged
+DATABASE_POOL = None
+# prepare the statements of the query registry on each connection
+DATABASE_PREPARE_STATEMENTS = os.environ.get('DATABASE_PREPARE_STATEMENTS', '1') == '1'
+
+# page size of list pages
+PAGE_SIZE_DEFAULT = int(os.environ.get('PAGE_SIZE_DEFAULT', '50'))
+PAGE_SIZE_MAX = int(os.environ.get('PAGE_SIZE_MAX', '200'))
+# number of rows fetched in one round trip by a server-side cursor
+STREAM_ITERSIZE = int(os.environ.get('STREAM_ITERSIZE', '500'))
+STREAM_CURSOR_COUNTER = itertools.count()
+
+# instrumentation settings
+DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', '500')) # statements slower than this are logged with EXPLAIN
+DB_N_PLUS_ONE_THRESHOLD = int(os.environ.get('DB_N_PLUS_ONE_THRESHOLD', '5')) # identical statements in a request to be flagged
+
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'Latency of SQL statements', ['query'])
+QUERY_ROWS = Histogram('db_query_rows', 'Rows returned or affected by SQL statements', ['query'], buckets=COUNT_BUCKETS)
+QUERY_ERRORS = Counter('db_query_errors_total', 'SQL statements which raised an error', ['query'])
+REQUEST_QUERIES = Histogram('db_queries_per_request', 'SQL statements executed in a request', ['endpoint'], buckets=COUNT_BUCKETS)
+N_PLUS_ONE = Counter('db_n_plus_one_total', 'Requests repeating an identical statement', ['endpoint', 'query'])
+
+class PoolTimeout(Exception):
+    pass
+
+# psycopg2 connection remembering when it was created and last returned to the pool
+class PooledConnection(_connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.returned_at = self.created_at
+        # names of statements prepared on this connection, and of those which failed to be prepared
+        self.prepared = set()
+        self.unpreparable = set()
+
+# bounded pool of connections shared by the threads of a worker
+class ConnectionPool:
+    def __init__(self, dsn, schema, size, timeout, max_idle, max_lifetime, ping_interval):
+        self.dsn = dsn
+        self.schema = schema
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self._idle = []
+        self._condition = threading.Condition()
+        # statistics
+        self.in_use = 0
+        self.waiting = 0
+        self.created = 0
+        self.recycled = 0
+
+    def _connect(self):
+        # SSLモードを指定して新しい接続を確立
+        connection = psycopg2.connect(self.dsn, sslmode=DATABASE_SSLMODE, connection_factory=PooledConnection)
+        # search_path is set only once per physical connection, and committed so that a rollback keeps it
+        with connection.cursor() as cursor:
+            cursor.execute(f"SET search_path TO {self.schema};")
+        connection.commit()
+        if DATABASE_PREPARE_STATEMENTS:
+            prepare_statements(connection)
+        with self._condition:
+            self.created += 1
+        return connection
+
+    # health check on checkout; connections too old or idle too long are recycled
+    def _is_usable(self, connection):
+        if connection.closed != 0:
+            return False
+        now = time.monotonic()
+        if now - connection.created_at > self.max_lifetime or now - connection.returned_at > self.max_idle:
+            return False
+        if now - connection.returned_at > self.ping_interval:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self._condition:
+            self.recycled += 1
+            self.in_use -= 1
+            self._condition.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            connection = None
+            with self._condition:
+                while not self._idle and self.in_use >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"no database connection available in {self.timeout} seconds")
+                    self.waiting += 1
+                    self._condition.wait(remaining)
+                    self.waiting -= 1
+                if self._idle:
+                    connection = self._idle.pop()
+                self.in_use += 1
+            if connection is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._condition:
+                        self.in_use -= 1
+                        self._condition.notify()
+                    raise
+            if self._is_usable(connection):
+                return connection
+            self._discard(connection)
 
+    def putconn(self, connection, discard=False):
+        if not discard and connection.closed == 0:
+            try:
+                # never hand over an open transaction to the next request
+                if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or connection.closed != 0:
+            self._discard(connection)
+            return
+        connection.returned_at = time.monotonic()
+        with self._condition:
+            self._idle.append(connection)
+            self.in_use -= 1
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'created': self.created,
+                'recycled': self.recycled,
+            }
+
+def getDBPool():
+    global DATABASE_POOL
+    if DATABASE_POOL is None:
+        DATABASE_POOL = ConnectionPool(DATABASE_URL, DATABASE_SCHEMA, DATABASE_POOL_SIZE, DATABASE_POOL_TIMEOUT,
+                                       DATABASE_POOL_MAX_IDLE, DATABASE_POOL_MAX_LIFETIME, DATABASE_POOL_PING_INTERVAL)
+    return DATABASE_POOL
+
+# drop the pool inherited from the parent process; its connections aren't closed, as they're still used by the parent
+def reset_db_pool():
+    global DATABASE_POOL
+    DATABASE_POOL = None
+
+# the connection is checked out once per request and returned in release_db_connection
 def getDBConnection():
-    global DATABASE_CONNECTION 
-	# Check if the existing connection is alive
-    if DATABASE_CONNECTION is None or DATABASE_CONNECTION.closed != 0:
-        # SSLモード'require'を指定して新しい接続を確立
-        DATABASE_CONNECTION = psycopg2.connect(DATABASE_URL, sslmode='require')
-        with DATABASE_CONNECTION.cursor() as cursor:
-            cursor.execute(f"SET search_path TO {DATABASE_SCHEMA};")
-    return DATABASE_CONNECTION
+    if 'db_connection' not in g:
+        g.db_connection = getDBPool().getconn()
+    return g.db_connection
+
+# to be registered as a teardown of the app context
+def release_db_connection(exception=None):
+    connection = g.pop('db_connection', None)
+    if connection is not None:
+        getDBPool().putconn(connection)
+
+def get_pool_stats():
+    return getDBPool().stats()
+
+# Prepare statements of the registry on an idle connection, all in one round trip
+# if any of them fails, they are prepared one by one so that only the failed ones are executed as text
+def prepare_statements(connection, queries=None):
+    queries = [query for query in (queries or QUERIES.values()) if query.name not in connection.prepared]
+    if not queries:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(';'.join(query.prepare_sql for query in queries))
+        connection.commit()
+        connection.prepared.update(query.name for query in queries)
+    except psycopg2.Error:
+        connection.rollback()
+        for query in queries:
+            prepare_statement(connection, query)
+
+# an invalidated statement is deallocated and prepared again
+def prepare_statement(connection, query):
+    try:
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(query.prepare_sql)
+            except errors.DuplicatePreparedStatement:
+                connection.rollback()
+                cursor.execute(f"DEALLOCATE {query.name}")
+                cursor.execute(query.prepare_sql)
+        connection.commit()
+        connection.prepared.add(query.name)
+        connection.unpreparable.discard(query.name)
+    except psycopg2.Error as e:
+        connection.rollback()
+        connection.unpreparable.add(query.name)
+        logger.warning("query %s is executed without being prepared: %s", query.name, e)
+
+# Execute the statement of the registry by name
+# a prepared statement is invalidated when a table it reads is altered so that its result type changes,
+# or when the session is reset; it is then prepared again and retried once if no transaction was open,
+# otherwise the error is raised and the statement is prepared again when the connection is idle
+def execute_query(cursor, query, params):
+    connection = cursor.connection
+    if not isinstance(connection, PooledConnection) or not DATABASE_PREPARE_STATEMENTS:
+        cursor.execute(query.sql, params)
+        return
+    idle = connection.info.transaction_status == TRANSACTION_STATUS_IDLE
+    if query.name not in connection.prepared and query.name not in connection.unpreparable and idle:
+        prepare_statement(connection, query)
+    if query.name not in connection.prepared:
+        cursor.execute(query.sql, params)
+        return
+    try:
+        cursor.execute(query.execute_sql, params)
+    except (errors.InvalidSqlStatementName, errors.FeatureNotSupported) as e:
+        connection.prepared.discard(query.name)
+        if not idle:
+            raise
+        logger.warning("prepared statement %s is invalidated: %s", query.name, e)
+        connection.rollback()
+        prepare_statement(connection, query)
+        cursor.execute(query.execute_sql if query.name in connection.prepared else query.sql, params)
+
+# statements of the registry are keyed by their names, and others by their text with whitespace collapsed
+# parameters are always given separately
+def normalize_sql(sql_string):
+    if isinstance(sql_string, Query):
+        return sql_string.name
+    return ' '.join(sql_string.split())
+
+# parameters are described by their types only, as they may hold emails, passwords or other personal data
+# for the same reason, string literals in plans, where parameters appear as constants, are masked
+QUOTED_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+def describe_params(params):
+    if params is None:
+        return 'no params'
+    return f"{len(params)} params ({', '.join(type(param).__name__ for param in params)})"
+
+# return the plan of the statement without running it
+# it runs in a savepoint of the caller's transaction, so that a failure, e.g. on a statement timeout,
+# is rolled back to the savepoint and doesn't abort the transaction which is committed afterwards
+def explain(connection, sql_string, params):
+    with connection.cursor() as cursor:
+        cursor.execute("savepoint explain_slow_query")
+        try:
+            cursor.execute("EXPLAIN " + str(sql_string), params)
+            plan = QUOTED_LITERAL.sub("'?'", '\n'.join(row[0] for row in cursor.fetchall()))
+        except psycopg2.Error as e:
+            cursor.execute("rollback to savepoint explain_slow_query")
+            # the message of the error may quote the statement with its parameters
+            plan = f"EXPLAIN failed: {type(e).__name__}"
+        cursor.execute("release savepoint explain_slow_query")
+        return plan
+
+def record_query(connection, sql_string, params, duration, rows):
+    query = normalize_sql(sql_string)
+    QUERY_DURATION.observe(duration, (query,))
+    add_time(COMPONENT_DB, duration)
+    if rows >= 0:
+        QUERY_ROWS.observe(rows, (query,))
+    if has_app_context():
+        # count statements in the request to detect N+1 queries
+        counts = g.setdefault('db_query_counts', {})
+        counts[query] = counts.get(query, 0) + 1
+        if counts[query] == DB_N_PLUS_ONE_THRESHOLD:
+            endpoint = request.endpoint if has_request_context() else None
+            N_PLUS_ONE.inc((endpoint, query))
+            logger.warning("possible N+1 query in %s: executed %d times: %s", endpoint, counts[query], query)
+    if duration * 1000 >= DB_SLOW_QUERY_MS:
+        logger.warning("slow query (%.1f ms): %s\n%s\n%s", duration * 1000, query, describe_params(params), explain(connection, sql_string, params))
+
+# execute the statement with the cursor and record its latency
+def execute_instrumented(cursor, sql_string, params):
+    logger.debug("Preparing to execute SQL: %s with %s", normalize_sql(sql_string), describe_params(params))
+    started = time.perf_counter()
+    try:
+        if isinstance(sql_string, Query):
+            execute_query(cursor, sql_string, params)
+        else:
+            cursor.execute(sql_string, params)
+    except Exception:
+        QUERY_ERRORS.inc((normalize_sql(sql_string),))
+        raise
+    record_query(cursor.connection, sql_string, params, time.perf_counter() - started, cursor.rowcount)
+
+# to be registered as a teardown of the request
+# requests without SQL statements are skipped, so that a streamed response is counted once when its rows are consumed
+def record_request_queries(exception=None):
+    counts = g.pop('db_query_counts', None)
+    if counts and has_request_context():
+        REQUEST_QUERIES.observe(sum(counts.values()), (request.endpoint,))
 
 def sql_select(sql_string, params):
-    print("Preparing to execute SQL:", sql_string, "with params:", params)
     cursor = None
     try:
         cursor = getDBConnection().cursor(cursor_factory=DictCursor)
-        cursor.execute(sql_string, params) 
+        execute_instrumented(cursor, sql_string, params)
         results = cursor.fetchall()
         return results
-    except Exception as e:
-        print("Error during SQL execution:", e)
+    except Exception:
+        logger.exception("Error during SQL execution: %s", normalize_sql(sql_string))
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+# Select a page of rows with keyset pagination
+# key_column must be unique and the query must have a where clause; the next page starts after the last key of this page
+# return (rows, pager) where pager has tokens of the next and previous pages
+# a statement of the registry should be registered with paged(key_column) so that each mode is prepared
+def sql_select_page(sql_string, params, key_column, after=None, before=None, page_size=PAGE_SIZE_DEFAULT):
+    key_name = key_column.split('.')[-1]
+    params = tuple(params)
+    if before is not None:
+        mode = PAGE_BEFORE
+        params += (before, page_size + 1)
+    elif after is not None:
+        mode = PAGE_AFTER
+        params += (after, page_size + 1)
+    else:
+        mode = PAGE_FIRST
+        params += (page_size + 1,)
+    if isinstance(sql_string, Query) and sql_string.pages:
+        sql_string = sql_string.pages[mode]
+    else:
+        sql_string = page_sql(str(sql_string), key_column, mode)
+    results = sql_select(sql_string, params)
+    pager = {'next': None, 'prev': None, 'size': page_size}
+    if results is None:
+        return results, pager
+    has_more = len(results) > page_size
+    results = results[:page_size]
+    if before is not None:
+        results.reverse()
+        if results:
+            pager['next'] = results[-1][key_name]
+            if has_more:
+                pager['prev'] = results[0][key_name]
+    elif results:
+        if has_more:
+            pager['next'] = results[-1][key_name]
+        if after is not None:
+            pager['prev'] = results[0][key_name]
+    return results, pager
+
+# Iterate over all rows with a named server-side cursor, which fetches itersize rows per round trip
+# this is for consumers which need every row without keeping them in memory
+# the latency is the sum of the time to execute and fetch, excluding the time the consumer spends on rows
+# errors are raised after they're logged, as the consumer can't tell rows cut short by an error from the end of rows
+def sql_select_stream(sql_string, params, itersize=STREAM_ITERSIZE):
+    logger.debug("Preparing to execute SQL: %s with %s", normalize_sql(sql_string), describe_params(params))
+    cursor = None
+    rows = 0
+    started = time.perf_counter()
+    try:
+        cursor = getDBConnection().cursor(name=f"stream_{next(STREAM_CURSOR_COUNTER)}", cursor_factory=DictCursor)
+        cursor.itersize = itersize
+        # a cursor can't be declared for EXECUTE, so statements of the registry are streamed as text
+        cursor.execute(str(sql_string), params)
+        duration = time.perf_counter() - started
+        fetched = iter(cursor)
+        while True:
+            started = time.perf_counter()
+            row = next(fetched, None)
+            duration += time.perf_counter() - started
+            if row is None:
+                break
+            rows += 1
+            yield row
+        record_query(cursor.connection, sql_string, params, duration, rows)
+    except Exception:
+        QUERY_ERRORS.inc((normalize_sql(sql_string),))
+        logger.exception("Error during SQL execution: %s", normalize_sql(sql_string))
+        raise
     finally:
         if cursor is not None:
             cursor.close()
 
+# Rows of sql_select_stream which can be tested for emptiness in templates
+# the first row is fetched only when it's tested or iterated, so the page can be sent before the query runs
+class RowStream:
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._head = None
+
+    def _peek(self):
+        if self._head is None:
+            self._head = list(itertools.islice(self._rows, 1))
+        return self._head
+
+    def __bool__(self):
+        return bool(self._peek())
 
+    def __iter__(self):
+        return itertools.chain(self._peek(), self._rows)
+
+# return rows of the RETURNING clause if the statement has one
 def sql_execute(sql_string, params):
-    print("Preparing to execute SQL:", sql_string, "with params:", params)
     connection = None
     cursor = None
     try:
         connection = getDBConnection()
-        cursor = connection.cursor()
-        cursor.execute(sql_string, params) 
+        cursor = connection.cursor(cursor_factory=DictCursor)
+        execute_instrumented(cursor, sql_string, params)
+        results = cursor.fetchall() if cursor.description is not None else None
         connection.commit()
-    except Exception as e:
-        print("Error during SQL execution:", e)
+        return results
+    except Exception:
+        logger.exception("Error during SQL execution: %s", normalize_sql(sql_string))
         if connection is not None:
             connection.rollback()
     finally:
         if cursor is not None:
             cursor.close()
-        if connection is not None:
-            connection.close()
\ No newline at end of file
+
+# Run statements with the cursor in one transaction, which is rolled back if an exception is raised
+@contextmanager
+def sql_transaction():
+    connection = getDBConnection()
+    cursor = connection.cursor(cursor_factory=DictCursor)
+    try:
+        yield cursor
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# Compare a statement of the registry executed as text and as a prepared statement on a pooled connection
+# return mean seconds per call, and mean planning milliseconds reported by EXPLAIN ANALYZE
+def benchmark_query(query, params, iterations=100):
+    pool = getDBPool()
+    connection = pool.getconn()
+    try:
+        prepare_statement(connection, query)
+        result = {}
+        with connection.cursor() as cursor:
+            for mode, sql_string in (('text', query.sql), ('prepared', query.execute_sql)):
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    cursor.execute(sql_string, params)
+                    cursor.fetchall()
+                result[mode] = (time.perf_counter() - started) / iterations
+                planning = 0.0
+                for _ in range(iterations):
+                    cursor.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + sql_string, params)
+                    planning += cursor.fetchone()[0][0]['Planning Time']
+                result[mode + '_planning_ms'] = planning / iterations
+        connection.rollback()
+        return result
+    finally:
+        pool.putconn(connection)
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+import redis
+
+import constants as cns
+from metrics import Gauge
+from redis_operations import getRedisClient, redis_pipeline
+
+try:
+	from gevent.monkey import is_module_patched
+except ImportError:
+	is_module_patched = None
+
+logger = logging.getLogger(__name__)
+
+# event stream settings
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', '15')) # seconds between comments keeping idle streams open through proxies
+EVENTS_MAX_AGE = float(os.environ.get('EVENTS_MAX_AGE', '300')) # seconds a stream is kept before the browser is told to reconnect
+EVENTS_RETRY_MS = int(os.environ.get('EVENTS_RETRY_MS', '3000')) # milliseconds the browser waits before reconnecting
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', '100')) # events waiting to be sent on each stream
+
+# events
+EVENT_REPORT_SUBMITTED = 'report_submitted'
+EVENT_REPORT_APPROVED = 'report_approved'
+EVENT_REPORT_REJECTED = 'report_rejected'
+
+EVENT_STREAMS = Gauge('events_streams', 'Event streams open in this worker')
+
+# streams are served only where waiting for events doesn't hold a process or thread, i.e. gevent has patched socket;
+# with sync or gthread workers each open page would hold a worker or a thread of its pool for EVENTS_MAX_AGE
+def events_supported():
+	return is_module_patched is not None and is_module_patched('socket')
+
+# approvers of the company, and the employee who owns reports, listen to their own channel
+def company_channel(company_id):
+	return cns.REDIS_EVENTS + '/company/' + str(company_id)
+
+def employee_channel(employee_id):
+	return cns.REDIS_EVENTS + '/employee/' + str(employee_id)
+
+# publish the event to the channels; it's dropped if Redis is unavailable, and pages show it on the next load
+def publish_event(event, data, *channels):
+	publish_events([(event, data, channels)])
+
+# publish events given as (event, data, channels) in one round trip
+def publish_events(events):
+	messages = [(channel, json.dumps({'event': event, 'data': data})) for event, data, channels in events for channel in channels]
+	if messages:
+		redis_pipeline(lambda pipeline: [pipeline.publish(channel, message) for channel, message in messages])
+
+# Fan out events of Redis pub/sub to the streams of this worker
+# A single subscription per worker receives every channel with a pattern, so that streams don't hold Redis connections;
+# each stream has a bounded queue, and events are dropped for a stream which doesn't keep up.
+class EventBroker:
+	def __init__(self, pattern=cns.REDIS_EVENTS + '/*'):
+		self.pattern = pattern
+		self.listeners = {}
+		self.streams = 0
+		self.lock = threading.Lock()
+		self.thread = None
+
+	# the thread is started by the first stream so that it's created in the worker process
+	def start(self):
+		with self.lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+				self.thread.start()
+
+	def subscribe(self, channels):
+		self.start()
+		listener = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+		with self.lock:
+			for channel in channels:
+				self.listeners.setdefault(channel, set()).add(listener)
+			self.streams += 1
+			EVENT_STREAMS.set(self.streams)
+		return listener
+
+	def unsubscribe(self, listener, channels):
+		with self.lock:
+			for channel in channels:
+				listeners = self.listeners.get(channel)
+				if listeners is not None:
+					listeners.discard(listener)
+					if not listeners:
+						del self.listeners[channel]
+			self.streams -= 1
+			EVENT_STREAMS.set(self.streams)
+
+	def _dispatch(self, channel, message):
+		with self.lock:
+			listeners = list(self.listeners.get(channel, ()))
+		for listener in listeners:
+			try:
+				listener.put_nowait(message)
+			except queue.Full:
+				logger.warning("event dropped for a slow stream on %s", channel)
+
+	# subscribe again with backoff when the connection to Redis is lost
+	def _run(self):
+		backoff = 1
+		while True:
+			pubsub = None
+			try:
+				pubsub = getRedisClient().pubsub(ignore_subscribe_messages=True)
+				pubsub.psubscribe(self.pattern)
+				backoff = 1
+				while True:
+					message = pubsub.get_message(timeout=1.0)
+					if message is not None:
+						self._dispatch(message['channel'].decode('utf8'), message['data'].decode('utf8'))
+			except redis.RedisError as exception:
+				logger.warning("event subscription failed: %s", exception)
+				if pubsub is not None:
+					pubsub.close()
+				time.sleep(backoff)
+				backoff = min(backoff * 2, 30)
+
+EVENT_BROKER = None
+
+def getEventBroker():
+	global EVENT_BROKER
+	if EVENT_BROKER is None:
+		EVENT_BROKER = EventBroker()
+	return EVENT_BROKER
+
+# drop the broker inherited from the parent process; its thread doesn't run in this process
+def reset_event_broker():
+	global EVENT_BROKER
+	EVENT_BROKER = None
+
+# Generate the Server-Sent Events stream of the channels
+# the stream ends after EVENTS_MAX_AGE, and the browser reconnects by itself after EVENTS_RETRY_MS
+def stream_events(channels):
+	broker = getEventBroker()
+	listener = broker.subscribe(channels)
+	try:
+		yield f"retry: {EVENTS_RETRY_MS}\n\n"
+		deadline = time.monotonic() + EVENTS_MAX_AGE
+		while time.monotonic() < deadline:
+			try:
+				message = json.loads(listener.get(timeout=EVENTS_HEARTBEAT))
+			except queue.Empty:
+				yield ": heartbeat\n\n"
+				continue
+			yield f"event: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+	finally:
+		broker.unsubscribe(listener, channels)
@@ -0,0 +1,89 @@
+import io
+import csv
+import zlib
+import tempfile
+from decimal import Decimal
+
+import constants as cns
+import queries as qry
+from db_operations import sql_select_stream
+
+# supported formats of files to export, and their MIME types
+FORMAT_CSV = 'csv'
+FORMAT_XLSX = 'xlsx'
+EXPORT_MIMETYPES = {
+	FORMAT_CSV: 'text/csv',
+	FORMAT_XLSX: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+# bytes buffered before a chunk is sent
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_COLUMNS = ['report_id', 'report_name', 'submit_date', 'approve_date', 'employee_id', 'first_name', 'last_name', 'email',
+	'expense_id', 'expense_name', 'date', 'amount', 'currency', 'description']
+AMOUNT_COLUMN = EXPORT_COLUMNS.index('amount')
+CURRENCY_COLUMN = EXPORT_COLUMNS.index('currency')
+
+# Yield expenses of reports approved in the company between the dates as lists of cells, then a row of the total of each currency
+# rows are fetched with a server-side cursor, so that only a batch of rows is kept in memory
+def export_rows(company_id, date_from, date_to):
+	totals = {currency: Decimal(0) for currency in cns.CURRENCIES}
+	params = (company_id, cns.STATUS_APRROVED, date_from, date_to)
+	for row in sql_select_stream(qry.EXPORT_APPROVED_EXPENSES, params):
+		cells = [row[column] for column in EXPORT_COLUMNS]
+		if row['currency'] in totals and row['amount'] is not None:
+			totals[row['currency']] += row['amount']
+		yield cells
+	for currency, total in totals.items():
+		cells = [None] * len(EXPORT_COLUMNS)
+		cells[0] = 'total'
+		cells[AMOUNT_COLUMN] = total
+		cells[CURRENCY_COLUMN] = currency
+		yield cells
+
+# Encode rows as CSV in chunks; a BOM is added so that spreadsheets read it as UTF-8
+def write_csv(rows):
+	buffer = io.StringIO()
+	buffer.write('﻿')
+	writer = csv.writer(buffer, lineterminator='\n')
+	writer.writerow(EXPORT_COLUMNS)
+	for row in rows:
+		writer.writerow(row)
+		if buffer.tell() >= EXPORT_CHUNK_SIZE:
+			yield buffer.getvalue().encode('utf8')
+			buffer.seek(0)
+			buffer.truncate()
+	yield buffer.getvalue().encode('utf8')
+
+# Write rows to a workbook in write-only mode, which keeps rows in a temporary file instead of memory, and send the file in chunks
+# the file can be sent only after the last row is written, as XLSX is a ZIP archive
+def write_xlsx(rows):
+	# openpyxl is required only when XLSX is exported
+	from openpyxl import Workbook
+	workbook = Workbook(write_only=True)
+	worksheet = workbook.create_sheet('approved')
+	worksheet.append(EXPORT_COLUMNS)
+	for row in rows:
+		worksheet.append(row)
+	with tempfile.TemporaryFile() as xlsx_file:
+		workbook.save(xlsx_file)
+		xlsx_file.seek(0)
+		while True:
+			chunk = xlsx_file.read(EXPORT_CHUNK_SIZE)
+			if not chunk:
+				break
+			yield chunk
+
+# compress chunks as a gzip stream on the fly
+def gzip_chunks(chunks):
+	compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+	for chunk in chunks:
+		compressed = compressor.compress(chunk)
+		if compressed:
+			yield compressed
+	yield compressor.flush()
+
+# Export approved reports of the company with their expenses as chunks of bytes of the format, compressed with gzip if compress is set
+def export_approved_reports(company_id, date_from, date_to, export_format=FORMAT_CSV, compress=False):
+	rows = export_rows(company_id, date_from, date_to)
+	chunks = write_xlsx(rows) if export_format == FORMAT_XLSX else write_csv(rows)
+	return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,158 @@
+import io
+import csv
+import json
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import constants as cns
+from db_operations import sql_transaction
+
+# supported formats of files to import
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+# max number of errors kept in the result
+IMPORT_MAX_ERRORS = 1000
+# number of rows inserted by each statement
+IMPORT_BATCH_SIZE = 1000
+IMPORT_SQL = 'insert into expense(name, date, amount, currency, description, user_id) values %s'
+# max length of name and description, which is the limit of a CSV field so that both formats accept the same rows
+IMPORT_TEXT_MAX_LENGTH = csv.field_size_limit()
+# limits of digits before and after the decimal point of the numeric column of amounts
+NUMERIC_MAX_INTEGER_DIGITS = 131072
+NUMERIC_MAX_SCALE = 16383
+
+# return the format from the extension of the file name
+def get_import_format(file_name):
+	if file_name and file_name.lower().endswith(('.jsonl', '.json', '.ndjson')):
+		return FORMAT_JSONL
+	return FORMAT_CSV
+
+# Parse the binary stream line by line and yield (line number, row as dict or an error message)
+# bytes which aren't UTF-8 are decoded as surrogates, so that a line with them is reported by validate_row instead of ending the file
+def read_rows(stream, file_format):
+	text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='surrogateescape', newline='')
+	if file_format == FORMAT_JSONL:
+		for line_number, line in enumerate(text, start=1):
+			if not line.strip():
+				continue
+			try:
+				row = json.loads(line)
+			except ValueError as exception:
+				yield line_number, 'invalid JSON: ' + str(exception)
+				continue
+			if isinstance(row, dict):
+				yield line_number, row
+			else:
+				yield line_number, 'a line should be a JSON object'
+	else:
+		reader = csv.DictReader(text)
+		while True:
+			try:
+				row = next(reader)
+			except StopIteration:
+				break
+			except csv.Error as exception:
+				# the reader goes on from the next line
+				yield reader.line_num, 'invalid CSV: ' + str(exception)
+				continue
+			yield reader.line_num, row
+
+# Return the value as text which can be stored; raise ValueError if it can't
+def validate_text(value, column):
+	text = str(value or '')
+	if len(text) > IMPORT_TEXT_MAX_LENGTH:
+		raise ValueError(f"{column} is longer than {IMPORT_TEXT_MAX_LENGTH} characters")
+	if '\x00' in text:
+		raise ValueError(column + ' contains a NUL character')
+	try:
+		text.encode('utf8')
+	except UnicodeEncodeError:
+		raise ValueError(column + ' is not valid UTF-8')
+	return text
+
+# Validate the row and return values to insert; raise ValueError if the row is invalid
+def validate_row(row):
+	name = validate_text(row.get('name'), 'name').strip()
+	if not name:
+		raise ValueError('name is empty')
+	try:
+		expense_date = date.fromisoformat(str(row.get('date') or '').strip())
+	except ValueError:
+		raise ValueError('date should be YYYY-MM-DD')
+	try:
+		amount = Decimal(str(row.get('amount') or '').strip())
+	except InvalidOperation:
+		raise ValueError('amount is not a number')
+	if not amount.is_finite():
+		raise ValueError('amount is not a number')
+	digits, exponent = amount.as_tuple()[1:]
+	if len(digits) + exponent > NUMERIC_MAX_INTEGER_DIGITS or -exponent > NUMERIC_MAX_SCALE:
+		raise ValueError('amount is out of range')
+	currency = str(row.get('currency') or '').strip()
+	if currency not in cns.CURRENCIES:
+		raise ValueError('currency should be one of ' + ', '.join(cns.CURRENCIES))
+	description = validate_text(row.get('description'), 'description')
+	return name, expense_date.isoformat(), str(amount), currency, description
+
+def add_error(result, line_number, error):
+	result['error_count'] += 1
+	if len(result['errors']) < IMPORT_MAX_ERRORS:
+		result['errors'].append({'line': line_number, 'error': error})
+
+# Yield lists of at most IMPORT_BATCH_SIZE (line number, validated values) to insert, and count invalid rows in the result
+def validated_batches(rows, user_id, result):
+	batch = []
+	for line_number, row in rows:
+		try:
+			if isinstance(row, str):
+				raise ValueError(row)
+			values = validate_row(row)
+		except ValueError as exception:
+			add_error(result, line_number, str(exception))
+			continue
+		batch.append((line_number, values + (user_id,)))
+		if len(batch) >= IMPORT_BATCH_SIZE:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+# Insert the batch in a multi-row insert within a savepoint
+# if the database rejects a value, rows are inserted one by one, so that only the rows it rejects are reported with their line numbers
+def insert_batch(cursor, batch, result):
+	cursor.execute('savepoint import_batch')
+	try:
+		execute_values(cursor, IMPORT_SQL, [values for _, values in batch], page_size=IMPORT_BATCH_SIZE)
+	except (psycopg2.DataError, psycopg2.IntegrityError):
+		cursor.execute('rollback to savepoint import_batch')
+		for line_number, values in batch:
+			insert_row(cursor, line_number, values, result)
+	else:
+		result['imported'] += len(batch)
+	cursor.execute('release savepoint import_batch')
+
+def insert_row(cursor, line_number, values, result):
+	cursor.execute('savepoint import_row')
+	try:
+		execute_values(cursor, IMPORT_SQL, [values])
+	except (psycopg2.DataError, psycopg2.IntegrityError) as exception:
+		cursor.execute('rollback to savepoint import_row')
+		add_error(result, line_number, str(exception).splitlines()[0])
+	else:
+		result['imported'] += 1
+	cursor.execute('release savepoint import_row')
+
+# Import expenses of the user from CSV or JSON Lines with columns; name, date, amount, currency, description
+# valid rows are inserted in batches of multi-row inserts in a single transaction and invalid rows are reported with their line numbers
+# COPY isn't used, as psycopg2 can't run it once psycogreen has made it wait in the event loop of a gevent worker
+def import_expenses(stream, file_format, user_id):
+	result = {'imported': 0, 'error_count': 0, 'errors': []}
+	with sql_transaction() as cursor:
+		for batch in validated_batches(read_rows(stream, file_format), user_id, result):
+			insert_batch(cursor, batch, result)
+	# rows rejected by the database are reported after the invalid rows of their batch
+	result['errors'].sort(key=lambda error: error['line'])
+	return result
@@ -1,44 +1,106 @@
+import io
 import os
+import hmac
+import sys
+import csv
+import json
+import time
+import click
+import contextvars
+import statistics
+import subprocess
+import psycopg2
 from datetime import date, timedelta
-from flask import Flask, redirect, request, url_for, session
+from flask import Flask, Blueprint, Response, abort, g, redirect, request, url_for, session, jsonify, flash, stream_with_context, current_app, before_render_template, template_rendered
+from flask.helpers import get_debug_flag
 
 import constants as cns
-from file_operations import save_file, delete_file
-from db_operations import sql_execute, sql_select
-from utilities import getPendoParams, get_default_currency, generate_fullname, display_page, getRedisClient, generate_currency_expression
-
-# a random secret used by Flask to encrypt session data cookies
-app = Flask(__name__)
-app.debug = True
-app.secret_key = os.environ.get('FLASK_SECRET_KEY')
+import queries as qry
+from file_operations import receipt_transaction, delete_file, get_receipt_url
+from expense_import import FORMAT_CSV as IMPORT_FORMAT_CSV, get_import_format, import_expenses
+from expense_export import FORMAT_CSV, FORMAT_XLSX, EXPORT_MIMETYPES, export_approved_reports
+from rollup_operations import ROLLUP_STATUSES, rebuild_rollups, first_month, pivot_rollups
+from schema_operations import migrate, explain_queries
+from seed_operations import seed_database
+from session_operations import init_sessions, regenerate_session
+from events_operations import EVENT_REPORT_SUBMITTED, EVENT_REPORT_APPROVED, EVENT_REPORT_REJECTED, company_channel, employee_channel, events_supported, publish_event, publish_events, stream_events
+from cache_operations import get_dashboard_counts, set_dashboard_counts, invalidate_dashboard, get_approval_counts, get_dashboard_and_approval_counts, set_approval_counts, invalidate_approval_counts
+from db_operations import PAGE_SIZE_DEFAULT, sql_execute, sql_select, sql_select_page, sql_select_stream, RowStream, execute_instrumented, release_db_connection, record_request_queries, get_pool_stats, benchmark_query
+from metrics import Gauge, render_metrics
+from redis_operations import getRedisClient
+from profiling import ProfilingMiddleware, init_profiling
+from utilities import getPendoParams, get_default_currency, generate_fullname, display_page, get_locale, get_page_args, get_page_url, display_page_stream, preload_messages, apply_language
 
 # Pendo API Key of this app
 PENDO_API_KEY = os.environ.get('PENDO_API_KEY')
 PENDO_API_KEY_2 = os.environ.get('PENDO_API_KEY_2')
+# token which clients give as "Authorization: Bearer <token>" to read internals of the worker; they're not served without it
+MONITORING_TOKEN = os.environ.get('MONITORING_TOKEN')
+
+# routes and CLI commands of the app, registered on it by create_app; commands are run in the app context and added to the flask command itself
+bp = Blueprint('main', __name__, cli_group=None)
 
 def main():
     return None
 
-@app.context_processor
+# number of months shown in the analytics page by default, and at most
+ANALYTICS_MONTHS = int(os.environ.get('ANALYTICS_MONTHS', '12'))
+ANALYTICS_MONTHS_MAX = 120
+
+# category of flashed outcomes of reports approved or rejected
+FLASH_REPORT_OUTCOME = 'report_outcome'
+# prefix of the page args of approved reports in the approve list
+APPROVED_PAGE_PREFIX = 'approved_'
+
+DB_POOL_CONNECTIONS = Gauge('db_pool_connections', 'Connections of the DB pool in this worker', ['state'])
+
 def function_processor():
-	def get_fullname(first_name, last_name):
-		return generate_fullname(first_name, last_name)
+	# messages and formats are resolved once per render, and each text is a dict lookup
+	locale = get_locale()
+	messages = locale.messages
 	def get_text(msg_key):
-		if getRedisClient().hexists(cns.REDIS_MESSAGES + '/' + session[cns.REDIS_LANGUAGE], msg_key):
-			return getRedisClient().hget(cns.REDIS_MESSAGES + '/' + session[cns.REDIS_LANGUAGE], msg_key).decode('utf8')
-		else:
-			return 'MSG_MISMATCH'
-	def get_currency_expression(amount, currency):
-		return generate_currency_expression(amount, currency)
+		return messages.get(msg_key, 'MSG_MISMATCH')
 	return dict(pendo_api_key=PENDO_API_KEY,
 							pendo_api_key_2=PENDO_API_KEY_2,
-							get_fullname=get_fullname,
+							get_fullname=locale.fullname,
 							role_list=cns.ROLES,
 							currency_list=cns.CURRENCIES,
 							get_text=get_text,
-							get_currency_expression=get_currency_expression)
-
-@app.route('/')
+							get_currency_expression=locale.format_amount,
+							get_receipt_url=get_receipt_url,
+							get_page_url=get_page_url,
+							get_approval_counts=load_approval_counts,
+							live_updates=live_updates)
+
+# the DB pool, SQL and timings of routes are shown only to clients giving MONITORING_TOKEN
+def monitoring_authorized():
+	if not MONITORING_TOKEN:
+		return False
+	authorization = request.headers.get('Authorization', '')
+	return hmac.compare_digest(authorization.encode('utf8'), ('Bearer ' + MONITORING_TOKEN).encode('utf8'))
+
+# pages receive events from /events only with gevent workers, or in debug mode, where the development server starts a thread per request
+def live_updates():
+	return events_supported() or current_app.debug
+
+# counts of reports in each status of the approval queue of the company of the session; e.g. for the badge of the navigator
+# the counts may have been read from the cache with others of the page, e.g. by user_home
+def load_approval_counts():
+	company_id = session[cns.SESSION_COMPANY_ID]
+	if 'approval_counts' in g:
+		counts = g.pop('approval_counts')
+	else:
+		counts = get_approval_counts(company_id)
+	if counts is None:
+		results = sql_select(qry.APPROVAL_COUNTS, (company_id,))
+		counts = {cns.STATUS_SUBMITTED: 0, cns.STATUS_APRROVED: 0}
+		if results is not None:
+			for status, count in results:
+				counts[status] = count
+			set_approval_counts(company_id, counts)
+	return counts
+
+@bp.route('/')
 def index():
 	if cns.SESSION_EMAIL in session:
 		email = session[cns.SESSION_EMAIL]
@@ -51,17 +113,32 @@ def index():
 		elif role == cns.ROLE_APPROVER:
 			return redirect('approve_list_html')
 	
-	return redirect(url_for('login'))
+	return redirect(url_for('.login'))
 
-@app.route('/error/<message_key>')
+@bp.route('/error/<message_key>')
 def error(message_key):
 	return display_page('error.html', message_key=message_key)
 
-@app.route('/login')
+@bp.route('/db_pool_stats')
+def db_pool_stats():
+	if not monitoring_authorized():
+		abort(403)
+	# connections in use, waiting, created and recycled in this worker
+	return jsonify(get_pool_stats())
+
+@bp.route('/metrics')
+def metrics():
+	if not monitoring_authorized():
+		abort(403)
+	for state, value in get_pool_stats().items():
+		DB_POOL_CONNECTIONS.set(value, (state,))
+	return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/login')
 def login():
 	return display_page('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
 	# flush Pendo parameters, and keep messages and language
 	session.pop(cns.SESSION_EMPLOYEE_ID, None)
@@ -73,7 +150,7 @@ def logout():
 	session.pop(cns.SESSION_COMPANY_PLAN, None)
 	return display_page('logout.html')
 
-@app.route('/authenticate', methods=['POST'])
+@bp.route('/authenticate', methods=['POST'])
 def authenticate():
 
 	email = request.form['email']
@@ -81,16 +158,13 @@ def authenticate():
 	
 	if email and password:
 		# login succeeds
-		sql_string = "select employee.id, email, role, first_name, last_name, company.id as company_id,"\
-					" company.name as company_name, company.plan as company_plan"\
-					" from employee join company"\
-					" on employee.company_id = company.id"\
-					" where email=%s and password=%s"
+		sql_string = qry.AUTHENTICATE
 		params = (email, password)
 		results = sql_select(sql_string, params)
 		if results is not None and len(results) == 1:
 			employee_id, email, role, first_name, last_name, company_id, company_name, company_plan = results[0]
 			print('login as email:', email, ', company: ', company_name)
+			regenerate_session(session)
 			# set Pendo parameters
 			session[cns.SESSION_EMPLOYEE_ID] = str(employee_id)
 			session[cns.SESSION_EMAIL] = email
@@ -100,374 +174,444 @@ def authenticate():
 			session[cns.SESSION_COMPANY_NAME] = company_name
 			session[cns.SESSION_COMPANY_PLAN] = company_plan
 			session.permanent = True
-			app.permanent_session_lifetime = timedelta(hours=24)
-			return redirect(url_for('index'))
+			return redirect(url_for('.index'))
 		else:
 			# login failed
-			return redirect(url_for('error', message_key=cns.MSG_EMAIL_MISMATCH))
+			return redirect(url_for('.error', message_key=cns.MSG_EMAIL_MISMATCH))
 	else:
 		# email or password was null
-		return redirect(url_for('error', message_key=cns.MSG_NO_EMAIL_PASSWORD))
+		return redirect(url_for('.error', message_key=cns.MSG_NO_EMAIL_PASSWORD))
 
-@app.route('/user_home')
+@bp.route('/user_home')
 def user_home():
 	if cns.SESSION_EMAIL in session:
-		# get number of expenses and reports that the user has
-		sql_string = "select count(distinct expense.id), count(distinct report.id)"\
-				" from expense join report"\
-				" on expense.report_id = report.id"\
-				" where expense.user_id = %s"\
-							" and report.status = %s"
-		params = (session[cns.SESSION_EMPLOYEE_ID], cns.STATUS_OPEN)
-
-		inprogress_records = sql_select(sql_string, params)
-		sql_string = "select count(distinct expense.id), count(distinct report.id)"\
-				" from expense join report"\
-				" on expense.report_id = report.id"\
-				" where expense.user_id = %s"\
-							" and report.status = %s"
-		params = (session[cns.SESSION_EMPLOYEE_ID], cns.STATUS_SUBMITTED)
-		submitted_records = sql_select(sql_string, params)
-		sql_string = "select count(distinct expense.id), count(distinct report.id)"\
-				" from expense join report"\
-				" on expense.report_id = report.id"\
-				" where expense.user_id = %s"\
-							" and report.status = %s"
-		params = (session[cns.SESSION_EMPLOYEE_ID], cns.STATUS_APRROVED)
-		approved_records = sql_select(sql_string, params)
+		# get number of expenses and reports that the user has in each status
+		user_id = session[cns.SESSION_EMPLOYEE_ID]
+		if session.get(cns.SESSION_ROLE) == cns.ROLE_APPROVER:
+			# the navigator of an approver shows the approval counts, which are read with the dashboard counts in one round trip
+			counts, g.approval_counts = get_dashboard_and_approval_counts(user_id, session[cns.SESSION_COMPANY_ID])
+		else:
+			counts = get_dashboard_counts(user_id)
+		if counts is None:
+			sql_string = qry.DASHBOARD_COUNTS
+			params = (user_id,)
+			results = sql_select(sql_string, params)
+			counts = {status: [0, 0] for status in (cns.STATUS_OPEN, cns.STATUS_SUBMITTED, cns.STATUS_APRROVED)}
+			if results is not None:
+				for status, expense_count, report_count in results:
+					counts[status] = [expense_count, report_count]
+				set_dashboard_counts(user_id, counts)
 		return display_page('user_home.html', params=getPendoParams(),
 																			title=cns.TITLE_INDEX,
-																			inprogress_records=inprogress_records[0],
-																			submitted_records=submitted_records[0],
-																			approved_records=approved_records[0])
+																			inprogress_records=counts[cns.STATUS_OPEN],
+																			submitted_records=counts[cns.STATUS_SUBMITTED],
+																			approved_records=counts[cns.STATUS_APRROVED])
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/expense_list_html')
+@bp.route('/expense_list_html')
 def expense_list_html():
 	if cns.SESSION_EMAIL in session:
 		expenses = []
-		sql_string = "select expense.id, name, date, amount, currency, description, receipt_image"\
-					" from expense join employee"\
-					" on expense.user_id = employee.id"\
-					" where expense.user_id = %s"\
-								" and expense.report_id is null"
+		sql_string = qry.EXPENSE_LIST
 		params = (session[cns.SESSION_EMPLOYEE_ID],)
-		expenses = sql_select(sql_string, params)
-		return display_page('expense_list.html', params=getPendoParams(), expenses=expenses, title=cns.TITLE_EXPENSE_LIST)
+		if request.args.get('all'):
+			# stream all expenses instead of a page
+			expenses = RowStream(sql_select_stream(qry.EXPENSE_LIST_ALL, params))
+			return display_page_stream('expense_list.html', params=getPendoParams(), expenses=expenses, pager=None, title=cns.TITLE_EXPENSE_LIST)
+		after, before, page_size = get_page_args()
+		expenses, pager = sql_select_page(sql_string, params, 'expense.id', after, before, page_size)
+		pager['all'] = True
+		amounts = get_locale().format_amounts(expenses or [])
+		return display_page('expense_list.html', params=getPendoParams(), expenses=expenses, amounts=amounts, pager=pager, title=cns.TITLE_EXPENSE_LIST)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/expense_detail_html', methods=['POST'])
+@bp.route('/expense_detail_html', methods=['POST'])
 def expense_detail_html():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "select id, name, date, amount, currency, description, receipt_image"\
-					" from expense"\
-					" where id = %s"
+		sql_string = qry.EXPENSE_DETAIL
 		params = (request.form['id'],)
 		results = sql_select(sql_string, params)
 		if len(results) == 1:
 			return display_page('expense_detail.html', params=getPendoParams(), expense=results[0], title=cns.TITLE_EXPENSE_DETAIL)
 		else:
-			return redirect(url_for('error', message_key=cns.MSG_NO_EXPENSE_ID_MATCH))
+			return redirect(url_for('.error', message_key=cns.MSG_NO_EXPENSE_ID_MATCH))
 
-@app.route('/expense_new_html')
+@bp.route('/expense_new_html')
 def expense_new_html():		
 	if cns.SESSION_EMAIL in session:
 		return display_page('expense_new.html', params=getPendoParams(), title=cns.TITLE_EXPENSE_NEW, default_currency=get_default_currency())
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/create_expense', methods=['POST'])
+@bp.route('/create_expense', methods=['POST'])
 def create_expense():
 	if cns.SESSION_EMAIL in session:
 		file = request.files.get('receipt_image')
-		file_name = save_file(file)
-		sql_string = "insert into expense(name, date, amount, currency, description, receipt_image, user_id)"\
-								" values(%s, %s, %s, %s, %s, %s, %s)"
-		params = (request.form['name'], request.form['date'], request.form['amount'], request.form['currency'], request.form['description'], file_name, session[cns.SESSION_EMPLOYEE_ID])
-		sql_execute(sql_string, params)
-		return redirect(url_for('expense_list_html'))
+		try:
+			with receipt_transaction(file) as (cursor, file_name):
+				sql_string = qry.CREATE_EXPENSE
+				params = (request.form['name'], request.form['date'], request.form['amount'], request.form['currency'], request.form['description'], file_name, session[cns.SESSION_EMPLOYEE_ID])
+				execute_instrumented(cursor, sql_string, params)
+		except psycopg2.Error as exception:
+			print('failed to create expense:', exception)
+		invalidate_dashboard(session[cns.SESSION_EMPLOYEE_ID])
+		return redirect(url_for('.expense_list_html'))
+	else:
+		return redirect(url_for('.login'))
+
+@bp.route('/import_expense_file', methods=['POST'])
+def import_expense_file():
+	if cns.SESSION_EMAIL in session:
+		file = request.files.get('import_file')
+		result = None
+		if file:
+			try:
+				result = import_expenses(file.stream, get_import_format(file.filename), session[cns.SESSION_EMPLOYEE_ID])
+			except psycopg2.Error as exception:
+				print('import failed:', exception)
+			invalidate_dashboard(session[cns.SESSION_EMPLOYEE_ID])
+		return display_page('expense_import.html', params=getPendoParams(), title=cns.TITLE_EXPENSE_IMPORT, result=result)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/update_expense', methods=['POST'])
+@bp.route('/update_expense', methods=['POST'])
 def update_expense():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "update expense set"\
-								" name = %s,"\
-								" date = %s,"\
-								" currency = %s,"\
-								" amount = %s,"\
-								" description = %s"\
-								" where id = %s"
+		sql_string = qry.UPDATE_EXPENSE
 		params = (request.form['name'], request.form['date'], request.form['currency'], request.form['amount'], request.form['description'], request.form['id'])
 		sql_execute(sql_string, params)
 
-		return redirect(url_for('expense_list_html'))
+		return redirect(url_for('.expense_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/delete_expense', methods=['POST'])
+@bp.route('/delete_expense', methods=['POST'])
 def delete_expense():
 	if cns.SESSION_EMAIL in session:
 		if (request.form['id']):
-			receipt_image = request.form.get('receipt_image')
-			delete_file(receipt_image)
-			sql_string = "delete from expense"\
-									" where id = %s"
+			sql_string = qry.DELETE_EXPENSE
 			params = (request.form['id'],)
-			sql_execute(sql_string, params)
-		return redirect(url_for('expense_list_html'))
+			results = sql_execute(sql_string, params)
+			# the receipt is deleted if no other expense refers to it
+			for result in results or []:
+				delete_file(result['receipt_image'])
+			invalidate_dashboard(session[cns.SESSION_EMPLOYEE_ID])
+		return redirect(url_for('.expense_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/delete_receipt_image', methods=['POST'])
+@bp.route('/delete_receipt_image', methods=['POST'])
 def delete_receipt_image():
 	if cns.SESSION_EMAIL in session:
-		receipt_image = request.form.get('receipt_image')
-		if delete_file(receipt_image):
-			sql_string = "update expense set"\
-									" receipt_image = null"\
-									" where id = %s"
-			params = (request.form['id'],)
-			sql_execute(sql_string, params)
-		return redirect(url_for('expense_detail_html'), code=307)
+		sql_string = qry.CLEAR_RECEIPT_IMAGE
+		params = (request.form['id'],)
+		results = sql_execute(sql_string, params)
+		# the receipt is deleted if no other expense refers to it
+		for result in results or []:
+			delete_file(result['receipt_image'])
+		return redirect(url_for('.expense_detail_html'), code=307)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/update_receipt_image', methods=['POST'])
+@bp.route('/update_receipt_image', methods=['POST'])
 def update_receipt_image():
 	if cns.SESSION_EMAIL in session:
 		file = request.files.get('new_receipt_image')
-		file_name = save_file(file)
-		if file_name:
-			sql_string = "update expense set"\
-									" receipt_image = %s"\
-									" where id = %s"
-			params = (file_name, request.form['id'])
-			sql_execute(sql_string, params)
-		return redirect(url_for('expense_detail_html'), code=307)
+		if file:
+			try:
+				with receipt_transaction(file) as (cursor, file_name):
+					sql_string = qry.UPDATE_RECEIPT_IMAGE
+					params = (request.form['id'], file_name)
+					execute_instrumented(cursor, sql_string, params)
+					results = cursor.fetchall()
+				# the previous receipt is deleted if no other expense refers to it
+				for result in results:
+					delete_file(result['receipt_image'])
+			except psycopg2.Error as exception:
+				print('failed to update receipt image:', exception)
+		return redirect(url_for('.expense_detail_html'), code=307)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/report_list_html')
+@bp.route('/report_list_html')
 def report_list_html():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "select report.id, name, submit_date, approve_date, status"\
-					" from report join employee"\
-					" on report.user_id = employee.id"\
-					" where report.user_id = %s"
+		sql_string = qry.REPORT_LIST
 		params = (session[cns.SESSION_EMPLOYEE_ID],)
-		reports = sql_select(sql_string, params)
-		return display_page('report_list.html', params=getPendoParams(), reports=reports, title=cns.TITLE_REPORT_LIST)
+		after, before, page_size = get_page_args()
+		reports, pager = sql_select_page(sql_string, params, 'report.id', after, before, page_size)
+		return display_page('report_list.html', params=getPendoParams(), reports=reports, pager=pager, title=cns.TITLE_REPORT_LIST)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/report_new_html')
+@bp.route('/report_new_html')
 def report_new_html():
 	if cns.SESSION_EMAIL in session:
 		return display_page('report_new.html', params=getPendoParams(), title=cns.TITLE_REPORT_NEW)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/create_report', methods=['POST'])
+@bp.route('/create_report', methods=['POST'])
 def create_report():
 	if cns.SESSION_EMAIL in session:
 		# create a report record
-		sql_string = "insert into report(name, user_id, status)"\
-								" values(%s, %s, %s)"
+		sql_string = qry.CREATE_REPORT
 		params = (request.form['name'], session[cns.SESSION_EMPLOYEE_ID], cns.STATUS_OPEN)
 		sql_execute(sql_string, params)
-		return redirect(url_for('report_list_html'))
+		return redirect(url_for('.report_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/report_detail_html', methods=['POST'])
+@bp.route('/report_detail_html', methods=['POST'])
 def report_detail_html():
 	if cns.SESSION_EMAIL in session:
 		# get the specified report
-		sql_string = "select id, name"\
-					" from report"\
-					" where id = %s"
+		sql_string = qry.REPORT_DETAIL
 		params = (request.form['id'],)
 		reports = sql_select(sql_string, params)
 		# retrieve a list of expenses which haven't been assigned to the report
 		expenses = []
-		sql_string = "select expense.id, name, date, amount, currency, description"\
-					" from expense"\
-					" join employee on expense.user_id = employee.id"\
-					" where expense.user_id = %s and expense.report_id is null"
-		params = (session[cns.SESSION_EMPLOYEE_ID])
+		sql_string = qry.REPORT_EXPENSES_OPEN
+		params = (session[cns.SESSION_EMPLOYEE_ID],)
 		expenses_open = sql_select(sql_string, params)
 		# retrieve a list of expenses which have already been assigned in the report
-		sql_string = "select expense.id, expense.name, date, amount, currency, description"\
-					" from expense"\
-					" join employee on expense.user_id = employee.id"\
-					" join report on expense.report_id = report.id"\
-					" where expense.user_id = %s"\
-								" and expense.report_id = %s"\
-								" and report.status = %s"
+		sql_string = qry.REPORT_EXPENSES_INCLUDED
 		params = (session[cns.SESSION_EMPLOYEE_ID], request.form['id'], cns.STATUS_OPEN)
 		expenses_included = sql_select(sql_string, params)
 
 		if len(reports) == 1:
 			return display_page('report_detail.html', params=getPendoParams(), report=reports[0], expenses_open=expenses_open, expenses_included=expenses_included, title=cns.TITLE_REPORT_DETAIL)
 		else:
-			return redirect(url_for('error', message_key=cns.MSG_NO_REPORT_ID_MATCH))
+			return redirect(url_for('.error', message_key=cns.MSG_NO_REPORT_ID_MATCH))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/update_report', methods=['POST'])
+@bp.route('/update_report', methods=['POST'])
 def update_report():
 	if cns.SESSION_EMAIL in session:
-		# update the name of the report
-		sql_string = "update report set"\
-								" name = %s"\
-								" where id = %s"
-		params = (request.form['name'], request.form['id'])
+		# rename the report, and add and remove expenses in a single statement
+		id_added = set(request.form.getlist('id_added', type=int))
+		id_removed = set(request.form.getlist('id_removed', type=int))
+		# an expense given in both lists is left as it is, as two parts of the statement would update it otherwise
+		id_added, id_removed = sorted(id_added - id_removed), sorted(id_removed - id_added)
+		sql_string = qry.UPDATE_REPORT
+		params = (request.form['name'], request.form['id'], session[cns.SESSION_EMPLOYEE_ID],
+							id_added, session[cns.SESSION_EMPLOYEE_ID],
+							id_removed)
 		sql_execute(sql_string, params)
-		# update the report ID in the expenses
-		id_added = request.form.getlist('id_added')
-		if id_added:
-			# add specified expenses to this report
-			sql_string = "update expense set"\
-									" report_id = %s"\
-									" where id in(%s)"
-			params = (request.form['id'], ",".join(id_added))
-			sql_execute(sql_string, params)
-		# remove the report ID from the expenses
-		id_removed = request.form.getlist('id_removed')
-		if id_removed:
-			# remove specified expenses from this report
-			sql_string = "update expense set"\
-									" report_id = null"\
-									" where id in(%s)"
-			params = (",".join(id_removed))
-			sql_execute(sql_string, params)
-		return redirect(url_for('report_detail_html'), code=307)
+		invalidate_dashboard(session[cns.SESSION_EMPLOYEE_ID])
+		return redirect(url_for('.report_detail_html'), code=307)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/delete_report', methods=['POST'])
+@bp.route('/delete_report', methods=['POST'])
 def delete_report():
 	if cns.SESSION_EMAIL in session:
 		# remove specified expenses from this report
-		sql_string = "update expense set"\
-								" report_id = null"\
-								" where expense.report_id = %s"
+		sql_string = qry.DETACH_REPORT_EXPENSES
 		params = (request.form['id'],)
 		sql_execute(sql_string, params)
 		# delete the specified report
-		sql_string = "delete from report"\
-								" where id = %s"
+		sql_string = qry.DELETE_REPORT
 		params = (request.form['id'],)
 		sql_execute(sql_string, params)
-		return redirect(url_for('report_list_html'))
+		invalidate_dashboard(session[cns.SESSION_EMPLOYEE_ID])
+		invalidate_approval_counts(session[cns.SESSION_COMPANY_ID])
+		return redirect(url_for('.report_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/submit_report', methods=['POST'])
+@bp.route('/submit_report', methods=['POST'])
 def submit_report():
 	if cns.SESSION_EMAIL in session:
-		# change the status of the report to submitted
-		sql_string = "update report set"\
-								" submit_date = %s,"\
-								" status = %s"\
-								" where report.id = %s"
+		# change the status of the report to submitted, and add it to the approval queue
+		sql_string = qry.SUBMIT_REPORT
 		params = (date.today().strftime('%Y-%m-%d'), cns.STATUS_SUBMITTED, request.form['id'])
-		sql_execute(sql_string, params)
-		return redirect(url_for('expense_list_html'))
+		results = sql_execute(sql_string, params)
+		invalidate_dashboard(session[cns.SESSION_EMPLOYEE_ID])
+		invalidate_approval_counts(session[cns.SESSION_COMPANY_ID])
+		# add the report to approve lists open in the company
+		for result in results or []:
+			publish_event(EVENT_REPORT_SUBMITTED, {'report_id': result['report_id'], 'name': result['name']}, company_channel(session[cns.SESSION_COMPANY_ID]))
+		return redirect(url_for('.expense_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/approve_list_html')
+@bp.route('/approve_list_html')
 def approve_list_html():
 	if cns.SESSION_EMAIL in session:
-		# get all reports submitted
-		sql_string = "select report.id as id, report.name as name, report.status as status"\
-								" from report join employee"\
-								" on report.user_id = employee.id"\
-								" where employee.company_id = %s and"\
-										" (report.status = %s or report.status = %s)"
-		params = (session[cns.SESSION_COMPANY_ID], cns.STATUS_SUBMITTED, cns.STATUS_APRROVED)
-		results = sql_select(sql_string, params)
-		reports_submitted = []
-		reports_approved = []
-		if results:
-			for result in results:
-				if result['status'] == cns.STATUS_SUBMITTED:
-					reports_submitted.append(result.copy())
-				elif result['status'] == cns.STATUS_APRROVED:
-					reports_approved.append(result.copy())
-		return display_page('approve_list.html', params=getPendoParams(), title=cns.TITLE_APPROVE_LIST, reports_submitted=reports_submitted, reports_approved=reports_approved)
+		# get reports submitted and approved from the approval queue of the company
+		company_id = session[cns.SESSION_COMPANY_ID]
+		if request.args.get('all'):
+			# stream all reports instead of a page; reports are queried for each status in the order of tables
+			sql_string = qry.APPROVE_LIST_BY_STATUS
+			reports_submitted = RowStream(sql_select_stream(sql_string, (company_id, cns.STATUS_SUBMITTED)))
+			reports_approved = RowStream(sql_select_stream(sql_string, (company_id, cns.STATUS_APRROVED)))
+			return display_page_stream('approve_list.html', params=getPendoParams(), title=cns.TITLE_APPROVE_LIST, reports_submitted=reports_submitted, reports_approved=reports_approved, pager_submitted=None, pager_approved=None)
+		# each status has its own pager; reports to approve with after and before, and approved reports with approved_after and approved_before
+		after, before, page_size = get_page_args()
+		reports_submitted, pager_submitted = sql_select_page(qry.APPROVE_LIST, (company_id, cns.STATUS_SUBMITTED), 'report_id', after, before, page_size)
+		after, before, page_size = get_page_args(APPROVED_PAGE_PREFIX)
+		reports_approved, pager_approved = sql_select_page(qry.APPROVE_LIST, (company_id, cns.STATUS_APRROVED), 'report_id', after, before, page_size)
+		pager_submitted['all'] = pager_approved['all'] = True
+		pager_approved['prefix'] = APPROVED_PAGE_PREFIX
+		return display_page('approve_list.html', params=getPendoParams(), title=cns.TITLE_APPROVE_LIST, reports_submitted=reports_submitted or [], reports_approved=reports_approved or [],
+							pager_submitted=pager_submitted, pager_approved=pager_approved)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/approve_report', methods=['POST'])
+# approve or reject the reports selected in the approve list in one statement, and show the outcome of each in the list
+@bp.route('/approve_report', methods=['POST'])
 def approve_report():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "update report set"\
-								" approve_date = %s,"\
-								" status = %s"\
-								" where report.id = %s"
-		params = (date.today().strftime('%Y-%m-%d'), cns.STATUS_APRROVED, request.form['id'])
-		sql_execute(sql_string, params)
-		return redirect(url_for('approve_list_html'))
+		sql_string = qry.APPROVE_REPORT
+		report_ids = request.form.getlist('id', type=int)
+		approve_date = date.today().strftime('%Y-%m-%d')
+		params = (approve_date, cns.STATUS_APRROVED, report_ids, session[cns.SESSION_COMPANY_ID], cns.STATUS_SUBMITTED)
+		results = sql_execute(sql_string, params) if report_ids else []
+		finish_approval(report_ids, results, cns.MSG_REPORT_APPROVED, EVENT_REPORT_APPROVED, {'approve_date': approve_date})
+		return redirect(url_for('.approve_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/reject_report', methods=['POST'])
+@bp.route('/reject_report', methods=['POST'])
 def reject_report():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "update report set"\
-								" submit_date = null,"\
-								" status = %s"\
-								" where report.id = %s"
-		params = (cns.STATUS_OPEN, request.form['id'])
-		sql_execute(sql_string, params)
-		return redirect(url_for('approve_list_html'))
+		sql_string = qry.REJECT_REPORT
+		report_ids = request.form.getlist('id', type=int)
+		params = (cns.STATUS_OPEN, report_ids, session[cns.SESSION_COMPANY_ID], cns.STATUS_SUBMITTED)
+		results = sql_execute(sql_string, params) if report_ids else []
+		finish_approval(report_ids, results, cns.MSG_REPORT_REJECTED, EVENT_REPORT_REJECTED, {})
+		return redirect(url_for('.approve_list_html'))
+	else:
+		return redirect(url_for('.login'))
+
+# invalidate caches and publish events of the reports changed by approval or rejection, and flash the outcome of each selected report
+# reports which weren't waiting for approval in the company of the approver are left unchanged
+def finish_approval(report_ids, results, outcome_key, event, data):
+	results = results or []
+	# the dashboards of the users who submitted the reports are changed
+	invalidate_dashboard(*{result['user_id'] for result in results})
+	invalidate_approval_counts(session[cns.SESSION_COMPANY_ID])
+	# update approve lists open in the company, and report lists of the users
+	publish_events([(event, dict(data, report_id=result['report_id']), (company_channel(session[cns.SESSION_COMPANY_ID]), employee_channel(result['user_id'])))
+		for result in results])
+	names = {result['report_id']: result['name'] for result in results}
+	for report_id in report_ids:
+		if report_id in names:
+			flash((report_id, names[report_id], outcome_key), FLASH_REPORT_OUTCOME)
+		else:
+			flash((report_id, None, cns.MSG_REPORT_UNCHANGED), FLASH_REPORT_OUTCOME)
+
+# Server-Sent Events of reports for open pages; approvers receive events of their company, and employees of their own reports
+# the stream holds no DB connection, and is served by one greenlet of a gevent worker (see gunicorn.conf.py)
+@bp.route('/events')
+def events():
+	if cns.SESSION_EMAIL in session:
+		if not live_updates():
+			# the browser doesn't reconnect to a stream answered with 204 No Content
+			return Response(status=204)
+		channels = [employee_channel(session[cns.SESSION_EMPLOYEE_ID])]
+		if session[cns.SESSION_ROLE] in (cns.ROLE_APPROVER, cns.ROLE_ADMIN):
+			channels.append(company_channel(session[cns.SESSION_COMPANY_ID]))
+		return Response(stream_events(channels), mimetype='text/event-stream',
+			headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/employee_list_html')
+# Export reports approved in the company of the session between the dates with their expenses, for finance
+# the file is streamed as rows are fetched, and CSV is compressed on the fly when the browser accepts gzip
+@bp.route('/export_approved_reports')
+def export_approved_reports_file():
+	if cns.SESSION_EMAIL in session:
+		if session[cns.SESSION_ROLE] not in (cns.ROLE_APPROVER, cns.ROLE_ADMIN):
+			return redirect(url_for('.index'))
+		try:
+			date_from, date_to = get_export_period(request.args.get('from'), request.args.get('to'))
+		except ValueError:
+			return redirect(url_for('.error', message_key=cns.MSG_INVALID_EXPORT_PERIOD))
+		export_format = FORMAT_XLSX if request.args.get('format') == FORMAT_XLSX else FORMAT_CSV
+		# XLSX is already a ZIP archive
+		compress = export_format == FORMAT_CSV and 'gzip' in request.accept_encodings
+		company_id = session[cns.SESSION_COMPANY_ID]
+		headers = {'Content-Disposition': f"attachment; filename=approved_{company_id}_{date_from}_{date_to}.{export_format}",
+			'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no', 'Vary': 'Accept-Encoding'}
+		if compress:
+			headers['Content-Encoding'] = 'gzip'
+		# an error of the query ends the response without the final chunk, so that the client fails instead of saving a truncated file
+		chunks = export_approved_reports(company_id, date_from, date_to, export_format, compress)
+		return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format], headers=headers)
+	else:
+		return redirect(url_for('.login'))
+
+# dates of the period to export given as YYYY-MM-DD; the current month by default
+def get_export_period(date_from, date_to):
+	today = date.today()
+	date_from = date.fromisoformat(date_from) if date_from else today.replace(day=1)
+	date_to = date.fromisoformat(date_to) if date_to else today
+	if date_from > date_to:
+		raise ValueError('the period ends before it starts')
+	return date_from, date_to
+
+# Spend of the company by month and currency, and of each employee in a month, for admins
+# read only from the rollups, so that the page doesn't depend on the number of expenses
+@bp.route('/analytics_html')
+def analytics_html():
+	if cns.SESSION_EMAIL in session:
+		if session[cns.SESSION_ROLE] != cns.ROLE_ADMIN:
+			return redirect(url_for('.index'))
+		company_id = session[cns.SESSION_COMPANY_ID]
+		months = min(max(request.args.get('months', ANALYTICS_MONTHS, type=int), 1), ANALYTICS_MONTHS_MAX)
+		spend_by_month = pivot_rollups(sql_select(qry.ROLLUP_COMPANY_MONTHS, (company_id, first_month(date.today(), months))), ['month', 'currency'])
+		# employees are shown for the month given as YYYY-MM, or the latest month with expenses
+		try:
+			month = date.fromisoformat(request.args['month'] + '-01')
+		except (KeyError, ValueError):
+			month = spend_by_month[0]['month'] if spend_by_month else None
+		spend_by_employee = []
+		if month is not None:
+			spend_by_employee = pivot_rollups(sql_select(qry.ROLLUP_EMPLOYEE_MONTH, (company_id, month)), ['employee_id', 'first_name', 'last_name', 'currency'])
+		return display_page('analytics.html', params=getPendoParams(), title=cns.TITLE_ANALYTICS, statuses=ROLLUP_STATUSES, months=months,
+			spend_by_month=spend_by_month, month=month, spend_by_employee=spend_by_employee)
+	else:
+		return redirect(url_for('.login'))
+
+@bp.route('/employee_list_html')
 def employee_list_html():
 	if cns.SESSION_EMAIL in session:
 		# get all employees in this company
-		sql_string = "select id, email, first_name, last_name, role"\
-								" from employee"\
-								" where company_id = %s"
+		sql_string = qry.EMPLOYEE_LIST
 		params = (session[cns.SESSION_COMPANY_ID],)
-		employees = sql_select(sql_string, params)
-		return display_page('employee_list.html', params=getPendoParams(), title=cns.TITLE_EMPLOYEE_LIST, employees=employees)
+		after, before, page_size = get_page_args()
+		employees, pager = sql_select_page(sql_string, params, 'id', after, before, page_size)
+		return display_page('employee_list.html', params=getPendoParams(), title=cns.TITLE_EMPLOYEE_LIST, employees=employees, pager=pager)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/employee_new_html')
+@bp.route('/employee_new_html')
 def employee_new_html():
 	if cns.SESSION_EMAIL in session:
 		return display_page('employee_new.html', params=getPendoParams(), title=cns.TITLE_EMPLOYEE_NEW)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/employee_detail_html', methods=['POST'])
+@bp.route('/employee_detail_html', methods=['POST'])
 def employee_detail_html():
 	if cns.SESSION_EMAIL in session:
 		# get details of the employee record
-		sql_string = "select id, first_name, last_name, email, password, role"\
-								" from employee"\
-								" where id = %s"
+		sql_string = qry.EMPLOYEE_DETAIL
 		params = (request.form['id'],)
 		employees = sql_select(sql_string, params)
 		return display_page('employee_detail.html', params=getPendoParams(), title=cns.TITLE_EMPLOYEE_DETAIL, employee=employees[0])
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/create_employee', methods=['POST'])
+@bp.route('/create_employee', methods=['POST'])
 def create_employee():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "insert into employee(first_name, last_name, email, password, role, company_id)"\
-								" values(%s, %s, %s, %s, %s, %s)"
+		sql_string = qry.CREATE_EMPLOYEE
 		params = (request.form['first_name'], 
 							request.form['last_name'], 
 							request.form['email'], 
@@ -475,39 +619,331 @@ def create_employee():
 							request.form['role'], 
 							session[cns.SESSION_COMPANY_ID])
 		sql_execute(sql_string, params)
-		return redirect(url_for('employee_list_html'))
+		return redirect(url_for('.employee_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/update_employee', methods=['POST'])
+@bp.route('/update_employee', methods=['POST'])
 def update_employee():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "update employee set"\
-								" first_name = %s,"\
-								" last_name = %s,"\
-								" email = %s,"\
-								" role = %s"\
-								" where id = %s"
+		sql_string = qry.UPDATE_EMPLOYEE
 		params = (request.form['first_name'], 
 							request.form['last_name'], 
 							request.form['email'], 
 							request.form['role'], 
 							request.form['id'])
 		sql_execute(sql_string, params)
-		return redirect(url_for('employee_list_html'))
+		return redirect(url_for('.employee_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 
-@app.route('/delete_employee', methods=['POST'])
+@bp.route('/delete_employee', methods=['POST'])
 def delete_employee():
 	if cns.SESSION_EMAIL in session:
-		sql_string = "delete from employee"\
-								" where id = %s"
-		params = (request.form['id'])
+		sql_string = qry.DELETE_EMPLOYEE
+		params = (request.form['id'],)
 		sql_execute(sql_string, params)
-		return redirect(url_for('employee_list_html'))
+		return redirect(url_for('.employee_list_html'))
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
+
+# import expenses of the employee from CSV or JSON Lines; flask --app expense_report_demo import-expenses EMPLOYEE_ID FILE
+@bp.cli.command('import-expenses')
+@click.argument('employee_id')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_expenses_command(employee_id, path):
+	with open(path, 'rb') as import_file:
+		result = import_expenses(import_file, get_import_format(path), employee_id)
+	print('imported:', result['imported'], ', errors:', result['error_count'])
+	for error in result['errors']:
+		print('line', error['line'], ':', error['error'])
+
+# export reports approved in the company between the dates with their expenses
+# flask --app expense_report_demo export-approved COMPANY_ID --from 2024-04-01 --to 2024-04-30 --format xlsx --output approved.xlsx
+@bp.cli.command('export-approved')
+@click.argument('company_id', type=int)
+@click.option('--from', 'date_from', default=None, help='first approve date as YYYY-MM-DD; the first day of this month by default')
+@click.option('--to', 'date_to', default=None, help='last approve date as YYYY-MM-DD; today by default')
+@click.option('--format', 'export_format', default=FORMAT_CSV, type=click.Choice([FORMAT_CSV, FORMAT_XLSX]), help='format of the file')
+@click.option('--output', default='-', type=click.File('wb'), help='file to write to; standard output by default')
+@click.option('--gzip', 'compress', is_flag=True, help='compress the file with gzip')
+def export_approved_command(company_id, date_from, date_to, export_format, output, compress):
+	try:
+		date_from, date_to = get_export_period(date_from, date_to)
+	except ValueError as exception:
+		raise click.BadParameter(str(exception))
+	try:
+		for chunk in export_approved_reports(company_id, date_from, date_to, export_format, compress):
+			output.write(chunk)
+	except psycopg2.Error as exception:
+		raise click.ClickException('export failed: ' + str(exception).strip())
+
+# recompute the rollups of spend from expenses, of a company or of all companies; flask --app expense_report_demo rebuild-rollups
+@bp.cli.command('rebuild-rollups')
+@click.option('--company-id', default=None, type=int, help='company to rebuild the rollups of; all companies by default')
+def rebuild_rollups_command(company_id):
+	rows = rebuild_rollups(company_id)
+	print('rebuilt rollups:', rows, 'rows')
+
+# apply migrations in migrations/; flask --app expense_report_demo migrate
+@bp.cli.command('migrate')
+@click.option('--dry-run', is_flag=True, help='list migrations to apply without applying them')
+def migrate_command(dry_run):
+	versions = migrate(dry_run=dry_run)
+	for version in versions:
+		click.echo(f"{'pending' if dry_run else 'applied'} migration: {version}")
+	if not versions:
+		click.echo('no migration to apply')
+
+# generate synthetic companies, employees, reports and expenses for load tests
+# flask --app expense_report_demo seed --companies 10 --credentials loadtest/users.csv
+@bp.cli.command('seed')
+@click.option('--companies', default=10, help='number of companies')
+@click.option('--employees', default=20, help='mean number of employees per company')
+@click.option('--expenses', default=50, help='mean number of expenses per employee')
+@click.option('--password', default='password', help='password of the employees')
+@click.option('--seed', default=None, type=int, help='random seed to generate the same data')
+@click.option('--credentials', default=None, type=click.Path(dir_okay=False), help='CSV file to write email, password and role of the employees to')
+def seed_command(companies, employees, expenses, password, seed, credentials):
+	counts, employee_credentials = seed_database(companies, employees, expenses, password, seed)
+	print('seeded:', ', '.join(f"{count} {table}" for table, count in counts.items()))
+	if credentials:
+		with open(credentials, 'w', newline='') as credentials_file:
+			writer = csv.writer(credentials_file)
+			writer.writerow(['email', 'password', 'role'])
+			writer.writerows(employee_credentials)
+
+# replay registered queries under EXPLAIN (ANALYZE, BUFFERS) and report sequential scans
+# flask --app expense_report_demo explain-queries
+@bp.cli.command('explain-queries')
+@click.option('--employee-id', default=None, help='employee to replay queries as; the one with the most expenses by default')
+@click.option('--disable-seqscan', is_flag=True, help='plan with enable_seqscan off to find queries no index can serve')
+def explain_queries_command(employee_id, disable_seqscan):
+	seq_scan_count = 0
+	for result in explain_queries(employee_id, PAGE_SIZE_DEFAULT, disable_seqscan):
+		if result['analyzed']:
+			print(f"{result['query']}: planning {result['planning_ms']:.3f} ms, execution {result['execution_ms']:.3f} ms,"\
+				f" buffers hit {result['shared_hit']} read {result['shared_read']}")
+		else:
+			print(f"{result['query']}: estimated plan, since it failed with the sample: {result['error']}")
+		for relation, condition, rows in result['seq_scans']:
+			seq_scan_count += 1
+			print(f"  Seq Scan on {relation} ({rows} rows)" + (f" filter: {condition}" if condition else ''))
+	print('sequential scans:', seq_scan_count)
+
+# compare planning overhead of the list and dashboard queries executed as text and as prepared statements
+# flask --app expense_report_demo benchmark-queries EMPLOYEE_ID
+@bp.cli.command('benchmark-queries')
+@click.argument('employee_id')
+@click.option('--iterations', default=200, help='number of calls of each query')
+def benchmark_queries_command(employee_id, iterations):
+	company_id = sql_select("select company_id from employee where id = %s", (employee_id,))[0][0]
+	benchmarks = [
+		(qry.DASHBOARD_COUNTS, (employee_id,)),
+		(qry.EXPENSE_LIST.pages[qry.PAGE_FIRST], (employee_id, PAGE_SIZE_DEFAULT + 1)),
+		(qry.REPORT_LIST.pages[qry.PAGE_FIRST], (employee_id, PAGE_SIZE_DEFAULT + 1)),
+		(qry.APPROVE_LIST.pages[qry.PAGE_FIRST], (company_id, cns.STATUS_SUBMITTED, PAGE_SIZE_DEFAULT + 1)),
+		(qry.EMPLOYEE_LIST.pages[qry.PAGE_FIRST], (company_id, PAGE_SIZE_DEFAULT + 1)),
+	]
+	print(f"{'query':<28}{'text ms':>10}{'prepared ms':>13}{'text planning ms':>18}{'prepared planning ms':>22}")
+	for query, params in benchmarks:
+		result = benchmark_query(query, params, iterations)
+		print(f"{query.name:<28}{result['text'] * 1000:>10.3f}{result['prepared'] * 1000:>13.3f}"\
+			f"{result['text_planning_ms']:>18.3f}{result['prepared_planning_ms']:>22.3f}")
+
+# measure cold start of a worker in fresh processes: importing the app, and serving its first request
+# flask --app expense_report_demo benchmark-startup
+STARTUP_PROBE = """
+import time, json
+started = time.perf_counter()
+import expense_report_demo
+app = expense_report_demo.create_app()
+imported = time.perf_counter()
+status = app.test_client().get('/login').status_code
+print(json.dumps({'import': imported - started, 'first_request': time.perf_counter() - imported, 'status': status}))
+"""
+
+@bp.cli.command('benchmark-startup')
+@click.option('--runs', default=10, help='number of processes to start')
+def benchmark_startup_command(runs):
+	results = {'process': [], 'import': [], 'first_request': []}
+	for _ in range(runs):
+		started = time.perf_counter()
+		output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], capture_output=True, text=True, check=True).stdout
+		results['process'].append(time.perf_counter() - started)
+		probe = json.loads(output.splitlines()[-1])
+		results['import'].append(probe['import'])
+		results['first_request'].append(probe['first_request'])
+	print(f"{'phase':<16}{'median ms':>12}{'max ms':>10}")
+	for phase, durations in results.items():
+		print(f"{phase:<16}{statistics.median(durations) * 1000:>12.1f}{max(durations) * 1000:>10.1f}")
+
+# compare the single statement of update_report adding and removing expenses of a report with a statement and a commit for each direction and the name
+# a report and expenses are created for the employee and deleted afterwards
+# flask --app expense_report_demo benchmark-update-report EMPLOYEE_ID
+@bp.cli.command('benchmark-update-report')
+@click.argument('employee_id', type=int)
+@click.option('--expenses', 'expense_count', default=200, help='number of expenses added to and removed from the report')
+@click.option('--iterations', default=20, help='number of times the expenses are added and removed')
+def benchmark_update_report_command(employee_id, expense_count, iterations):
+	name = f"benchmark-update-report {os.getpid()}"
+	report_id = sql_execute("insert into report(name, user_id, status) values(%s, %s, %s) returning id", (name, employee_id, cns.STATUS_OPEN))[0][0]
+	expense_ids = [row[0] for row in sql_execute("insert into expense(name, date, amount, currency, user_id)"\
+		" select %s, current_date, 1, %s, %s from generate_series(1, %s) returning id", (name, cns.CURRENCY_DOLLAR, employee_id, expense_count))]
+	results = []
+	try:
+		started = time.perf_counter()
+		for _ in range(iterations):
+			for id_added, id_removed in ((expense_ids, []), ([], expense_ids)):
+				sql_execute(qry.UPDATE_REPORT, (name, report_id, employee_id, id_added, employee_id, id_removed))
+		results.append(('statement', time.perf_counter() - started))
+		started = time.perf_counter()
+		for _ in range(iterations):
+			for id_added, id_removed in ((expense_ids, []), ([], expense_ids)):
+				sql_execute("update report set name = %s where id = %s and user_id = %s", (name, report_id, employee_id))
+				sql_execute("update expense set report_id = %s where id = any(%s) and user_id = %s and report_id is null", (report_id, id_added, employee_id))
+				sql_execute("update expense set report_id = null where id = any(%s) and report_id = %s", (id_removed, report_id))
+		results.append(('per direction', time.perf_counter() - started))
+	finally:
+		sql_execute("delete from expense where user_id = %s and name = %s", (employee_id, name))
+		sql_execute("delete from report where id = %s", (report_id,))
+	print(f"{'path':<16}{'ms/update':>12}{'expenses/s':>12}")
+	for path, duration in results:
+		print(f"{path:<16}{duration / (iterations * 2) * 1000:>12.2f}{expense_count * iterations * 2 / duration:>12.0f}")
+
+# test client logged in as the employee, and the pages of the employee read from the database; (method, path, form data)
+def benchmark_client(app, employee_id):
+	email, password = sql_select("select email, password from employee where id = %s", (employee_id,))[0]
+	report_id = sql_select("select max(id) from report where user_id = %s", (employee_id,))[0][0]
+	pages = [('GET', '/user_home', None), ('GET', '/expense_list_html', None), ('GET', '/report_list_html', None)]
+	if report_id is not None:
+		pages.append(('POST', '/report_detail_html', {'id': report_id}))
+	client = app.test_client()
+	client.post('/authenticate', data={'email': email, 'password': password})
+	return client, pages
+
+# count Redis commands of pages of the employee, and the commands sent while templates render, where each message used to be looked up
+# flask --app expense_report_demo benchmark-messages EMPLOYEE_ID
+@bp.cli.command('benchmark-messages')
+@click.argument('employee_id', type=int)
+@click.option('--requests', 'request_count', default=50, help='number of requests of each page')
+def benchmark_messages_command(employee_id, request_count):
+	app = current_app._get_current_object()
+	client, pages = benchmark_client(app, employee_id)
+	counts = {'request': 0, 'render': 0}
+	rendering = []
+	redis_client = getRedisClient()
+	execute_command = redis_client.execute_command
+	def counted_command(*args, **options):
+		counts['request'] += 1
+		if rendering:
+			counts['render'] += 1
+		return execute_command(*args, **options)
+	def render_started(sender, template, context, **extra):
+		rendering.append(template)
+	def render_finished(sender, template, context, **extra):
+		rendering.pop()
+	redis_client.execute_command = counted_command
+	before_render_template.connect(render_started, app)
+	template_rendered.connect(render_finished, app)
+	try:
+		print(f"{'page':<24}{'redis/request':>15}{'redis/render':>14}{'ms/request':>12}")
+		for method, path, data in pages:
+			counts.update(request=0, render=0)
+			started = time.perf_counter()
+			for _ in range(request_count):
+				client.open(path, method=method, data=data)
+			duration = time.perf_counter() - started
+			print(f"{path:<24}{counts['request'] / request_count:>15.2f}{counts['render'] / request_count:>14.2f}{duration / request_count * 1000:>12.2f}")
+	finally:
+		del redis_client.execute_command
+		before_render_template.disconnect(render_started, app)
+		template_rendered.disconnect(render_finished, app)
+
+# compare rows per second of importing expenses with inserting them one by one as create_expense does; the expenses are deleted afterwards
+# flask --app expense_report_demo benchmark-import EMPLOYEE_ID
+@bp.cli.command('benchmark-import')
+@click.argument('employee_id', type=int)
+@click.option('--rows', default=1000, help='number of expenses inserted by each path')
+def benchmark_import_command(employee_id, rows):
+	name = f"benchmark-import {os.getpid()}"
+	expenses = [(name, date.today().isoformat(), f"{index % 1000}.50", cns.CURRENCIES[index % len(cns.CURRENCIES)], f"row {index}") for index in range(rows)]
+	buffer = io.StringIO()
+	writer = csv.writer(buffer, lineterminator='\n')
+	writer.writerow(['name', 'date', 'amount', 'currency', 'description'])
+	writer.writerows(expenses)
+	results = []
+	try:
+		started = time.perf_counter()
+		for expense in expenses:
+			sql_execute(qry.CREATE_EXPENSE, expense + (None, employee_id))
+		results.append(('per row', rows, time.perf_counter() - started))
+		started = time.perf_counter()
+		imported = import_expenses(io.BytesIO(buffer.getvalue().encode('utf8')), IMPORT_FORMAT_CSV, employee_id)['imported']
+		results.append(('import', imported, time.perf_counter() - started))
+	finally:
+		sql_execute("delete from expense where user_id = %s and name = %s", (employee_id, name))
+	print(f"{'path':<12}{'rows':>8}{'seconds':>10}{'rows/s':>10}")
+	for path, count, duration in results:
+		print(f"{path:<12}{count:>8}{duration:>10.3f}{count / duration:>10.0f}")
+
+# compare time of pages of the employee with and without the profiling middleware
+# requests with and without it alternate, so that drift of the database and caches is shared by both, and the medians of single requests are compared
+# the time includes the test client, and the greenlet clock of gevent workers isn't installed here
+# flask --app expense_report_demo benchmark-profiling EMPLOYEE_ID
+@bp.cli.command('benchmark-profiling')
+@click.argument('employee_id', type=int)
+@click.option('--requests', 'request_count', default=500, help='number of requests of each page with the middleware and without it')
+def benchmark_profiling_command(employee_id, request_count):
+	app = current_app._get_current_object()
+	if not isinstance(app.wsgi_app, ProfilingMiddleware):
+		raise click.ClickException('the profiling middleware is off; run with PROFILING_ENABLED=1')
+	client, pages = benchmark_client(app, employee_id)
+	profiled = app.wsgi_app
+	durations = {(path, profiling): [] for _, path, _ in pages for profiling in (False, True)}
+	# each request runs in a context of its own, so that it pushes an app context as in a worker instead of sharing the one of this command
+	def request_page(method, path, data):
+		started = time.perf_counter()
+		client.open(path, method=method, data=data).close()
+		return time.perf_counter() - started
+	try:
+		for method, path, data in pages:
+			for index in range(request_count):
+				for profiling in ((False, True) if index % 2 == 0 else (True, False)):
+					app.wsgi_app = profiled if profiling else profiled.wsgi_app
+					durations[(path, profiling)].append(contextvars.Context().run(request_page, method, path, data))
+	finally:
+		app.wsgi_app = profiled
+	print(f"{'page':<24}{'off ms':>10}{'on ms':>10}{'overhead us':>13}{'overhead %':>12}")
+	for _, path, _ in pages:
+		off = statistics.median(durations[(path, False)])
+		on = statistics.median(durations[(path, True)])
+		print(f"{path:<24}{off * 1000:>10.3f}{on * 1000:>10.3f}{(on - off) * 1000000:>13.1f}{(on - off) / off * 100:>12.2f}")
+
+# Create the app; no client is connected here, as the DB pool, Redis and the Pendo shipper are created on first use,
+# so that workers boot fast and workers forked from a preloaded master don't share its sockets (see gunicorn.conf.py)
+def create_app():
+	app = Flask(__name__)
+	# debug mode only if FLASK_DEBUG is set, e.g. by flask run --debug in development
+	app.debug = get_debug_flag()
+	# a random secret used by Flask to encrypt session data cookies
+	app.secret_key = os.environ.get('FLASK_SECRET_KEY')
+	# sessions are kept in Redis for 24 hours from the last request
+	app.permanent_session_lifetime = timedelta(hours=24)
+	init_sessions(app)
+	# set the language of the session from Accept-Language
+	app.before_request(apply_language)
+	# return the DB connection of the request to the pool
+	app.teardown_appcontext(release_db_connection)
+	# record the number of SQL statements in the request
+	app.teardown_request(record_request_queries)
+	app.context_processor(function_processor)
+	app.register_blueprint(bp)
+	# record wall, CPU and component time of each route
+	init_profiling(app)
+	# load messages from the message files
+	preload_messages()
+	return app
 
 if __name__ == '__main__':
   main()
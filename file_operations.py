@@ -1,8 +1,21 @@
 import os
-import uuid
+import shutil
+import logging
+import hashlib
+import tempfile
+import mimetypes
+from contextlib import contextmanager
+import psycopg2
 import werkzeug
+from flask import url_for
 
+import queries as qry
 from utilities import send_track_event
+from db_operations import sql_transaction, execute_instrumented
+from profiling import timed, COMPONENT_HTTP
+from image_operations import DERIVATIVE_SIZES, derivative_name, create_derivatives, submit_image_job
+
+logger = logging.getLogger(__name__)
 
 # Events
 EVENT_FILE_UPLOADED = 'FileUploaded'
@@ -11,24 +24,184 @@ EVENT_FILE_DELETED = 'FileDeleted'
 # root path for image files
 RECEIPT_IMAGE_ROOT = 'static/images/receipt/'
 
-# Save the specified file and return the name
+# receipt store settings
+RECEIPT_STORE = os.environ.get('RECEIPT_STORE', 'local') # local or s3
+RECEIPT_S3_BUCKET = os.environ.get('RECEIPT_S3_BUCKET')
+RECEIPT_S3_PREFIX = os.environ.get('RECEIPT_S3_PREFIX', 'receipt/')
+RECEIPT_S3_ENDPOINT_URL = os.environ.get('RECEIPT_S3_ENDPOINT_URL') # e.g. URL of MinIO
+RECEIPT_S3_PUBLIC_URL = os.environ.get('RECEIPT_S3_PUBLIC_URL') # URL of the bucket if it's public, otherwise presigned URLs are used
+RECEIPT_UPLOAD_CHUNK_SIZE = 64 * 1024
+RECEIPT_STORE_INSTANCE = None
+
+# Receipt store on the local file system, served as static files
+class LocalReceiptStore:
+	def __init__(self, root):
+		self.root = root
+
+	def exists(self, key):
+		return os.path.exists(self.root + key)
+
+	def put(self, key, path):
+		destination = self.root + key
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		# link the file if possible, and copy it through a temporary file otherwise so that a partial file is never served
+		try:
+			os.link(path, destination)
+		except FileExistsError:
+			pass
+		except OSError:
+			shutil.copyfile(path, destination + '.tmp')
+			os.replace(destination + '.tmp', destination)
+
+	def delete(self, key):
+		if os.path.exists(self.root + key):
+			os.remove(self.root + key)
+
+	def url(self, key):
+		return url_for('static', filename=self.root[len('static/'):] + key)
+
+# Receipt store on S3 or a compatible storage like MinIO
+class S3ReceiptStore:
+	def __init__(self, bucket, prefix, endpoint_url=None, public_url=None):
+		# boto3 is required only when this store is used
+		import boto3
+		import botocore.exceptions
+		self.client = boto3.client('s3', endpoint_url=endpoint_url)
+		self.client_error = botocore.exceptions.ClientError
+		self.bucket = bucket
+		self.prefix = prefix
+		self.public_url = public_url
+
+	def exists(self, key):
+		try:
+			with timed(COMPONENT_HTTP):
+				self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+			return True
+		except self.client_error as error:
+			if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+				return False
+			raise
+
+	def put(self, key, path):
+		content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+		with timed(COMPONENT_HTTP):
+			self.client.upload_file(path, self.bucket, self.prefix + key, ExtraArgs={'ContentType': content_type})
+
+	def delete(self, key):
+		with timed(COMPONENT_HTTP):
+			self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+	def url(self, key):
+		if self.public_url:
+			return self.public_url.rstrip('/') + '/' + self.prefix + key
+		return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.prefix + key}, ExpiresIn=3600)
+
+def getReceiptStore():
+	global RECEIPT_STORE_INSTANCE
+	if RECEIPT_STORE_INSTANCE is None:
+		if RECEIPT_STORE == 's3':
+			RECEIPT_STORE_INSTANCE = S3ReceiptStore(RECEIPT_S3_BUCKET, RECEIPT_S3_PREFIX, RECEIPT_S3_ENDPOINT_URL, RECEIPT_S3_PUBLIC_URL)
+		else:
+			RECEIPT_STORE_INSTANCE = LocalReceiptStore(RECEIPT_IMAGE_ROOT)
+	return RECEIPT_STORE_INSTANCE
+
+# drop the store inherited from the parent process, as the S3 client isn't safe to share across a fork
+def reset_receipt_store():
+	global RECEIPT_STORE_INSTANCE
+	RECEIPT_STORE_INSTANCE = None
+
+# Write the uploaded file to a temporary file chunk by chunk while hashing it
+# return (SHA-256 of the content, path of the temporary file)
+def write_temporary_file(file):
+	digest = hashlib.sha256()
+	descriptor, path = tempfile.mkstemp(prefix='receipt_')
+	with os.fdopen(descriptor, 'wb') as temporary_file:
+		for chunk in iter(lambda: file.stream.read(RECEIPT_UPLOAD_CHUNK_SIZE), b''):
+			digest.update(chunk)
+			temporary_file.write(chunk)
+	return digest.hexdigest(), path
+
+# files are keyed by their content hash and sharded in subdirectories; e.g. ab/cd/abcd...ef.jpg
+def content_key(content_hash, file_name):
+	extension = os.path.splitext(werkzeug.utils.secure_filename(file_name))[1].lower()
+	return content_hash[0:2] + '/' + content_hash[2:4] + '/' + content_hash + extension
+
+# Create derivatives of the temporary file and put them in the store; this runs in a process of the pool
+def store_derivatives(path, key):
+	try:
+		for kind, derivative_path in create_derivatives(path).items():
+			try:
+				# the original may have been deleted meanwhile, e.g. when the expense referring to it wasn't saved
+				if getReceiptStore().exists(key):
+					getReceiptStore().put(derivative_name(key, kind), derivative_path)
+			finally:
+				os.remove(derivative_path)
+	finally:
+		os.remove(path)
+
+# Lock the receipt until the transaction of the cursor ends
+# an upload holds it from the check of the stored file until an expense refers to the file, and a deletion from the count of references
+# until the file is deleted, so that a file isn't deleted while an upload of the same content is starting to refer to it
+def lock_receipt(cursor, file_name):
+	cursor.execute("select pg_advisory_xact_lock(hashtext(%s))", (file_name,))
+
+# Save the specified file with the cursor of the transaction which refers to it, and return the key
 # If the format of the file is not correct or the file doesn't exist, then return None
-def save_file(file):
+def save_file(file, cursor):
 	if file:
-		file_name = str(uuid.uuid4()) + '_' + werkzeug.utils.secure_filename(file.filename)
-		file.save(RECEIPT_IMAGE_ROOT + file_name)
-		print('file created at ', RECEIPT_IMAGE_ROOT + file_name)
+		content_hash, path = write_temporary_file(file)
+		key = content_key(content_hash, file.filename)
+		lock_receipt(cursor, key)
+		store = getReceiptStore()
+		if store.exists(key):
+			# the same receipt has been uploaded already
+			os.remove(path)
+		else:
+			store.put(key, path)
+			logger.info("file created at %s", key)
+			submit_image_job(store_derivatives, path, key)
 		send_track_event(EVENT_FILE_UPLOADED)
-		return file_name
+		return key
 	else:
 		return None
 
-# Delete the specified file
+# Save the uploaded file and yield (cursor, key of the file) to refer to it in the same transaction; the key is None without a file
+# the file is deleted again if the transaction fails, unless another expense refers to it
+@contextmanager
+def receipt_transaction(file):
+	key = None
+	try:
+		with sql_transaction() as cursor:
+			key = save_file(file, cursor)
+			yield cursor, key
+	except Exception:
+		delete_file(key)
+		raise
+
+# Delete the specified file and its derivatives if no expense refers to it any more
+# this should be called after the reference to it is removed from the expense and committed
 def delete_file(file_name):
+	deleted = False
 	if file_name:
-		file_path = RECEIPT_IMAGE_ROOT + file_name
-		if os.path.exists(file_path):
-			os.remove(file_path)
-			send_track_event(EVENT_FILE_DELETED)
-			return True
-	return False
+		try:
+			with sql_transaction() as cursor:
+				lock_receipt(cursor, file_name)
+				execute_instrumented(cursor, qry.RECEIPT_IMAGE_REFERENCES, (file_name,))
+				if cursor.fetchone()[0] == 0:
+					store = getReceiptStore()
+					store.delete(file_name)
+					for kind in DERIVATIVE_SIZES:
+						store.delete(derivative_name(file_name, kind))
+					deleted = True
+		except psycopg2.Error as exception:
+			logger.warning("failed to delete file %s: %s", file_name, exception)
+	if deleted:
+		send_track_event(EVENT_FILE_DELETED)
+	return deleted
+
+# Return URL of the original image or its derivative
+# pages should fall back to the original until the derivative is created
+def get_receipt_url(file_name, kind=None):
+	if kind is not None:
+		file_name = derivative_name(file_name, kind)
+	return getReceiptStore().url(file_name)
@@ -0,0 +1,46 @@
+import os
+
+# gunicorn settings; gunicorn reads this file from the working directory
+# the number of workers is given by WEB_CONCURRENCY
+
+# gevent serves each request in a greenlet, so that idle event streams of /events don't hold a worker each;
+# with GUNICORN_WORKER_CLASS=sync or gthread requests are served in processes or threads, and pages are served
+# without live updates since /events answers 204 instead of holding a worker or thread for EVENTS_MAX_AGE
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+	# patch the standard library before the app, requests and redis import ssl, socket and threading;
+	# the gevent worker patches it only after the app is loaded with GUNICORN_PRELOAD=1 and after post_fork
+	from gevent import monkey
+	monkey.patch_all()
+
+# GUNICORN_PRELOAD=1 imports the app once in the master before workers are forked,
+# so that a new worker starts without importing the app and shares the memory of the loaded code
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+# max number of concurrent requests, including open event streams, of each gevent worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+# Clients created in the master before the fork would share sockets, threads and processes with the workers;
+# drop them in each worker so that they're created again on first use
+def post_fork(server, worker):
+	if worker_class == 'gevent':
+		# let psycopg2 wait for the server in the event loop instead of blocking every greenlet of the worker
+		from psycogreen.gevent import patch_psycopg
+		patch_psycopg()
+	from db_operations import reset_db_pool
+	from redis_operations import reset_redis_client
+	from track_events import reset_track_event_shipper
+	from image_operations import reset_image_executor
+	from file_operations import reset_receipt_store
+	from events_operations import reset_event_broker
+	reset_db_pool()
+	reset_redis_client()
+	reset_track_event_shipper()
+	reset_image_executor()
+	reset_receipt_store()
+	reset_event_broker()
+
+# share messages in Redis once the worker has loaded the app
+def post_worker_init(worker):
+	from utilities import publish_messages
+	publish_messages()
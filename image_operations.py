@@ -0,0 +1,65 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# derivatives of receipt images
+DERIVATIVE_DISPLAY = 'display' # bounded size image shown in the detail page
+DERIVATIVE_THUMBNAIL = 'thumbnail' # small image shown in list pages
+DERIVATIVE_SIZES = {
+	DERIVATIVE_DISPLAY: int(os.environ.get('RECEIPT_DISPLAY_SIZE', '1280')),
+	DERIVATIVE_THUMBNAIL: int(os.environ.get('RECEIPT_THUMBNAIL_SIZE', '160')),
+}
+# JPEG or WEBP
+DERIVATIVE_FORMAT = os.environ.get('RECEIPT_DERIVATIVE_FORMAT', 'JPEG').upper()
+DERIVATIVE_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+DERIVATIVE_QUALITY = int(os.environ.get('RECEIPT_DERIVATIVE_QUALITY', '80'))
+
+# number of processes to create derivatives in each worker
+IMAGE_PROCESSES = int(os.environ.get('IMAGE_PROCESSES', '1'))
+IMAGE_EXECUTOR = None
+
+def derivative_name(file_name, kind):
+	return os.path.splitext(file_name)[0] + '_' + kind + DERIVATIVE_EXTENSIONS[DERIVATIVE_FORMAT]
+
+# Create derivatives of the image next to it and return their paths; this runs in a process of the pool
+# orientation is normalised with the EXIF tag, and derivatives are saved without EXIF
+def create_derivatives(path):
+	paths = {}
+	with Image.open(path) as original:
+		image = ImageOps.exif_transpose(original)
+		if image.mode not in ('RGB', 'L'):
+			image = image.convert('RGB')
+		for kind, size in DERIVATIVE_SIZES.items():
+			derivative = image.copy()
+			derivative.thumbnail((size, size))
+			paths[kind] = derivative_name(path, kind)
+			derivative.save(paths[kind], DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY, optimize=True)
+	return paths
+
+def getImageExecutor():
+	global IMAGE_EXECUTOR
+	if IMAGE_EXECUTOR is None:
+		# processes are started from a clean server process instead of forking the worker,
+		# whose threads, sockets and gevent hub would be copied into them half-initialised
+		IMAGE_EXECUTOR = ProcessPoolExecutor(max_workers=IMAGE_PROCESSES, mp_context=multiprocessing.get_context('forkserver'))
+	return IMAGE_EXECUTOR
+
+# drop the executor inherited from the parent process; its worker processes belong to the parent
+def reset_image_executor():
+	global IMAGE_EXECUTOR
+	IMAGE_EXECUTOR = None
+
+def _report_failure(future):
+	exception = future.exception()
+	if exception is not None:
+		logger.warning("failed to process image: %s", exception)
+
+# run a function processing images off the request thread
+def submit_image_job(function, *args):
+	future = getImageExecutor().submit(function, *args)
+	future.add_done_callback(_report_failure)
+	return future
@@ -0,0 +1,96 @@
+import os
+import re
+import csv
+import random
+from datetime import date
+
+from locust import HttpUser, task, between, events
+
+# Load test of the expense workflow against employees generated by 'flask seed --credentials'
+# locust -f loadtest/locustfile.py --host http://localhost:5000 --headless -u 50 -r 5 -t 5m
+
+CREDENTIALS_PATH = os.environ.get('LOADTEST_CREDENTIALS', 'loadtest/users.csv')
+ID_PATTERN = re.compile(r'name="id" value="(\d+)"')
+LAST_PAGE = 2 ** 31 - 1
+
+with open(CREDENTIALS_PATH, newline='') as credentials_file:
+	CREDENTIALS = list(csv.DictReader(credentials_file))
+USERS = [row for row in CREDENTIALS if row['role'] == 'ROLE_USER']
+APPROVERS = [row for row in CREDENTIALS if row['role'] == 'ROLE_APPROVER']
+
+def find_ids(response):
+	return ID_PATTERN.findall(response.text)
+
+class EmployeeUser(HttpUser):
+	abstract = True
+	wait_time = between(1, 3)
+	credentials = []
+
+	def on_start(self):
+		account = random.choice(self.credentials)
+		self.client.post('/authenticate', data={'email': account['email'], 'password': account['password']})
+
+# an employee recording expenses and submitting them in a report
+class ExpenseUser(EmployeeUser):
+	weight = 4
+	credentials = USERS
+
+	@task(4)
+	def home(self):
+		self.client.get('/user_home')
+
+	@task(6)
+	def list_and_view_expense(self):
+		ids = find_ids(self.client.get('/expense_list_html'))
+		if ids:
+			self.client.post('/expense_detail_html', data={'id': random.choice(ids)})
+
+	@task(3)
+	def create_expense(self):
+		self.client.post('/create_expense', data={
+			'name': 'Load test',
+			'date': date.today().isoformat(),
+			'amount': str(random.randint(100, 20000)),
+			'currency': 'CURRENCY_YEN',
+			'description': '',
+		})
+
+	@task(2)
+	def list_reports(self):
+		self.client.get('/report_list_html')
+
+	# create a report, attach unassigned expenses to it and submit it
+	@task(1)
+	def submit_report(self):
+		self.client.post('/create_report', data={'name': 'Load test'})
+		report_ids = find_ids(self.client.get(f"/report_list_html?before={LAST_PAGE}", name='/report_list_html?before'))
+		if not report_ids:
+			return
+		report_id = report_ids[-1]
+		expense_ids = find_ids(self.client.get('/expense_list_html'))
+		self.client.post('/update_report', data={'id': report_id, 'name': 'Load test', 'id_added': expense_ids[:5]})
+		self.client.post('/submit_report', data={'id': report_id})
+
+# an approver approving reports submitted in the company
+class Approver(EmployeeUser):
+	weight = 1
+	credentials = APPROVERS
+
+	@task(3)
+	def list_reports(self):
+		self.client.get('/approve_list_html')
+
+	# approve several reports at once as approvers do at month-end
+	@task(1)
+	def approve_report(self):
+		report_ids = find_ids(self.client.get('/approve_list_html'))
+		if report_ids:
+			self.client.post('/approve_report', data={'id': random.sample(report_ids, min(len(report_ids), 10))})
+
+# print throughput and percentiles per route when the test ends
+@events.quitting.add_listener
+def report_percentiles(environment, **kwargs):
+	print(f"{'route':<40}{'requests':>10}{'failures':>10}{'req/s':>8}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}")
+	for entry in sorted(environment.stats.entries.values(), key=lambda entry: entry.name):
+		print(f"{entry.method + ' ' + entry.name:<40}{entry.num_requests:>10}{entry.num_failures:>10}{entry.total_rps:>8.1f}"\
+			f"{entry.get_response_time_percentile(0.5):>8.0f}{entry.get_response_time_percentile(0.95):>8.0f}{entry.get_response_time_percentile(0.99):>8.0f}")
@@ -0,0 +1,47 @@
+import constants as cns
+
+# Formats of amounts, full names and default currency of a language
+# formatters are built once per language, so formatting a row needs no session or Redis lookup
+class Locale:
+	def __init__(self, language, messages):
+		self.language = language
+		self.messages = messages
+		if language == 'ja-JP':
+			# in case Japanese is used, amount comes first and last name comes first
+			self.amount_pattern = '{{:,}} {}'
+			self.last_name_first = True
+			self.default_currency = cns.CURRENCY_YEN
+		else:
+			self.amount_pattern = '{} {{:,.2f}}'
+			self.last_name_first = False
+			self.default_currency = cns.CURRENCY_DOLLAR
+		self.formatters = {currency: self.build_formatter(currency) for currency in cns.CURRENCIES}
+
+	# the symbol of the currency is its message, or the code itself if it has no message
+	def build_formatter(self, currency):
+		return self.amount_pattern.format(self.messages.get(currency, currency)).format
+
+	# currencies which aren't in CURRENCIES, e.g. of rows written before a currency was removed, are formatted as they come
+	def format_amount(self, amount, currency):
+		formatter = self.formatters.get(currency)
+		if formatter is None:
+			formatter = self.build_formatter(str(currency))
+		return formatter(amount)
+
+	# format amounts of rows with 'amount' and 'currency' at once for list pages
+	# formatters of currencies not in CURRENCIES are built once per call, as format_amount builds them
+	def format_amounts(self, rows):
+		formatters = dict(self.formatters)
+		amounts = []
+		for row in rows:
+			currency = row['currency']
+			formatter = formatters.get(currency)
+			if formatter is None:
+				formatter = formatters[currency] = self.build_formatter(str(currency))
+			amounts.append(formatter(row['amount']))
+		return amounts
+
+	def fullname(self, first_name, last_name):
+		if self.last_name_first:
+			return last_name + ' ' + first_name
+		return first_name + ' ' + last_name
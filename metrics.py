@@ -0,0 +1,94 @@
+import bisect
+import threading
+
+# Minimal in-process metrics exposed in the Prometheus text format
+# values are kept per worker process
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000)
+
+METRICS = []
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+	pairs = list(zip(names, values)) + list(extra)
+	if not pairs:
+		return ''
+	return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+	metric_type = 'untyped'
+
+	def __init__(self, name, help_text, label_names=()):
+		self.name = name
+		self.help_text = help_text
+		self.label_names = tuple(label_names)
+		self.values = {}
+		self.lock = threading.Lock()
+		METRICS.append(self)
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+		with self.lock:
+			items = list(self.values.items())
+		for labels, value in items:
+			lines.extend(self._samples(labels, value))
+		return lines
+
+	def _samples(self, labels, value):
+		return [self.name + _format_labels(self.label_names, labels) + ' ' + _format_value(value)]
+
+class Counter(Metric):
+	metric_type = 'counter'
+
+	def inc(self, labels=(), amount=1):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+	metric_type = 'gauge'
+
+	def set(self, value, labels=()):
+		with self.lock:
+			self.values[labels] = value
+
+class Histogram(Metric):
+	metric_type = 'histogram'
+
+	def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, help_text, label_names)
+		self.buckets = tuple(buckets) + (float('inf'),)
+
+	def observe(self, value, labels=()):
+		with self.lock:
+			state = self.values.get(labels)
+			if state is None:
+				state = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+			state[0][bisect.bisect_left(self.buckets, value)] += 1
+			state[1] += value
+			state[2] += 1
+
+	def _samples(self, labels, state):
+		bucket_counts, total, count = state
+		samples = []
+		cumulative = 0
+		for bound, bucket_count in zip(self.buckets, bucket_counts):
+			cumulative += bucket_count
+			samples.append(self.name + '_bucket' + _format_labels(self.label_names, labels, [('le', _format_value(bound))]) + ' ' + str(cumulative))
+		samples.append(self.name + '_sum' + _format_labels(self.label_names, labels) + ' ' + _format_value(float(total)))
+		samples.append(self.name + '_count' + _format_labels(self.label_names, labels) + ' ' + str(count))
+		return samples
+
+# return all metrics in the Prometheus text format
+def render_metrics():
+	lines = []
+	for metric in METRICS:
+		lines.extend(metric.render())
+	return '\n'.join(lines) + '\n'
@@ -0,0 +1,40 @@
+-- Tables of the app as shown in data_diagram.jpg
+-- "if not exists" lets databases created before migrations adopt this version as their baseline
+
+create table if not exists company (
+	id serial primary key,
+	name text,
+	trial boolean default false,
+	plan text
+);
+
+create table if not exists employee (
+	id serial primary key,
+	first_name text,
+	last_name text,
+	email text,
+	password text,
+	role text,
+	company_id integer references company(id)
+);
+
+create table if not exists report (
+	id serial primary key,
+	name text,
+	submit_date date,
+	approve_date date,
+	user_id integer references employee(id),
+	status text
+);
+
+create table if not exists expense (
+	id serial primary key,
+	name text,
+	date date,
+	amount numeric,
+	currency text,
+	description text,
+	report_id integer references report(id),
+	user_id integer references employee(id),
+	receipt_image text
+);
@@ -0,0 +1,26 @@
+-- Indexes for the statements in queries.py
+-- list queries page by id, so the id is the last column of the indexes they use
+
+-- expense_list: unassigned expenses of the user; also report_expenses_open
+create index if not exists expense_unassigned_user_id_idx on expense (user_id, id) where report_id is null;
+
+-- dashboard_counts: expenses of the user joined to their reports
+create index if not exists expense_user_id_report_id_idx on expense (user_id, report_id);
+
+-- report_expenses_included, detach_report_expenses and the foreign key from expense to report
+create index if not exists expense_report_id_idx on expense (report_id);
+
+-- receipt_image_references: expenses sharing a stored receipt
+create index if not exists expense_receipt_image_idx on expense (receipt_image) where receipt_image is not null;
+
+-- report_list: reports of the user
+create index if not exists report_user_id_idx on report (user_id, id);
+
+-- approve_list: reports in a status, joined to the employees of the company
+create index if not exists report_status_user_id_idx on report (status, user_id, id);
+
+-- employee_list and the join of approve_list: employees of the company
+create index if not exists employee_company_id_idx on employee (company_id, id);
+
+-- authenticate
+create index if not exists employee_email_password_idx on employee (email, password);
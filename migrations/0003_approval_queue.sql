@@ -0,0 +1,21 @@
+-- Reports submitted or approved in each company, read by approve_list instead of joining report to employee
+-- rows are added by submit_report, updated by approve_report and update_report, and removed by reject_report; delete_report removes them by the cascade
+
+create table if not exists approval_queue (
+	report_id integer primary key references report(id) on delete cascade,
+	company_id integer not null references company(id),
+	name text,
+	status text not null
+);
+
+-- approve_list: reports of the company in the order of their ids
+create index if not exists approval_queue_company_id_idx on approval_queue (company_id, report_id);
+
+-- approve_list_by_status and approval_counts: reports of the company in a status
+create index if not exists approval_queue_company_id_status_idx on approval_queue (company_id, status, report_id);
+
+insert into approval_queue (report_id, company_id, name, status)
+	select report.id, employee.company_id, report.name, report.status
+	from report join employee on report.user_id = employee.id
+	where report.status in ('STATUS_SUBMITTED', 'STATUS_APRROVED')
+	on conflict (report_id) do nothing;
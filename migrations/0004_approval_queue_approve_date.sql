@@ -0,0 +1,11 @@
+-- Approve date of reports in approval_queue, so that the export of approved reports reads the reports of a company in a period from its index
+-- set by approve_report; it's null while the report is waiting for approval
+
+alter table approval_queue add column if not exists approve_date date;
+
+-- export_approved_expenses: reports of the company approved in a period
+create index if not exists approval_queue_company_id_approve_date_idx on approval_queue (company_id, status, approve_date, report_id);
+
+update approval_queue set approve_date = report.approve_date
+	from report
+	where approval_queue.report_id = report.id and approval_queue.approve_date is distinct from report.approve_date;
@@ -0,0 +1,141 @@
+-- Spend of each company and employee by currency, month and status of the report of expenses, read by the analytics page instead of scanning expense
+-- expenses which aren't in any report are counted as STATUS_OPEN, and expenses without a date or a currency aren't counted
+-- rows are kept up to date by the triggers below, which add the changes of each statement; flask --app expense_report_demo rebuild-rollups recomputes them
+
+create table if not exists expense_rollup_employee (
+	company_id integer not null references company(id) on delete cascade,
+	employee_id integer not null references employee(id) on delete cascade,
+	currency text not null,
+	month date not null,
+	status text not null,
+	amount numeric not null default 0,
+	expense_count integer not null default 0,
+	primary key (company_id, month, employee_id, currency, status)
+);
+
+create table if not exists expense_rollup_company (
+	company_id integer not null references company(id) on delete cascade,
+	currency text not null,
+	month date not null,
+	status text not null,
+	amount numeric not null default 0,
+	expense_count integer not null default 0,
+	primary key (company_id, month, currency, status)
+);
+
+-- a change of the amount and the number of expenses; changes of a statement are added to both tables in one statement
+do $$
+begin
+	if not exists (select 1 from pg_type where typname = 'expense_rollup_delta' and typnamespace = current_schema()::regnamespace) then
+		create type expense_rollup_delta as (company_id integer, employee_id integer, currency text, month date, status text, amount numeric, expense_count integer);
+	end if;
+end
+$$;
+
+create or replace function apply_expense_rollup(deltas expense_rollup_delta[]) returns void language sql as $$
+	with delta as (
+		select company_id, employee_id, currency, month, status, sum(amount) as amount, sum(expense_count) as expense_count
+		from unnest(deltas)
+		group by company_id, employee_id, currency, month, status
+		-- e.g. an expense whose receipt image is changed is removed and added again
+		having sum(amount) <> 0 or sum(expense_count) <> 0),
+	employee_rollup as (
+		insert into expense_rollup_employee as rollup (company_id, employee_id, currency, month, status, amount, expense_count)
+		select company_id, employee_id, currency, month, status, amount, expense_count from delta
+		on conflict (company_id, month, employee_id, currency, status) do update
+		set amount = rollup.amount + excluded.amount, expense_count = rollup.expense_count + excluded.expense_count)
+	insert into expense_rollup_company as rollup (company_id, currency, month, status, amount, expense_count)
+	select company_id, currency, month, status, sum(amount), sum(expense_count) from delta
+	group by company_id, currency, month, status
+	on conflict (company_id, month, currency, status) do update
+	set amount = rollup.amount + excluded.amount, expense_count = rollup.expense_count + excluded.expense_count;
+$$;
+
+-- expenses added are counted, and expenses removed are subtracted, with the current status of their reports
+create or replace function expense_rollup_changed() returns trigger language plpgsql as $$
+begin
+	if TG_OP in ('INSERT', 'UPDATE') then
+		perform apply_expense_rollup(array(
+			select row(employee.company_id, new_rows.user_id, new_rows.currency, date_trunc('month', new_rows.date)::date,
+				coalesce(report.status, 'STATUS_OPEN'), coalesce(new_rows.amount, 0), 1)::expense_rollup_delta
+			from new_rows
+			join employee on new_rows.user_id = employee.id
+			left join report on new_rows.report_id = report.id
+			where new_rows.date is not null and new_rows.currency is not null));
+	end if;
+	if TG_OP in ('UPDATE', 'DELETE') then
+		perform apply_expense_rollup(array(
+			select row(employee.company_id, old_rows.user_id, old_rows.currency, date_trunc('month', old_rows.date)::date,
+				coalesce(report.status, 'STATUS_OPEN'), -coalesce(old_rows.amount, 0), -1)::expense_rollup_delta
+			from old_rows
+			join employee on old_rows.user_id = employee.id
+			left join report on old_rows.report_id = report.id
+			where old_rows.date is not null and old_rows.currency is not null));
+	end if;
+	return null;
+end
+$$;
+
+-- expenses of reports whose status is changed are moved from the old status to the new one
+-- a statement which changes the status of a report and moves expenses in or out of it at once would count them twice; no statement of the app does
+create or replace function report_rollup_changed() returns trigger language plpgsql as $$
+begin
+	perform apply_expense_rollup(array(
+		select row(employee.company_id, expense.user_id, expense.currency, date_trunc('month', expense.date)::date, status.status,
+			status.sign * coalesce(expense.amount, 0), status.sign)::expense_rollup_delta
+		from new_rows
+		join old_rows on old_rows.id = new_rows.id
+		join expense on expense.report_id = new_rows.id
+		join employee on expense.user_id = employee.id
+		cross join lateral (values (old_rows.status, -1), (new_rows.status, 1)) as status(status, sign)
+		where old_rows.status is distinct from new_rows.status
+			and expense.date is not null and expense.currency is not null));
+	return null;
+end
+$$;
+
+-- transition tables can be given to a trigger of a single event
+drop trigger if exists expense_rollup_insert on expense;
+create trigger expense_rollup_insert after insert on expense
+	referencing new table as new_rows
+	for each statement execute function expense_rollup_changed();
+
+drop trigger if exists expense_rollup_update on expense;
+create trigger expense_rollup_update after update on expense
+	referencing old table as old_rows new table as new_rows
+	for each statement execute function expense_rollup_changed();
+
+drop trigger if exists expense_rollup_delete on expense;
+create trigger expense_rollup_delete after delete on expense
+	referencing old table as old_rows
+	for each statement execute function expense_rollup_changed();
+
+drop trigger if exists report_rollup_update on report;
+create trigger report_rollup_update after update on report
+	referencing old table as old_rows new table as new_rows
+	for each statement execute function report_rollup_changed();
+
+-- Recompute the rollups of the company, or of all companies if it's null, from expense
+-- the caller locks expense and report so that changes made while the rollups are recomputed aren't lost
+create or replace function rebuild_expense_rollups(target_company_id integer default null) returns void language sql as $$
+	delete from expense_rollup_employee where target_company_id is null or company_id = target_company_id;
+	delete from expense_rollup_company where target_company_id is null or company_id = target_company_id;
+	insert into expense_rollup_employee (company_id, employee_id, currency, month, status, amount, expense_count)
+	select employee.company_id, expense.user_id, expense.currency, date_trunc('month', expense.date)::date,
+		coalesce(report.status, 'STATUS_OPEN'), sum(coalesce(expense.amount, 0)), count(*)
+	from expense
+	join employee on expense.user_id = employee.id
+	left join report on expense.report_id = report.id
+	where (target_company_id is null or employee.company_id = target_company_id)
+		and expense.date is not null and expense.currency is not null
+	group by 1, 2, 3, 4, 5;
+	insert into expense_rollup_company (company_id, currency, month, status, amount, expense_count)
+	select company_id, currency, month, status, sum(amount), sum(expense_count)
+	from expense_rollup_employee
+	where target_company_id is null or company_id = target_company_id
+	group by company_id, currency, month, status;
+$$;
+
+-- count expenses which exist before the triggers
+lock table expense, report in share mode;
+select rebuild_expense_rollups();
@@ -0,0 +1,4 @@
+-- approve_list pages the reports of each status on approval_queue_company_id_status_idx, so the index of reports of the company in the order of their ids isn't read any more
+-- dropped so that writes to approval_queue don't maintain it
+
+drop index if exists approval_queue_company_id_idx;
@@ -0,0 +1,320 @@
+import os
+import sys
+import time
+import random
+import logging
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import redis
+
+from metrics import Counter, Histogram
+
+# functions of threads and sleep of the interpreter, which gevent workers replace with ones of greenlets
+try:
+	from gevent.monkey import get_original
+	start_native_thread, allocate_native_lock, get_native_ident = get_original('_thread', ['start_new_thread', 'allocate_lock', 'get_ident'])
+	native_sleep = get_original('time', 'sleep')
+except ImportError:
+	from _thread import start_new_thread as start_native_thread, allocate_lock as allocate_native_lock, get_ident as get_native_ident
+	from time import sleep as native_sleep
+
+try:
+	import greenlet
+	from gevent.monkey import is_module_patched
+except ImportError:
+	greenlet = None
+
+logger = logging.getLogger(__name__)
+
+# profiling settings
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '1') == '1' # on by default; see benchmark-profiling for its overhead
+PROFILE_BREAKDOWN_RATE = float(os.environ.get('PROFILE_BREAKDOWN_RATE', '0.1')) # fraction of requests whose CPU time and components are measured, 0 to 1
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0')) # fraction of requests to profile, 0 to 1
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'stack') # stack: sampled call stacks in the folded format, cprofile: pstats files
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '5')) / 1000 # milliseconds between stack samples
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# components of a request
+COMPONENT_DB = 'db'
+COMPONENT_REDIS = 'redis'
+COMPONENT_TEMPLATE = 'template'
+COMPONENT_HTTP = 'http'
+COMPONENTS = (COMPONENT_DB, COMPONENT_REDIS, COMPONENT_TEMPLATE, COMPONENT_HTTP)
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Wall time of requests including streamed bodies', ['route', 'method'])
+# CPU time and the breakdown are taken from a sample of requests, as reading CPU time is a system call;
+# divide by http_requests_profiled_total for the average of a request
+REQUEST_PROFILED = Counter('http_requests_profiled_total', 'Requests whose CPU time and components are measured', ['route', 'method'])
+REQUEST_CPU = Counter('http_request_cpu_seconds_total', 'CPU time of the thread or greenlet serving profiled requests', ['route', 'method'])
+REQUEST_COMPONENT = Counter('http_request_component_seconds_total', 'Time of profiled requests spent in DB, Redis, template rendering and outbound HTTP', ['route', 'component'])
+
+# seconds of each component in the current request, or None outside of a profiled request
+REQUEST_TIMES = contextvars.ContextVar('request_times', default=None)
+
+# Accumulate CPU time of greenlets across switches
+# all greenlets of a gevent worker run in one native thread, whose CPU time includes every request served at the same time;
+# the clock is read only on switches from or to a greenlet being measured, as it's a system call
+class GreenletClock:
+	def __init__(self):
+		self.running = greenlet.getcurrent()
+		# [CPU time so far, CPU time of the thread when it was switched in] of each greenlet being measured
+		self.measured = {}
+		self.previous = greenlet.settrace(self._trace)
+
+	def _trace(self, event, args):
+		if event in ('switch', 'throw'):
+			origin, target = args
+			self.running = target
+			if self.measured:
+				origin_times = self.measured.get(origin)
+				target_times = self.measured.get(target)
+				if origin_times is not None or target_times is not None:
+					now = time.thread_time()
+					if origin_times is not None:
+						origin_times[0] += now - origin_times[1]
+					if target_times is not None:
+						target_times[1] = now
+		if self.previous is not None:
+			self.previous(event, args)
+
+	def start(self):
+		self.measured[greenlet.getcurrent()] = [0.0, time.thread_time()]
+
+	# CPU time of the current greenlet since start
+	def stop(self):
+		cpu_time, switched_in = self.measured.pop(greenlet.getcurrent())
+		return cpu_time + time.thread_time() - switched_in
+
+# set by init_profiling in gevent workers
+GREENLET_CLOCK = None
+
+# measure CPU time of the current thread, or of the current greenlet in gevent workers
+def start_cpu_time():
+	if GREENLET_CLOCK is not None:
+		GREENLET_CLOCK.start()
+		return None
+	return time.thread_time()
+
+def stop_cpu_time(started):
+	if GREENLET_CLOCK is not None:
+		return GREENLET_CLOCK.stop()
+	return time.thread_time() - started
+
+# add time spent in the component to the current request
+def add_time(component, seconds):
+	times = REQUEST_TIMES.get()
+	if times is not None:
+		times[component] += seconds
+
+@contextmanager
+def timed(component):
+	started = time.perf_counter()
+	try:
+		yield
+	finally:
+		add_time(component, time.perf_counter() - started)
+
+# Redis client adding the time of each command to the current request
+class TimedRedis(redis.StrictRedis):
+	def execute_command(self, *args, **options):
+		started = time.perf_counter()
+		try:
+			return super().execute_command(*args, **options)
+		finally:
+			add_time(COMPONENT_REDIS, time.perf_counter() - started)
+
+# Call the render function and add its time to the current request as template time
+# DB and Redis time spent while a template is rendered, e.g. by a streamed query, is not counted as template time
+# pages are rendered through this instead of Flask's template signals, whose receivers would cost every render a few microseconds
+def timed_render(render, *args, **kwargs):
+	times = REQUEST_TIMES.get()
+	if times is None:
+		return render(*args, **kwargs)
+	other_time = sum(times.values())
+	started = time.perf_counter()
+	try:
+		return render(*args, **kwargs)
+	finally:
+		elapsed = time.perf_counter() - started - (sum(times.values()) - other_time)
+		times[COMPONENT_TEMPLATE] += max(elapsed, 0.0)
+
+# Yield the chunks of a streamed template, timing the render of each but not the time the server takes to send it
+def timed_stream(chunks):
+	chunks = iter(chunks)
+	try:
+		while True:
+			try:
+				chunk = timed_render(next, chunks)
+			except StopIteration:
+				return
+			yield chunk
+	finally:
+		# the stream pops its request context when it's closed
+		if hasattr(chunks, 'close'):
+			chunks.close()
+
+# Sample the call stack of a thread, or of a greenlet in gevent workers, and count identical stacks
+# the output is in the folded format read by flamegraph.pl and speedscope
+class StackSampler:
+	def __init__(self, thread_id, request_greenlet=None, interval=PROFILE_INTERVAL):
+		self.thread_id = thread_id
+		self.request_greenlet = request_greenlet
+		self.interval = interval
+		self.stacks = {}
+		self.stopping = False
+		# the sampler runs in a native thread even when gevent has patched threading,
+		# as a greenlet would take samples only while the request waits
+		self.finished = allocate_native_lock()
+
+	def start(self):
+		self.finished.acquire()
+		start_native_thread(self._run, ())
+
+	def stop(self):
+		self.stopping = True
+		self.finished.acquire()
+		self.finished.release()
+
+	def _run(self):
+		try:
+			while not self.stopping:
+				native_sleep(self.interval)
+				frame = self._frame()
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+					frame = frame.f_back
+				if stack:
+					key = ';'.join(reversed(stack))
+					self.stacks[key] = self.stacks.get(key, 0) + 1
+		finally:
+			self.finished.release()
+
+	# the frame of the thread is of the greenlet running in it; a greenlet switched out keeps its own frame
+	def _frame(self):
+		if self.request_greenlet is None or GREENLET_CLOCK.running is self.request_greenlet:
+			return sys._current_frames().get(self.thread_id)
+		return self.request_greenlet.gr_frame
+
+	def dump(self, path):
+		with open(path, 'w') as folded_file:
+			for stack, count in self.stacks.items():
+				folded_file.write(f"{stack} {count}\n")
+
+class CProfileSampler:
+	def __init__(self):
+		self.profile = cProfile.Profile()
+
+	def start(self):
+		self.profile.enable()
+
+	def stop(self):
+		self.profile.disable()
+
+	def dump(self, path):
+		self.profile.dump_stats(path)
+
+# WSGI middleware recording wall time of each request by route, and CPU time and the time by component of a sample of requests
+# a request is finished when its body is closed, so that streamed responses are measured as a whole
+class ProfilingMiddleware:
+	def __init__(self, wsgi_app, breakdown_rate=PROFILE_BREAKDOWN_RATE, sample_rate=PROFILE_SAMPLE_RATE, profile_dir=PROFILE_DIR, mode=PROFILE_MODE):
+		self.wsgi_app = wsgi_app
+		# profiled requests are broken down too
+		self.breakdown_rate = max(breakdown_rate, sample_rate)
+		self.sample_rate = sample_rate
+		self.profile_dir = profile_dir
+		self.mode = mode
+
+	def __call__(self, environ, start_response):
+		# requests which aren't sampled record only their route and wall time, and allocate nothing for the breakdown
+		times = None
+		sampler = None
+		if self.breakdown_rate:
+			sampled = random.random()
+			if sampled < self.breakdown_rate:
+				times = dict.fromkeys(COMPONENTS, 0.0)
+				REQUEST_TIMES.set(times)
+			if sampled < self.sample_rate:
+				if self.mode == 'stack':
+					sampler = StackSampler(get_native_ident(), greenlet.getcurrent() if GREENLET_CLOCK is not None else None)
+				else:
+					sampler = CProfileSampler()
+				sampler.start()
+		route = None
+		# the route is read when the response starts, as Flask removes the request from environ before it returns;
+		# this costs less than a before_request hook
+		def profiled_start_response(status, headers, exc_info=None):
+			nonlocal route
+			flask_request = environ.get('werkzeug.request')
+			if flask_request is not None and flask_request.url_rule is not None:
+				route = flask_request.url_rule.rule
+			return start_response(status, headers, exc_info)
+		started = time.perf_counter()
+		cpu_started = start_cpu_time() if times is not None else None
+		try:
+			body = self.wsgi_app(environ, profiled_start_response)
+		except BaseException:
+			self._finish(environ, route, times, sampler, started, cpu_started)
+			raise
+		return ProfiledBody(body, lambda: self._finish(environ, route, times, sampler, started, cpu_started))
+
+	def _finish(self, environ, route, times, sampler, started, cpu_started):
+		duration = time.perf_counter() - started
+		route = route or 'unmatched'
+		method = environ.get('REQUEST_METHOD')
+		labels = (route, method)
+		REQUEST_DURATION.observe(duration, labels)
+		if times is not None:
+			cpu_time = stop_cpu_time(cpu_started)
+			REQUEST_TIMES.set(None)
+			REQUEST_PROFILED.inc(labels)
+			REQUEST_CPU.inc(labels, cpu_time)
+			for component, seconds in times.items():
+				if seconds:
+					REQUEST_COMPONENT.inc((route, component), seconds)
+			if logger.isEnabledFor(logging.DEBUG):
+				logger.debug("%s %s: %.1f ms wall, %.1f ms CPU, %s", method, route, duration * 1000, cpu_time * 1000,
+					', '.join(f"{component} {seconds * 1000:.1f} ms" for component, seconds in times.items()))
+		if sampler is not None:
+			sampler.stop()
+			self._dump(sampler, route)
+
+	def _dump(self, sampler, route):
+		name = route.strip('/').replace('/', '_').replace('<', '').replace('>', '').replace(':', '_') or 'root'
+		extension = '.folded' if isinstance(sampler, StackSampler) else '.prof'
+		try:
+			os.makedirs(self.profile_dir, exist_ok=True)
+			sampler.dump(os.path.join(self.profile_dir, f"{name}.{time.strftime('%Y%m%d%H%M%S')}.{os.getpid()}.{threading.get_ident()}{extension}"))
+		except OSError:
+			logger.exception("failed to write the profile of %s", route)
+
+# response body calling the callback once when the server closes it
+class ProfiledBody:
+	def __init__(self, body, callback):
+		self.body = body
+		self.callback = callback
+
+	def __iter__(self):
+		return iter(self.body)
+
+	def close(self):
+		try:
+			if hasattr(self.body, 'close'):
+				self.body.close()
+		finally:
+			callback, self.callback = self.callback, None
+			if callback is not None:
+				callback()
+
+# Wrap the app with the middleware if PROFILING_ENABLED is 1
+def init_profiling(app):
+	global GREENLET_CLOCK
+	if not PROFILING_ENABLED:
+		return
+	if greenlet is not None and is_module_patched('threading') and GREENLET_CLOCK is None:
+		GREENLET_CLOCK = GreenletClock()
+	app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
@@ -0,0 +1,317 @@
+import re
+
+# Registry of the SQL statements of the app
+# Each statement has a name, by which it's prepared on every pooled connection and executed with EXECUTE,
+# so that it's parsed and planned by the server once per connection instead of once per call.
+# Statements are written with %s placeholders like other SQL given to psycopg2.
+
+QUERIES = {}
+
+# modes of keyset pagination; see sql_select_page()
+PAGE_FIRST = 'first'
+PAGE_AFTER = 'after'
+PAGE_BEFORE = 'before'
+
+PLACEHOLDER = re.compile(r'%[%s]')
+
+class Query:
+	def __init__(self, name, sql):
+		self.name = name
+		self.sql = sql
+		self.pages = {}
+		# %s placeholders are numbered for PREPARE, and the arguments of EXECUTE are given as %s again
+		count = 0
+		def number(match):
+			nonlocal count
+			if match.group() == '%%':
+				return '%'
+			count += 1
+			return '$' + str(count)
+		self.prepare_sql = f"PREPARE {name} AS " + PLACEHOLDER.sub(number, sql)
+		self.param_count = count
+		self.execute_sql = f"EXECUTE {name}" + ('(' + ', '.join(['%s'] * count) + ')' if count else '')
+
+	def __str__(self):
+		return self.sql
+
+	# register variants of the statement for keyset pagination on the key column
+	def paged(self, key_column):
+		self.pages = {mode: query(f"{self.name}_{mode}", page_sql(self.sql, key_column, mode)) for mode in (PAGE_FIRST, PAGE_AFTER, PAGE_BEFORE)}
+		return self
+
+# the statement should end with a where clause; the key and the page size are appended as parameters
+def page_sql(sql_string, key_column, mode):
+	if mode == PAGE_BEFORE:
+		return sql_string + f" and {key_column} < %s order by {key_column} desc limit %s"
+	if mode == PAGE_AFTER:
+		sql_string += f" and {key_column} > %s"
+	return sql_string + f" order by {key_column} limit %s"
+
+def query(name, sql):
+	if name in QUERIES:
+		raise ValueError(f"query {name} is already registered")
+	QUERIES[name] = Query(name, sql)
+	return QUERIES[name]
+
+# login
+AUTHENTICATE = query('authenticate',
+					"select employee.id, email, role, first_name, last_name, company.id as company_id,"\
+					" company.name as company_name, company.plan as company_plan"\
+					" from employee join company"\
+					" on employee.company_id = company.id"\
+					" where email=%s and password=%s")
+
+# number of expenses and reports of the user in each status
+DASHBOARD_COUNTS = query('dashboard_counts',
+					"select report.status, count(distinct expense.id), count(distinct report.id)"\
+					" from expense join report"\
+					" on expense.report_id = report.id"\
+					" where expense.user_id = %s"\
+					" group by report.status")
+
+# expenses
+EXPENSE_LIST = query('expense_list',
+					"select expense.id, name, date, amount, currency, description, receipt_image"\
+					" from expense join employee"\
+					" on expense.user_id = employee.id"\
+					" where expense.user_id = %s"\
+								" and expense.report_id is null").paged('expense.id')
+
+EXPENSE_LIST_ALL = query('expense_list_all', EXPENSE_LIST.sql + " order by expense.id")
+
+EXPENSE_DETAIL = query('expense_detail',
+					"select id, name, date, amount, currency, description, receipt_image"\
+					" from expense"\
+					" where id = %s")
+
+CREATE_EXPENSE = query('create_expense',
+					"insert into expense(name, date, amount, currency, description, receipt_image, user_id)"\
+					" values(%s, %s, %s, %s, %s, %s, %s)")
+
+UPDATE_EXPENSE = query('update_expense',
+					"update expense set"\
+					" name = %s,"\
+					" date = %s,"\
+					" currency = %s,"\
+					" amount = %s,"\
+					" description = %s"\
+					" where id = %s")
+
+DELETE_EXPENSE = query('delete_expense',
+					"delete from expense"\
+					" where id = %s"\
+					" returning receipt_image")
+
+# the previous receipt is returned so that it can be deleted if no other expense refers to it
+UPDATE_RECEIPT_IMAGE = query('update_receipt_image',
+					"with previous as (select id, receipt_image from expense where id = %s for update)"\
+					" update expense set"\
+					" receipt_image = %s"\
+					" from previous where expense.id = previous.id"\
+					" returning previous.receipt_image")
+
+CLEAR_RECEIPT_IMAGE = query('clear_receipt_image',
+					"with previous as (select id, receipt_image from expense where id = %s for update)"\
+					" update expense set"\
+					" receipt_image = null"\
+					" from previous where expense.id = previous.id"\
+					" returning previous.receipt_image")
+
+# number of expenses which refer to the receipt
+RECEIPT_IMAGE_REFERENCES = query('receipt_image_references',
+					"select count(*) from expense"\
+					" where receipt_image = %s")
+
+# reports
+REPORT_LIST = query('report_list',
+					"select report.id, name, submit_date, approve_date, status"\
+					" from report join employee"\
+					" on report.user_id = employee.id"\
+					" where report.user_id = %s").paged('report.id')
+
+REPORT_DETAIL = query('report_detail',
+					"select id, name"\
+					" from report"\
+					" where id = %s")
+
+# expenses which haven't been assigned to any report
+REPORT_EXPENSES_OPEN = query('report_expenses_open',
+					"select expense.id, name, date, amount, currency, description"\
+					" from expense"\
+					" join employee on expense.user_id = employee.id"\
+					" where expense.user_id = %s and expense.report_id is null")
+
+# expenses which have already been assigned to the report
+REPORT_EXPENSES_INCLUDED = query('report_expenses_included',
+					"select expense.id, expense.name, date, amount, currency, description"\
+					" from expense"\
+					" join employee on expense.user_id = employee.id"\
+					" join report on expense.report_id = report.id"\
+					" where expense.user_id = %s"\
+								" and expense.report_id = %s"\
+								" and report.status = %s")
+
+CREATE_REPORT = query('create_report',
+					"insert into report(name, user_id, status)"\
+					" values(%s, %s, %s)")
+
+# rename the report, and add and remove expenses in a single statement
+# ids are given as arrays so that the statement is the same regardless of the number of expenses
+UPDATE_REPORT = query('update_report',
+					"with renamed as ("\
+								" update report set"\
+								" name = %s"\
+								" where id = %s and user_id = %s"\
+								" returning id, name),"\
+							" queued as ("\
+								" update approval_queue set"\
+								" name = renamed.name"\
+								" from renamed"\
+								" where approval_queue.report_id = renamed.id),"\
+							" added as ("\
+								" update expense set"\
+								" report_id = renamed.id"\
+								" from renamed"\
+								" where expense.id = any(%s) and expense.user_id = %s and expense.report_id is null"\
+								" returning expense.id),"\
+							" removed as ("\
+								" update expense set"\
+								" report_id = null"\
+								" from renamed"\
+								" where expense.id = any(%s) and expense.report_id = renamed.id"\
+								" returning expense.id)"\
+							" select (select count(*) from added) as added, (select count(*) from removed) as removed")
+
+DETACH_REPORT_EXPENSES = query('detach_report_expenses',
+					"update expense set"\
+					" report_id = null"\
+					" where expense.report_id = %s")
+
+# the report is removed from approval_queue by the cascade
+DELETE_REPORT = query('delete_report',
+					"delete from report"\
+					" where id = %s")
+
+# the report is queued for approvers of its company in the same statement
+SUBMIT_REPORT = query('submit_report',
+					"with submitted as ("\
+								" update report set"\
+								" submit_date = %s,"\
+								" status = %s"\
+								" where report.id = %s"\
+								" returning report.id, report.name, report.user_id, report.status)"\
+							" insert into approval_queue (report_id, company_id, name, status)"\
+							" select submitted.id, employee.company_id, submitted.name, submitted.status"\
+							" from submitted join employee"\
+							" on submitted.user_id = employee.id"\
+							" on conflict (report_id) do update set name = excluded.name, status = excluded.status"\
+							" returning report_id, name")
+
+# reports of the company in a status, to approve or approved, read from approval_queue which holds only reports in these statuses
+# each status is paged on its own, so that a page of approved reports doesn't push reports to approve out of the list
+APPROVE_LIST = query('approve_list',
+					"select report_id, name, status"\
+					" from approval_queue"\
+					" where company_id = %s and status = %s").paged('report_id')
+
+APPROVE_LIST_BY_STATUS = query('approve_list_by_status',
+					"select report_id, name, status"\
+					" from approval_queue"\
+					" where company_id = %s and status = %s"\
+					" order by report_id")
+
+# number of reports of the company in each status, for the badge of the navigator
+APPROVAL_COUNTS = query('approval_counts',
+					"select status, count(*)"\
+					" from approval_queue"\
+					" where company_id = %s"\
+					" group by status")
+
+# approve or reject the reports in a single statement; only reports submitted in the company of the approver are changed
+# ids are given as an array so that the statement is the same regardless of the number of reports
+APPROVE_REPORT = query('approve_report',
+					"with approved as ("\
+								" update report set"\
+								" approve_date = %s,"\
+								" status = %s"\
+								" from approval_queue"\
+								" where report.id = any(%s) and approval_queue.report_id = report.id"\
+								" and approval_queue.company_id = %s and approval_queue.status = %s"\
+								" returning report.id, report.name, report.user_id, report.status, report.approve_date),"\
+							" queued as ("\
+								" update approval_queue set"\
+								" status = approved.status,"\
+								" approve_date = approved.approve_date"\
+								" from approved"\
+								" where approval_queue.report_id = approved.id)"\
+							" select id as report_id, name, user_id from approved")
+
+REJECT_REPORT = query('reject_report',
+					"with rejected as ("\
+								" update report set"\
+								" submit_date = null,"\
+								" status = %s"\
+								" from approval_queue"\
+								" where report.id = any(%s) and approval_queue.report_id = report.id"\
+								" and approval_queue.company_id = %s and approval_queue.status = %s"\
+								" returning report.id, report.name, report.user_id),"\
+							" dequeued as ("\
+								" delete from approval_queue"\
+								" using rejected"\
+								" where approval_queue.report_id = rejected.id)"\
+							" select id as report_id, name, user_id from rejected")
+
+# expenses of the reports approved in the company between the dates, for the export of finance; reports are read from approval_queue by their approve date
+EXPORT_APPROVED_EXPENSES = query('export_approved_expenses',
+					"select report.id as report_id, report.name as report_name, report.submit_date, report.approve_date,"\
+					" employee.id as employee_id, employee.first_name, employee.last_name, employee.email,"\
+					" expense.id as expense_id, expense.name as expense_name, expense.date, expense.amount, expense.currency, expense.description"\
+					" from approval_queue"\
+					" join report on approval_queue.report_id = report.id"\
+					" join employee on report.user_id = employee.id"\
+					" join expense on expense.report_id = report.id"\
+					" where approval_queue.company_id = %s and approval_queue.status = %s"\
+								" and approval_queue.approve_date between %s and %s"\
+					" order by report.id, expense.id")
+
+# spend of the company by month, currency and status since the month, read from the rollup maintained by triggers on expense and report
+ROLLUP_COMPANY_MONTHS = query('rollup_company_months',
+					"select month, currency, status, amount, expense_count"\
+					" from expense_rollup_company"\
+					" where company_id = %s and month >= %s and expense_count > 0"\
+					" order by month desc, currency, status")
+
+# spend of each employee of the company in the month by currency and status
+ROLLUP_EMPLOYEE_MONTH = query('rollup_employee_month',
+					"select employee.id as employee_id, first_name, last_name, currency, status, amount, expense_count"\
+					" from expense_rollup_employee join employee"\
+					" on expense_rollup_employee.employee_id = employee.id"\
+					" where expense_rollup_employee.company_id = %s and month = %s and expense_count > 0"\
+					" order by employee.id, currency, status")
+
+# employees
+EMPLOYEE_LIST = query('employee_list',
+					"select id, email, first_name, last_name, role"\
+					" from employee"\
+					" where company_id = %s").paged('id')
+
+EMPLOYEE_DETAIL = query('employee_detail',
+					"select id, first_name, last_name, email, password, role"\
+					" from employee"\
+					" where id = %s")
+
+CREATE_EMPLOYEE = query('create_employee',
+					"insert into employee(first_name, last_name, email, password, role, company_id)"\
+					" values(%s, %s, %s, %s, %s, %s)")
+
+UPDATE_EMPLOYEE = query('update_employee',
+					"update employee set"\
+					" first_name = %s,"\
+					" last_name = %s,"\
+					" email = %s,"\
+					" role = %s"\
+					" where id = %s")
+
+DELETE_EMPLOYEE = query('delete_employee',
+					"delete from employee"\
+					" where id = %s")
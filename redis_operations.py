@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import redis
+
+from profiling import TimedRedis, timed, COMPONENT_REDIS
+
+logger = logging.getLogger(__name__)
+
+# Redis settings
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_SSL = os.environ.get('REDIS_SSL', '1') == '1'
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '20')) # per worker
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '1')) # seconds to wait for a free connection
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '1')) # seconds for each command
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '1'))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', '30')) # idle seconds before a connection is checked
+# circuit breaker settings
+REDIS_BREAKER_THRESHOLD = int(os.environ.get('REDIS_BREAKER_THRESHOLD', '3')) # consecutive failures to open the circuit
+REDIS_BREAKER_COOLDOWN = float(os.environ.get('REDIS_BREAKER_COOLDOWN', '15')) # seconds before Redis is tried again
+
+REDIS_CLIENT = None
+REDIS_BREAKER = None
+
+# return the client of this worker; connections are shared by its threads through a bounded pool
+def getRedisClient():
+	global REDIS_CLIENT
+	if REDIS_CLIENT is None:
+		url = urlparse(REDIS_URL)
+		options = {}
+		if REDIS_SSL:
+			# SSL接続を有効にし、証明書検証を無効化する
+			options = {'connection_class': redis.SSLConnection, 'ssl_cert_reqs': None}
+		pool = redis.BlockingConnectionPool(
+			host=url.hostname,
+			port=url.port or 6379,
+			password=url.password,
+			max_connections=REDIS_MAX_CONNECTIONS,
+			timeout=REDIS_POOL_TIMEOUT,
+			socket_timeout=REDIS_SOCKET_TIMEOUT,
+			socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+			health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+			**options
+		)
+		REDIS_CLIENT = TimedRedis(connection_pool=pool)
+	return REDIS_CLIENT
+
+# drop the client inherited from the parent process, so that connections are made by this process
+def reset_redis_client():
+	global REDIS_CLIENT, REDIS_BREAKER
+	REDIS_CLIENT = None
+	REDIS_BREAKER = None
+
+# Circuit breaker around Redis
+# after threshold consecutive failures Redis isn't called for cooldown seconds, and callers use local data instead;
+# then one call is let through, and the circuit closes if it succeeds
+class CircuitBreaker:
+	def __init__(self, threshold=REDIS_BREAKER_THRESHOLD, cooldown=REDIS_BREAKER_COOLDOWN):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.opened_at = None
+		self.lock = threading.Lock()
+
+	def allow(self):
+		with self.lock:
+			if self.opened_at is None:
+				return True
+			if time.monotonic() - self.opened_at >= self.cooldown:
+				# half open; let this call try and keep the others out until it finishes
+				self.opened_at = time.monotonic()
+				return True
+			return False
+
+	def success(self):
+		with self.lock:
+			if self.opened_at is not None:
+				logger.warning("Redis circuit closed")
+			self.failures = 0
+			self.opened_at = None
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.failures >= self.threshold:
+				if self.opened_at is None:
+					logger.warning("Redis circuit opened after %d failures", self.failures)
+				self.opened_at = time.monotonic()
+
+	def is_open(self):
+		return self.opened_at is not None
+
+def getRedisBreaker():
+	global REDIS_BREAKER
+	if REDIS_BREAKER is None:
+		REDIS_BREAKER = CircuitBreaker()
+	return REDIS_BREAKER
+
+# Call the method of the client by name through the circuit breaker; return default if Redis fails or the circuit is open
+def redis_call(name, *args, default=None, **kwargs):
+	breaker = getRedisBreaker()
+	if not breaker.allow():
+		return default
+	try:
+		result = getattr(getRedisClient(), name)(*args, **kwargs)
+	except redis.RedisError as exception:
+		breaker.failure()
+		logger.warning("Redis %s failed: %s", name, exception)
+		return default
+	breaker.success()
+	return result
+
+# return values of the keys in one round trip; a list of None if Redis is unavailable
+def redis_mget(keys):
+	if not keys:
+		return []
+	return redis_call('mget', keys, default=[None] * len(keys))
+
+# Queue commands with queue(pipeline) and send them in one round trip; return their results, or None if Redis is unavailable
+def redis_pipeline(queue):
+	breaker = getRedisBreaker()
+	if not breaker.allow():
+		return None
+	try:
+		with timed(COMPONENT_REDIS), getRedisClient().pipeline(transaction=False) as pipeline:
+			queue(pipeline)
+			results = pipeline.execute()
+	except redis.RedisError as exception:
+		breaker.failure()
+		logger.warning("Redis pipeline failed: %s", exception)
+		return None
+	breaker.success()
+	return results
+
+# Bounded in-process LRU cache with expiry, used as local data while Redis is unavailable
+class LocalCache:
+	def __init__(self, size):
+		self.size = size
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			item = self.items.get(key)
+			if item is None:
+				return None
+			value, expires_at = item
+			if expires_at is not None and expires_at < time.monotonic():
+				del self.items[key]
+				return None
+			self.items.move_to_end(key)
+			return value
+
+	def set(self, key, value, ex=None):
+		with self.lock:
+			self.items[key] = (value, time.monotonic() + ex if ex else None)
+			self.items.move_to_end(key)
+			while len(self.items) > self.size:
+				self.items.popitem(last=False)
+
+	def delete(self, *keys):
+		with self.lock:
+			for key in keys:
+				self.items.pop(key, None)
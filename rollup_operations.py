@@ -0,0 +1,39 @@
+from datetime import date
+
+import constants as cns
+from db_operations import sql_transaction
+
+# statuses of the columns of the analytics page; expenses which aren't in any report are counted as STATUS_OPEN
+ROLLUP_STATUSES = [cns.STATUS_OPEN, cns.STATUS_SUBMITTED, cns.STATUS_APRROVED]
+
+# Recompute the rollups of the company, or of all companies, from expense; e.g. to backfill them or to repair them after writes with triggers disabled
+# writers of expenses and reports wait until this commits, so that no change is lost or counted twice
+# return the number of rows of the rollup by employee
+def rebuild_rollups(company_id=None):
+	with sql_transaction() as cursor:
+		cursor.execute("lock table expense, report in share mode")
+		cursor.execute("select rebuild_expense_rollups(%s)", (company_id,))
+		if company_id is None:
+			cursor.execute("select count(*) from expense_rollup_employee")
+		else:
+			cursor.execute("select count(*) from expense_rollup_employee where company_id = %s", (company_id,))
+		return cursor.fetchone()[0]
+
+# the first day of the month months - 1 before the month of the day, e.g. the start of the last 12 months
+def first_month(day, months):
+	index = day.year * 12 + day.month - months
+	return date(index // 12, index % 12 + 1, 1)
+
+# Pivot rows of rollups into a row for each key with the amount of each status and the total
+# rows should be ordered by the key columns
+def pivot_rollups(rows, key_columns):
+	pivoted = []
+	for row in rows or []:
+		key = [row[column] for column in key_columns]
+		if not pivoted or pivoted[-1]['key'] != key:
+			pivoted.append({'key': key, 'amounts': {status: 0 for status in ROLLUP_STATUSES}, 'total': 0, 'expense_count': 0})
+			pivoted[-1].update(zip(key_columns, key))
+		pivoted[-1]['amounts'][row['status']] = pivoted[-1]['amounts'].get(row['status'], 0) + row['amount']
+		pivoted[-1]['total'] += row['amount']
+		pivoted[-1]['expense_count'] += row['expense_count']
+	return pivoted
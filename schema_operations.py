@@ -0,0 +1,174 @@
+import os
+import json
+import logging
+from datetime import date
+
+import psycopg2
+
+import constants as cns
+from queries import QUERIES, PAGE_FIRST, PAGE_AFTER, PAGE_BEFORE
+from db_operations import getDBPool, DATABASE_URL, DATABASE_SCHEMA, DATABASE_SSLMODE
+
+logger = logging.getLogger(__name__)
+
+# root path for migration files; NNNN_description.sql applied in the order of their names
+MIGRATION_ROOT = 'migrations/'
+# key of the advisory lock held while migrating, so that only one process migrates at a time
+MIGRATION_LOCK_KEY = 7301
+
+def list_migrations(root=MIGRATION_ROOT):
+	return [(file_name[:-len('.sql')], os.path.join(root, file_name)) for file_name in sorted(os.listdir(root)) if file_name.endswith('.sql')]
+
+# Apply migrations which haven't been applied yet, each in its own transaction
+# return versions applied, or versions to be applied if dry_run is True
+# a connection outside of the pool is used, since pooled connections prepare statements for tables which may not exist yet
+def migrate(dry_run=False):
+	connection = psycopg2.connect(DATABASE_URL, sslmode=DATABASE_SSLMODE)
+	try:
+		with connection.cursor() as cursor:
+			cursor.execute(f"create schema if not exists {DATABASE_SCHEMA}")
+			cursor.execute(f"set search_path to {DATABASE_SCHEMA}")
+			cursor.execute("create table if not exists schema_migrations(version text primary key, applied_at timestamptz not null default now())")
+			connection.commit()
+			cursor.execute("select pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+			try:
+				cursor.execute("select version from schema_migrations")
+				applied = {row[0] for row in cursor.fetchall()}
+				pending = [(version, path) for version, path in list_migrations() if version not in applied]
+				if dry_run:
+					return [version for version, path in pending]
+				for version, path in pending:
+					with open(path) as migration_file:
+						cursor.execute(migration_file.read())
+					cursor.execute("insert into schema_migrations(version) values(%s)", (version,))
+					connection.commit()
+					logger.info("applied migration %s", version)
+				return [version for version, path in pending]
+			finally:
+				connection.rollback()
+				cursor.execute("select pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+				connection.commit()
+	finally:
+		connection.close()
+
+# parameters to replay each statement of the registry, from a sample of rows in the database
+# paged statements are replayed for each page with the key and the page size appended
+EXPLAIN_PARAMS = {
+	'authenticate': lambda s: (s['email'], s['password']),
+	'dashboard_counts': lambda s: (s['employee_id'],),
+	'expense_list': lambda s: (s['employee_id'],),
+	'expense_list_all': lambda s: (s['employee_id'],),
+	'expense_detail': lambda s: (s['expense_id'],),
+	'create_expense': lambda s: ('explain', s['today'], 1, cns.CURRENCY_YEN, '', None, s['employee_id']),
+	'update_expense': lambda s: ('explain', s['today'], cns.CURRENCY_YEN, 1, '', s['expense_id']),
+	'delete_expense': lambda s: (s['expense_id'],),
+	'update_receipt_image': lambda s: (s['expense_id'], s['receipt_image']),
+	'clear_receipt_image': lambda s: (s['expense_id'],),
+	'receipt_image_references': lambda s: (s['receipt_image'],),
+	'report_list': lambda s: (s['employee_id'],),
+	'report_detail': lambda s: (s['report_id'],),
+	'report_expenses_open': lambda s: (s['employee_id'],),
+	'report_expenses_included': lambda s: (s['employee_id'], s['report_id'], cns.STATUS_OPEN),
+	'create_report': lambda s: ('explain', s['employee_id'], cns.STATUS_OPEN),
+	'update_report': lambda s: ('explain', s['report_id'], s['employee_id'], [s['expense_id']], s['employee_id'], [s['expense_id']]),
+	'detach_report_expenses': lambda s: (s['report_id'],),
+	'delete_report': lambda s: (s['report_id'],),
+	'submit_report': lambda s: (s['today'], cns.STATUS_SUBMITTED, s['report_id']),
+	'approve_list': lambda s: (s['company_id'], cns.STATUS_SUBMITTED),
+	'approve_list_by_status': lambda s: (s['company_id'], cns.STATUS_SUBMITTED),
+	'approval_counts': lambda s: (s['company_id'],),
+	'approve_report': lambda s: (s['today'], cns.STATUS_APRROVED, [s['report_id']], s['company_id'], cns.STATUS_SUBMITTED),
+	'reject_report': lambda s: (cns.STATUS_OPEN, [s['report_id']], s['company_id'], cns.STATUS_SUBMITTED),
+	'export_approved_expenses': lambda s: (s['company_id'], cns.STATUS_APRROVED, s['today'], s['today']),
+	'rollup_company_months': lambda s: (s['company_id'], s['month']),
+	'rollup_employee_month': lambda s: (s['company_id'], s['month']),
+	'employee_list': lambda s: (s['company_id'],),
+	'employee_detail': lambda s: (s['employee_id'],),
+	'create_employee': lambda s: ('explain', 'explain', 'explain@example.com', 'explain', cns.ROLE_USER, s['company_id']),
+	'update_employee': lambda s: ('explain', 'explain', 'explain@example.com', cns.ROLE_USER, s['employee_id']),
+	'delete_employee': lambda s: (s['employee_id'],),
+}
+
+# ids of the employee with the most expenses unless specified, and of one of their reports and expenses
+def get_explain_sample(cursor, employee_id=None):
+	if employee_id is None:
+		cursor.execute("select user_id from expense group by user_id order by count(*) desc limit 1")
+		row = cursor.fetchone()
+		employee_id = row[0] if row else None
+	cursor.execute("select id, company_id, email, password from employee where id = %s", (employee_id,))
+	row = cursor.fetchone()
+	if row is None:
+		raise ValueError('no employee to replay queries with; seed the database first')
+	sample = {'employee_id': row[0], 'company_id': row[1], 'email': row[2], 'password': row[3], 'today': date.today().isoformat(), 'month': date.today().replace(day=1).isoformat()}
+	cursor.execute("select max(id) from report where user_id = %s", (employee_id,))
+	sample['report_id'] = cursor.fetchone()[0] or 0
+	cursor.execute("select max(id) from expense where user_id = %s", (employee_id,))
+	sample['expense_id'] = cursor.fetchone()[0] or 0
+	cursor.execute("select max(receipt_image) from expense")
+	sample['receipt_image'] = cursor.fetchone()[0] or 'explain.jpg'
+	return sample
+
+def explain_json(cursor, sql_string, params):
+	cursor.execute(sql_string, params)
+	output = cursor.fetchone()[0]
+	return (output if isinstance(output, list) else json.loads(output))[0]
+
+# return nodes of the plan scanning whole tables
+def find_seq_scans(plan):
+	scans = []
+	if plan.get('Node Type') == 'Seq Scan':
+		scans.append(plan)
+	for child in plan.get('Plans', []):
+		scans.extend(find_seq_scans(child))
+	return scans
+
+# statements of the registry with their parameters, paged statements expanded to their pages
+def get_explain_targets(sample, page_size):
+	targets = []
+	for query in QUERIES.values():
+		if query.name not in EXPLAIN_PARAMS:
+			continue
+		params = EXPLAIN_PARAMS[query.name](sample)
+		targets.append((query, params))
+		if query.pages:
+			targets.append((query.pages[PAGE_FIRST], params + (page_size + 1,)))
+			targets.append((query.pages[PAGE_AFTER], params + (0, page_size + 1)))
+			targets.append((query.pages[PAGE_BEFORE], params + (2 ** 31 - 1, page_size + 1)))
+	return targets
+
+# Replay statements of the registry under EXPLAIN (ANALYZE, BUFFERS) and report sequential scans
+# each statement runs in a savepoint which is rolled back, so that writes leave no trace
+# a statement which fails with the sample, e.g. on a foreign key, is reported with its estimated plan
+# with disable_seqscan, a sequential scan remains only where no index can serve the statement, which is useful on small databases
+def explain_queries(employee_id=None, page_size=50, disable_seqscan=False):
+	pool = getDBPool()
+	connection = pool.getconn()
+	results = []
+	try:
+		with connection.cursor() as cursor:
+			sample = get_explain_sample(cursor, employee_id)
+			if disable_seqscan:
+				cursor.execute("set local enable_seqscan = off")
+			for query, params in get_explain_targets(sample, page_size):
+				result = {'query': query.name, 'analyzed': True, 'error': None}
+				cursor.execute("savepoint explain_query")
+				try:
+					output = explain_json(cursor, "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.sql, params)
+				except psycopg2.Error as e:
+					cursor.execute("rollback to savepoint explain_query")
+					result.update({'analyzed': False, 'error': str(e).strip().splitlines()[0]})
+					output = explain_json(cursor, "EXPLAIN (FORMAT JSON) " + query.sql, params)
+				cursor.execute("rollback to savepoint explain_query")
+				plan = output['Plan']
+				result.update({
+					'planning_ms': output.get('Planning Time'),
+					'execution_ms': output.get('Execution Time'),
+					'shared_hit': plan.get('Shared Hit Blocks', 0),
+					'shared_read': plan.get('Shared Read Blocks', 0),
+					'seq_scans': [(scan['Relation Name'], scan.get('Filter'), scan.get('Actual Rows', scan.get('Plan Rows'))) for scan in find_seq_scans(plan)],
+				})
+				results.append(result)
+		return results
+	finally:
+		connection.rollback()
+		pool.putconn(connection)
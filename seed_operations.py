@@ -0,0 +1,114 @@
+import io
+import csv
+import math
+import random
+from datetime import date, timedelta
+
+import constants as cns
+from db_operations import sql_transaction
+
+# share of employees in each role, and of reports in each status
+SEED_ROLE_WEIGHTS = {cns.ROLE_ADMIN: 0.05, cns.ROLE_APPROVER: 0.15, cns.ROLE_USER: 0.8}
+SEED_STATUS_WEIGHTS = {cns.STATUS_OPEN: 0.3, cns.STATUS_SUBMITTED: 0.2, cns.STATUS_APRROVED: 0.5}
+SEED_CURRENCY_WEIGHTS = {cns.CURRENCY_YEN: 0.8, cns.CURRENCY_DOLLAR: 0.2}
+# share of expenses assigned to a report
+SEED_ATTACHED_RATIO = 0.7
+# days back from today over which expenses are dated
+SEED_DAYS = 365
+
+# File-like object giving rows to COPY as CSV without keeping them in memory
+class CopyRows:
+	def __init__(self, rows):
+		self.rows = iter(rows)
+		self.buffer = io.StringIO()
+		self.writer = csv.writer(self.buffer, lineterminator='\n')
+		self.pending = ''
+
+	def read(self, size=-1):
+		while size < 0 or len(self.pending) < size:
+			row = next(self.rows, None)
+			if row is None:
+				break
+			self.buffer.seek(0)
+			self.buffer.truncate()
+			self.writer.writerow(row)
+			self.pending += self.buffer.getvalue()
+		if size < 0:
+			size = len(self.pending)
+		data, self.pending = self.pending[:size], self.pending[size:]
+		return data
+
+# heavy-tailed counts with the given mean, so that a few companies and employees hold most of the rows
+def skewed_count(generator, mean, minimum=1):
+	return max(minimum, int(generator.paretovariate(1.5) * mean / 3))
+
+def weighted_choice(generator, weights):
+	return generator.choices(list(weights), weights=list(weights.values()))[0]
+
+def next_id(cursor, table):
+	cursor.execute(f"select coalesce(max(id), 0) + 1 from {table}")
+	return cursor.fetchone()[0]
+
+# Generate companies with employees, reports and expenses, and load them with COPY in a single transaction
+# employees per company and expenses per employee follow a heavy-tailed distribution around the given means
+# each employee can log in with email employee<ID>@company<COMPANY ID>.example.com and the password
+# return counts of rows and (email, password, role) of the employees
+def seed_database(companies, employees_per_company, expenses_per_employee, password='password', seed=None):
+	generator = random.Random(seed)
+	today = date.today()
+	credentials = []
+	counts = {'company': 0, 'employee': 0, 'report': 0, 'expense': 0}
+	with sql_transaction() as cursor:
+		# ids are assigned here so that rows can refer to each other; other writers wait until this commits
+		cursor.execute("lock table company, employee, report, expense, approval_queue, expense_rollup_employee, expense_rollup_company in exclusive mode")
+		company_id = next_id(cursor, 'company')
+		employee_id = next_id(cursor, 'employee')
+		report_id = next_id(cursor, 'report')
+		first_report_id = report_id
+		companies_rows = []
+		employees_rows = []
+		reports_rows = []
+		expense_plans = []
+		for _ in range(companies):
+			companies_rows.append((company_id, f"Company {company_id}", generator.random() < 0.1, generator.choice(cns.ACCOUNT_PLAN)))
+			for _ in range(skewed_count(generator, employees_per_company)):
+				role = weighted_choice(generator, SEED_ROLE_WEIGHTS)
+				email = f"employee{employee_id}@company{company_id}.example.com"
+				employees_rows.append((employee_id, f"First{employee_id}", f"Last{employee_id}", email, password, role, company_id))
+				credentials.append((email, password, role))
+				expense_count = skewed_count(generator, expenses_per_employee, minimum=0)
+				report_ids = []
+				for _ in range(max(1, expense_count // 8)):
+					status = weighted_choice(generator, SEED_STATUS_WEIGHTS)
+					submit_date = today - timedelta(days=generator.randrange(30)) if status != cns.STATUS_OPEN else None
+					approve_date = submit_date + timedelta(days=generator.randrange(7)) if status == cns.STATUS_APRROVED else None
+					reports_rows.append((report_id, f"Report {report_id}", submit_date, approve_date, employee_id, status))
+					report_ids.append(report_id)
+					report_id += 1
+				expense_plans.append((employee_id, expense_count, report_ids))
+				employee_id += 1
+			company_id += 1
+
+		def expenses():
+			for user_id, expense_count, report_ids in expense_plans:
+				for number in range(expense_count):
+					currency = weighted_choice(generator, SEED_CURRENCY_WEIGHTS)
+					amount = round(math.exp(generator.gauss(8, 1.2)) if currency == cns.CURRENCY_YEN else math.exp(generator.gauss(3.5, 1.2)), 2)
+					attached = generator.choice(report_ids) if generator.random() < SEED_ATTACHED_RATIO else None
+					counts['expense'] += 1
+					yield (f"Expense {number + 1}", today - timedelta(days=generator.randrange(SEED_DAYS)), amount, currency, '', attached, user_id)
+
+		cursor.copy_expert("copy company(id, name, trial, plan) from stdin with (format csv)", CopyRows(companies_rows))
+		cursor.copy_expert("copy employee(id, first_name, last_name, email, password, role, company_id) from stdin with (format csv)", CopyRows(employees_rows))
+		cursor.copy_expert("copy report(id, name, submit_date, approve_date, user_id, status) from stdin with (format csv)", CopyRows(reports_rows))
+		# reports submitted or approved are queued for approvers of their company
+		cursor.execute("insert into approval_queue (report_id, company_id, name, status, approve_date)"\
+			" select report.id, employee.company_id, report.name, report.status, report.approve_date from report join employee on report.user_id = employee.id"\
+			" where report.id >= %s and report.status in (%s, %s)", (first_report_id, cns.STATUS_SUBMITTED, cns.STATUS_APRROVED))
+		cursor.copy_expert("copy expense(name, date, amount, currency, description, report_id, user_id) from stdin with (format csv, force_not_null (description))", CopyRows(expenses()))
+		# serial sequences continue after the ids given above
+		for table in ('company', 'employee', 'report'):
+			cursor.execute(f"select setval(pg_get_serial_sequence('{table}', 'id'), (select max(id) from {table}))")
+		cursor.execute("analyze company, employee, report, expense, approval_queue, expense_rollup_employee, expense_rollup_company")
+	counts.update({'company': len(companies_rows), 'employee': len(employees_rows), 'report': len(reports_rows)})
+	return counts, credentials
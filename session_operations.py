@@ -0,0 +1,117 @@
+import os
+import time
+import secrets
+import msgpack
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import constants as cns
+from redis_operations import redis_call, LocalCache
+
+# session store settings
+SESSION_STORE = os.environ.get('SESSION_STORE', 'redis') # redis, or cookie for Flask's signed cookie session
+SESSION_LOCAL_SIZE = int(os.environ.get('SESSION_LOCAL_SIZE', '1000')) # sessions kept in the worker while Redis is unavailable
+# key in the session for the time the cookie was last sent
+SESSION_COOKIE_ISSUED = '_issued'
+# keys which a new session can hold without being stored; the language is resolved from Accept-Language on each request
+SESSION_TRANSIENT_KEYS = {cns.REDIS_LANGUAGE, SESSION_COOKIE_ISSUED}
+# returned by redis_call when Redis is unavailable, as None means the session doesn't exist
+UNAVAILABLE = object()
+
+# Session data kept in Redis; only the id of the session is sent in the cookie
+class RedisSession(CallbackDict, SessionMixin):
+	def __init__(self, initial=None, sid=None, new=False):
+		def on_update(session):
+			session.modified = True
+		super().__init__(initial, on_update)
+		self.sid = sid
+		self.new = new
+		self.modified = False
+		self.replaced_sid = None
+
+	# move the data to a new id, which is sent in the cookie, and delete the old one when the session is saved
+	def regenerate(self):
+		if not self.new and self.replaced_sid is None:
+			self.replaced_sid = self.sid
+		self.sid = secrets.token_urlsafe(32)
+		self.modified = True
+
+def session_key(sid):
+	return cns.REDIS_SESSION + '/' + sid
+
+# Server-side session interface storing msgpack encoded sessions in Redis
+# The TTL of the session slides on each request without writing the data; GETEX reads it and extends the TTL in one round trip.
+# The data is written only when it's changed, and the cookie is sent only when the session is created or changed,
+# or when half of its lifetime has passed, so that the browser keeps it as long as Redis does.
+# Sessions recently read or written by this worker are kept locally, and used while Redis is unavailable
+# so that users stay logged in; changes made meanwhile stay in this worker.
+class RedisSessionInterface(SessionInterface):
+	def __init__(self, local_size=SESSION_LOCAL_SIZE):
+		self.local = LocalCache(local_size)
+
+	def get_ttl(self, app):
+		return int(app.permanent_session_lifetime.total_seconds())
+
+	# static files are served without a session, so that each stylesheet, image and receipt thumbnail of a page
+	# costs no round trip to Redis; the URL isn't matched yet when the session is opened, so the path is checked
+	def is_static(self, app, request):
+		return app.has_static_folder and request.path.startswith(app.static_url_path + '/')
+
+	def open_session(self, app, request):
+		if self.is_static(app, request):
+			return self.make_null_session(app)
+		sid = request.cookies.get(self.get_cookie_name(app))
+		if sid:
+			key = session_key(sid)
+			ttl = self.get_ttl(app)
+			data = redis_call('getex', key, ex=ttl, default=UNAVAILABLE)
+			if data is UNAVAILABLE:
+				data = self.local.get(key)
+			elif data is not None:
+				self.local.set(key, data, ex=ttl)
+			if data is not None:
+				return RedisSession(msgpack.unpackb(data, raw=False), sid=sid)
+		return RedisSession(sid=secrets.token_urlsafe(32), new=True)
+
+	def save_session(self, app, session, response):
+		name = self.get_cookie_name(app)
+		response.vary.add('Cookie')
+		domain = self.get_cookie_domain(app)
+		path = self.get_cookie_path(app)
+		if session.replaced_sid is not None:
+			self.local.delete(session_key(session.replaced_sid))
+			redis_call('delete', session_key(session.replaced_sid))
+		if not session:
+			# the session is emptied, e.g. by logout
+			if session.modified and not session.new:
+				self.local.delete(session_key(session.sid))
+				redis_call('delete', session_key(session.sid))
+				response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+					httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
+			return
+		ttl = self.get_ttl(app)
+		now = int(time.time())
+		if now - session.get(SESSION_COOKIE_ISSUED, 0) > ttl // 2:
+			session[SESSION_COOKIE_ISSUED] = now
+		if not session.modified:
+			return
+		if session.new and not session.keys() - SESSION_TRANSIENT_KEYS:
+			# e.g. anonymous pages, health checks and scrapes of metrics, which would otherwise create a session on each request
+			return
+		key = session_key(session.sid)
+		data = msgpack.packb(dict(session), use_bin_type=True)
+		self.local.set(key, data, ex=ttl)
+		redis_call('set', key, data, ex=ttl)
+		response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), domain=domain, path=path,
+			secure=self.get_cookie_secure(app), httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
+
+# Give the session a new id when the user logs in, so that an id given to the browser before can't be used to take over the session
+# cookie sessions hold the data in the cookie itself, which is replaced when the session is changed
+def regenerate_session(session):
+	if isinstance(session, RedisSession):
+		session.regenerate()
+
+# use the Redis session interface unless SESSION_STORE is cookie
+def init_sessions(app):
+	if SESSION_STORE == 'redis':
+		app.session_interface = RedisSessionInterface()
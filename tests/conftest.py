@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+# tests run against the database of TEST_DATABASE_URL, in a schema of their own which is created by the migrations and dropped afterwards
+# e.g. TEST_DATABASE_URL=postgresql://postgres@localhost/postgres DATABASE_SSLMODE=disable python -m pytest tests
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+TEST_DATABASE_SCHEMA = os.environ.get('TEST_DATABASE_SCHEMA', 'expense_test')
+
+# settings are read when the modules of the app are imported
+if TEST_DATABASE_URL:
+	os.environ.update(DATABASE_URL=TEST_DATABASE_URL, DATABASE_SCHEMA=TEST_DATABASE_SCHEMA, SESSION_STORE='cookie', PROFILING_ENABLED='0')
+	os.environ.setdefault('FLASK_SECRET_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def pytest_collection_modifyitems(config, items):
+	if TEST_DATABASE_URL:
+		return
+	skip = pytest.mark.skip(reason='TEST_DATABASE_URL is not set')
+	for item in items:
+		item.add_marker(skip)
+
+@pytest.fixture(scope='session')
+def app():
+	import psycopg2
+	from schema_operations import migrate
+	from expense_report_demo import create_app
+	migrate()
+	app = create_app()
+	yield app
+	from db_operations import getDBPool
+	getDBPool().closeall()
+	connection = psycopg2.connect(TEST_DATABASE_URL, sslmode=os.environ.get('DATABASE_SSLMODE', 'require'))
+	try:
+		with connection.cursor() as cursor:
+			cursor.execute(f"drop schema if exists {TEST_DATABASE_SCHEMA} cascade")
+		connection.commit()
+	finally:
+		connection.close()
+
+# cursor of a connection in autocommit, to set up rows and read them back; all rows are removed after each test
+@pytest.fixture
+def cursor(app):
+	import psycopg2
+	from psycopg2.extras import DictCursor
+	connection = psycopg2.connect(TEST_DATABASE_URL, sslmode=os.environ.get('DATABASE_SSLMODE', 'require'))
+	connection.autocommit = True
+	cursor = connection.cursor(cursor_factory=DictCursor)
+	cursor.execute(f"set search_path to {TEST_DATABASE_SCHEMA}")
+	try:
+		yield cursor
+	finally:
+		cursor.execute("select tablename from pg_tables where schemaname = %s and tablename <> 'schema_migrations'", (TEST_DATABASE_SCHEMA,))
+		tables = ', '.join(row[0] for row in cursor.fetchall())
+		cursor.execute(f"truncate {tables} restart identity cascade")
+		connection.close()
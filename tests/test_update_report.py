@@ -0,0 +1,125 @@
+from datetime import date
+
+import pytest
+
+import constants as cns
+
+# rows of a company with the employee owning the report and another employee
+@pytest.fixture
+def rows(cursor):
+	cursor.execute("insert into company (name, plan) values ('Company', 'Advanced') returning id")
+	company_id = cursor.fetchone()[0]
+	employees = []
+	for email in ('owner@example.com', 'other@example.com'):
+		cursor.execute("insert into employee (first_name, last_name, email, password, role, company_id) values ('First', 'Last', %s, 'password', %s, %s) returning id",
+									(email, cns.ROLE_USER, company_id))
+		employees.append(cursor.fetchone()[0])
+	owner_id, other_id = employees
+	rows = {'company_id': company_id, 'owner_id': owner_id, 'other_id': other_id}
+	rows['report_id'] = add_report(cursor, 'report', owner_id)
+	rows['other_report_id'] = add_report(cursor, 'other report', owner_id)
+	rows['foreign_report_id'] = add_report(cursor, 'foreign report', other_id)
+	rows['attached'] = [add_expense(cursor, owner_id, rows['report_id']) for _ in range(2)]
+	rows['unattached'] = [add_expense(cursor, owner_id) for _ in range(2)]
+	rows['in_other_report'] = add_expense(cursor, owner_id, rows['other_report_id'])
+	rows['foreign'] = add_expense(cursor, other_id)
+	return rows
+
+def add_report(cursor, name, user_id):
+	cursor.execute("insert into report (name, user_id, status) values (%s, %s, %s) returning id", (name, user_id, cns.STATUS_OPEN))
+	return cursor.fetchone()[0]
+
+def add_expense(cursor, user_id, report_id=None):
+	cursor.execute("insert into expense (name, date, amount, currency, description, report_id, user_id) values ('expense', %s, 10, %s, '', %s, %s) returning id",
+								(date.today(), cns.CURRENCIES[0], report_id, user_id))
+	return cursor.fetchone()[0]
+
+def report_of(cursor, expense_id):
+	cursor.execute("select report_id from expense where id = %s", (expense_id,))
+	return cursor.fetchone()[0]
+
+def name_of(cursor, report_id):
+	cursor.execute("select name from report where id = %s", (report_id,))
+	return cursor.fetchone()[0]
+
+def expense_reports(cursor):
+	cursor.execute("select id, report_id from expense order by id")
+	return [tuple(row) for row in cursor.fetchall()]
+
+# run UPDATE_REPORT as update_report does and return (added, removed)
+def update_report(app, name, report_id, user_id, id_added, id_removed):
+	import queries as qry
+	from db_operations import sql_execute
+	with app.app_context():
+		results = sql_execute(qry.UPDATE_REPORT, (name, report_id, user_id, id_added, user_id, id_removed))
+	return tuple(results[0])
+
+def test_rename_only(app, cursor, rows):
+	before = expense_reports(cursor)
+	assert update_report(app, 'renamed', rows['report_id'], rows['owner_id'], [], []) == (0, 0)
+	assert name_of(cursor, rows['report_id']) == 'renamed'
+	assert expense_reports(cursor) == before
+
+def test_rename_updates_approval_queue(app, cursor, rows):
+	cursor.execute("insert into approval_queue (report_id, company_id, name, status) values (%s, %s, 'report', %s)",
+								(rows['report_id'], rows['company_id'], cns.STATUS_SUBMITTED))
+	update_report(app, 'renamed', rows['report_id'], rows['owner_id'], [], [])
+	cursor.execute("select name from approval_queue where report_id = %s", (rows['report_id'],))
+	assert cursor.fetchone()[0] == 'renamed'
+
+def test_add_only(app, cursor, rows):
+	assert update_report(app, 'report', rows['report_id'], rows['owner_id'], rows['unattached'], []) == (2, 0)
+	assert [report_of(cursor, expense_id) for expense_id in rows['unattached'] + rows['attached']] == [rows['report_id']] * 4
+
+def test_remove_only(app, cursor, rows):
+	assert update_report(app, 'report', rows['report_id'], rows['owner_id'], [], rows['attached']) == (0, 2)
+	assert [report_of(cursor, expense_id) for expense_id in rows['attached']] == [None, None]
+	assert [report_of(cursor, expense_id) for expense_id in rows['unattached']] == [None, None]
+
+def test_add_and_remove(app, cursor, rows):
+	assert update_report(app, 'report', rows['report_id'], rows['owner_id'], rows['unattached'][:1], rows['attached'][:1]) == (1, 1)
+	assert report_of(cursor, rows['unattached'][0]) == rows['report_id']
+	assert report_of(cursor, rows['attached'][0]) is None
+
+def test_expenses_of_others_are_not_touched(app, cursor, rows):
+	before = expense_reports(cursor)
+	# an expense of another employee, and one in another report of the owner, can't be added
+	# and an expense which isn't in the report can't be removed from it
+	assert update_report(app, 'report', rows['report_id'], rows['owner_id'],
+											[rows['foreign'], rows['in_other_report']], [rows['foreign'], rows['in_other_report'], rows['unattached'][0]]) == (0, 0)
+	assert expense_reports(cursor) == before
+
+def test_empty_arrays(app, cursor, rows):
+	before = expense_reports(cursor)
+	assert update_report(app, 'report', rows['report_id'], rows['owner_id'], [], []) == (0, 0)
+	assert expense_reports(cursor) == before
+
+@pytest.mark.parametrize('report_key', ['foreign_report_id', None])
+def test_report_of_another_employee_or_missing(app, cursor, rows, report_key):
+	report_id = rows[report_key] if report_key else 2 ** 31 - 1
+	before = expense_reports(cursor)
+	assert update_report(app, 'renamed', report_id, rows['owner_id'], rows['unattached'] + [rows['foreign']], rows['attached']) == (0, 0)
+	assert expense_reports(cursor) == before
+	assert name_of(cursor, rows['foreign_report_id']) == 'foreign report'
+
+# the route, which leaves an expense given to both add and remove as it is
+def post_update_report(app, rows, data):
+	client = app.test_client()
+	with client.session_transaction() as session:
+		session[cns.SESSION_EMAIL] = 'owner@example.com'
+		session[cns.SESSION_EMPLOYEE_ID] = rows['owner_id']
+	return client.post('/update_report', data=data)
+
+def test_route_renames_and_updates_expenses(app, cursor, rows):
+	response = post_update_report(app, rows, {'id': rows['report_id'], 'name': 'renamed', 'id_added': rows['unattached'], 'id_removed': rows['attached']})
+	assert response.status_code == 307
+	assert name_of(cursor, rows['report_id']) == 'renamed'
+	assert [report_of(cursor, expense_id) for expense_id in rows['unattached']] == [rows['report_id']] * 2
+	assert [report_of(cursor, expense_id) for expense_id in rows['attached']] == [None, None]
+
+def test_route_leaves_id_in_both_lists_unchanged(app, cursor, rows):
+	before = expense_reports(cursor)
+	both = [rows['attached'][0], rows['unattached'][0]]
+	response = post_update_report(app, rows, {'id': rows['report_id'], 'name': 'report', 'id_added': both, 'id_removed': both})
+	assert response.status_code == 307
+	assert expense_reports(cursor) == before
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+import requests
+
+# Pendo API to receive track events; it can be pointed to a local stub
+PENDO_TRACK_EVENT_URL = os.environ.get('PENDO_TRACK_EVENT_URL', 'https://app.pendo.io/data/track')
+
+# shipper settings
+TRACK_EVENT_QUEUE_SIZE = int(os.environ.get('TRACK_EVENT_QUEUE_SIZE', '1000'))
+TRACK_EVENT_BATCH_SIZE = int(os.environ.get('TRACK_EVENT_BATCH_SIZE', '20'))
+TRACK_EVENT_BATCH_INTERVAL = float(os.environ.get('TRACK_EVENT_BATCH_INTERVAL', '2')) # seconds to wait for a batch to fill
+TRACK_EVENT_TIMEOUT = float(os.environ.get('TRACK_EVENT_TIMEOUT', '5')) # seconds for each HTTP request
+TRACK_EVENT_MAX_RETRIES = int(os.environ.get('TRACK_EVENT_MAX_RETRIES', '3'))
+TRACK_EVENT_BACKOFF = float(os.environ.get('TRACK_EVENT_BACKOFF', '0.5')) # seconds, doubled on each retry
+TRACK_EVENT_SPILL_PATH = os.environ.get('TRACK_EVENT_SPILL_PATH') # JSON Lines file for events which can't be queued or sent
+
+# Ship track events to Pendo from a background thread
+# Events are queued by request handlers and sent in batches over a keep-alive session
+class TrackEventShipper:
+	def __init__(self, url, secret_key, queue_size=TRACK_EVENT_QUEUE_SIZE, batch_size=TRACK_EVENT_BATCH_SIZE,
+			batch_interval=TRACK_EVENT_BATCH_INTERVAL, timeout=TRACK_EVENT_TIMEOUT, max_retries=TRACK_EVENT_MAX_RETRIES,
+			backoff=TRACK_EVENT_BACKOFF, spill_path=TRACK_EVENT_SPILL_PATH):
+		self.url = url
+		self.batch_size = batch_size
+		self.batch_interval = batch_interval
+		self.timeout = timeout
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.spill_path = spill_path
+		self.queue = queue.Queue(maxsize=queue_size)
+		self.session = requests.Session()
+		self.session.headers.update({
+			"Content-Type":"application/json; charset=utf-8",
+			"x-pendo-integration-key":secret_key
+		})
+		self.thread = None
+		self.stopping = threading.Event()
+		self.lock = threading.Lock()
+
+	# the thread is started on the first event so that it's created in the worker process
+	def start(self):
+		with self.lock:
+			if self.thread is None:
+				atexit.register(self.stop)
+			if self.thread is None or not self.thread.is_alive():
+				self.stopping.clear()
+				self.thread = threading.Thread(target=self._run, name='track-event-shipper', daemon=True)
+				self.thread.start()
+
+	# queue an event without blocking; return False if the event had to be spilled
+	def enqueue(self, event):
+		self.start()
+		try:
+			self.queue.put_nowait(event)
+			return True
+		except queue.Full:
+			self._spill([event])
+			return False
+
+	# flush queued events and stop the thread
+	def stop(self, timeout=None):
+		self.stopping.set()
+		thread = self.thread
+		if thread is not None and thread.is_alive():
+			thread.join(timeout if timeout is not None else self.timeout * (self.max_retries + 1))
+
+	def _run(self):
+		self._replay_spilled()
+		while not self.stopping.is_set() or not self.queue.empty():
+			batch = self._next_batch()
+			if batch:
+				self._send_batch(batch)
+
+	# collect up to batch_size events, waiting no longer than batch_interval
+	def _next_batch(self):
+		batch = []
+		deadline = time.monotonic() + self.batch_interval
+		while len(batch) < self.batch_size:
+			remaining = deadline - time.monotonic()
+			if self.stopping.is_set():
+				remaining = 0
+			try:
+				if remaining > 0:
+					batch.append(self.queue.get(timeout=remaining))
+				else:
+					batch.append(self.queue.get_nowait())
+			except queue.Empty:
+				break
+		return batch
+
+	def _send_batch(self, batch):
+		failed = [event for event in batch if not self._send(event)]
+		if failed:
+			self._spill(failed)
+
+	# Pendo accepts one event per request; retry server errors and network failures with backoff
+	def _send(self, event):
+		for attempt in range(self.max_retries + 1):
+			try:
+				result = self.session.post(self.url, json=event, timeout=self.timeout)
+				if result.status_code < 500 and result.status_code != 429:
+					if result.status_code >= 400:
+						print('track event rejected:', result.status_code, result.text)
+					return True
+			except requests.RequestException as exception:
+				print('exception:', exception)
+			if attempt < self.max_retries and not self.stopping.is_set():
+				time.sleep(self.backoff * (2 ** attempt))
+		return False
+
+	def _spill(self, events):
+		if not self.spill_path:
+			print('track events dropped:', len(events))
+			return
+		with self.lock:
+			with open(self.spill_path, 'a') as spill_file:
+				for event in events:
+					spill_file.write(json.dumps(event) + '\n')
+
+	# queue events spilled by a previous run
+	def _replay_spilled(self):
+		if not self.spill_path or not os.path.exists(self.spill_path):
+			return
+		replay_path = self.spill_path + '.' + str(os.getpid())
+		with self.lock:
+			os.replace(self.spill_path, replay_path)
+		with open(replay_path) as replay_file:
+			for line in replay_file:
+				if line.strip():
+					self.enqueue(json.loads(line))
+		os.remove(replay_path)
+
+TRACK_EVENT_SHIPPER = None
+
+def getTrackEventShipper(secret_key):
+	global TRACK_EVENT_SHIPPER
+	if TRACK_EVENT_SHIPPER is None:
+		TRACK_EVENT_SHIPPER = TrackEventShipper(PENDO_TRACK_EVENT_URL, secret_key)
+	return TRACK_EVENT_SHIPPER
+
+# drop the shipper inherited from the parent process; its thread doesn't run in this process
+def reset_track_event_shipper():
+	global TRACK_EVENT_SHIPPER
+	TRACK_EVENT_SHIPPER = None
@@ -1,43 +1,61 @@
 import os
 import json
 import time
-import requests
-import redis
-from urllib.parse import urlparse
+import functools
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
 
 
-from flask import Flask, redirect, request, url_for, render_template, session, jsonify
+from flask import Response, g, redirect, request, url_for, render_template, stream_template, session, jsonify
 
 import constants as cns
+from db_operations import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX
+from track_events import getTrackEventShipper
+from locales import Locale
+from profiling import timed_render, timed_stream
+from redis_operations import redis_call, redis_pipeline
 
-# a random secret used by Flask to encrypt session data cookies
-app = Flask(__name__)
-app.debug = True
-app.secret_key = os.environ['FLASK_SECRET_KEY']
+# TrackEvent Secret Key for Pendo; it's needed only when track events are sent
+PENDO_TRACK_EVENT_SECRET_KEY = os.environ.get('PENDO_TRACK_EVENT_SECRET_KEY')
 
-# TrackEvent Secret Key for Pendo
-PENDO_TRACK_EVENT_SECRET_KEY = os.environ['PENDO_TRACK_EVENT_SECRET_KEY']
+# root path for message files
+MESSAGE_FILE_ROOT = 'static/json/'
 
-# Redis settings
-redis_url = os.getenv('REDIS_URL')
-url = urlparse(redis_url)
+# in-process message catalog; language -> (mtime of the message file, messages, expiry of messages read from Redis)
+MESSAGE_CATALOG = {}
+# seconds messages read from Redis are kept when the message file doesn't exist
+MESSAGE_FALLBACK_TTL = int(os.environ.get('MESSAGE_FALLBACK_TTL', '60'))
 
-# Redisクライアントの初期化
-REDIS_client = redis.StrictRedis(
-    host=url.hostname,
-    port=url.port,
-    password=url.password,
-    ssl=True,  # SSL接続を有効にする
-    ssl_cert_reqs=None  # 証明書検証を無効化する
-)
+# locale of each language built from the catalog
+LOCALES = {}
+
+# number of distinct Accept-Language headers whose languages are cached
+LANGUAGE_CACHE_SIZE = int(os.environ.get('LANGUAGE_CACHE_SIZE', '256'))
 
 def display_page(url_name, **arg):
-	set_language(request.accept_languages.best_match(cns.SUPPORTED_LANGUAGES))
-	return render_template(url_name, **arg)
+	return timed_render(render_template, url_name, **arg)
+
+# render the page as a stream for pages with many rows
+# the header and navigator are sent while rows given as a generator are still fetched
+def display_page_stream(url_name, **arg):
+	return Response(timed_stream(stream_template(url_name, **arg)))
+
+# return (after, before, page_size) given by the pager in the query string
+# a page with more than one pager reads the args of each with its prefix, e.g. approved_after
+def get_page_args(prefix=''):
+	after = request.args.get(prefix + 'after', type=int)
+	before = request.args.get(prefix + 'before', type=int)
+	page_size = request.args.get('size', PAGE_SIZE_DEFAULT, type=int)
+	page_size = min(max(page_size, 1), PAGE_SIZE_MAX)
+	return after, before, page_size
+
+# url of the page before or after the key in the pager, keeping the args of other pagers of the page
+def get_page_url(pager, mode, key):
+	prefix = pager.get('prefix', '')
+	args = {name: value for name, value in request.args.items() if name not in (prefix + 'after', prefix + 'before')}
+	args.update({prefix + mode: key, 'size': pager['size']})
+	return url_for(request.endpoint, **args)
 
-def getRedisClient():
-    return REDIS_client
-    
 def getPendoParams():
 	params = {}
 	params['email'] = session[cns.SESSION_EMAIL]
@@ -49,55 +67,96 @@ def getPendoParams():
 	params['company_plan'] = session[cns.SESSION_COMPANY_PLAN]
 	return params
 
-def set_language(language):
-	print('language: ', language)
+# return the language of messages for the Accept-Language header
+# the result is cached for each distinct header, so the header is negotiated only once
+@functools.lru_cache(maxsize=LANGUAGE_CACHE_SIZE)
+def resolve_language(accept_language):
+	language = parse_accept_header(accept_language, LanguageAccept).best_match(cns.SUPPORTED_LANGUAGES)
 	# currently supported language; ja-JP, en-US
-	lang = 'en-US' # set en_US as default
 	if language == 'ja' or language == 'ja-JP':
 		# ja_JP as Japanese
-		lang = 'ja-JP'
-	elif language == 'en':
-		# if 'en' is specified, set en_US
-		lang = 'en-US'
-	session[cns.REDIS_LANGUAGE] = lang
-	if not REDIS_client.exists(cns.REDIS_MESSAGES + '/' + lang):
-		# load messages
-		messages = {}
-		path = 'static/json/messages_'+session[cns.REDIS_LANGUAGE]+'.json'
+		return 'ja-JP'
+	# set en_US as default
+	return 'en-US'
+
+# the session is changed only when the language is changed, so that the session cookie isn't re-sent on every page
+def set_language(lang):
+	if session.get(cns.REDIS_LANGUAGE) != lang:
+		session[cns.REDIS_LANGUAGE] = lang
+		g.pop('locale', None)
+
+# to be registered as before_request so that the language is set before pages and formats are generated
+# static files have no session to keep the language in
+def apply_language():
+	if request.endpoint == 'static':
+		return
+	set_language(resolve_language(request.headers.get('Accept-Language', '')))
+
+# Load messages of all languages in the catalog; this is called when the app is created
+def preload_messages():
+	for lang in cns.MESSAGE_LANGUAGES:
+		get_messages(lang)
+
+# Share messages in Redis as the fallback for workers without message files; this is called when the worker boots
+# the hashes are checked and written in two round trips
+def publish_messages():
+	catalog = {cns.REDIS_MESSAGES + '/' + lang: get_messages(lang) for lang in cns.MESSAGE_LANGUAGES}
+	keys = [key for key, messages in catalog.items() if messages]
+	exists = redis_pipeline(lambda pipeline: [pipeline.exists(key) for key in keys])
+	missing = [key for key, found in zip(keys, exists or []) if not found]
+	if missing:
+		redis_pipeline(lambda pipeline: [pipeline.hset(key, mapping=catalog[key]) for key in missing])
+
+# return messages of the language from the in-process catalog
+# the catalog is reloaded when the message file is modified, and Redis is used only when the file doesn't exist
+# messages read from Redis are kept for MESSAGE_FALLBACK_TTL seconds
+def get_messages(language):
+	key = cns.REDIS_MESSAGES + '/' + language
+	path = MESSAGE_FILE_ROOT + 'messages_' + language + '.json'
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		mtime = None
+	cached = MESSAGE_CATALOG.get(language)
+	if cached is not None and cached[0] == mtime and (mtime is not None or time.monotonic() < cached[2]):
+		return cached[1]
+	if mtime is not None:
 		with open(path) as message_file:
 			messages = json.load(message_file)
-		REDIS_client.hmset(cns.REDIS_MESSAGES + '/' + lang, messages)
+		MESSAGE_CATALOG[language] = (mtime, messages, None)
+	else:
+		# fall back to the hash shared in Redis
+		messages = {field.decode('utf8'): value.decode('utf8') for field, value in redis_call('hgetall', key, default={}).items()}
+		# an empty hash, e.g. while Redis is unavailable, isn't kept, so that messages are read again on the next render
+		if messages:
+			MESSAGE_CATALOG[language] = (None, messages, time.monotonic() + MESSAGE_FALLBACK_TTL)
+	return messages
+
+# return the locale of the language of the session; it's resolved once per request
+# the locale is rebuilt only when the messages of the language are reloaded
+def get_locale():
+	if 'locale' not in g:
+		language = session.get(cns.REDIS_LANGUAGE, 'en-US')
+		messages = get_messages(language)
+		cached = LOCALES.get(language)
+		if cached is None or cached.messages is not messages:
+			cached = Locale(language, messages)
+			LOCALES[language] = cached
+		g.locale = cached
+	return g.locale
 
 # this should be called after language is set
 # return default currenct to be used in expense
 def get_default_currency():
-	language = session[cns.REDIS_LANGUAGE]
-	if language == 'ja-JP':
-		return cns.CURRENCY_YEN
-	else:
-		return cns.CURRENCY_DOLLAR
+	return get_locale().default_currency
 
 # this should be called after language is set
 # generage full name according to the language choosen
 def generate_fullname(first_name, last_name):
-	language = session[cns.REDIS_LANGUAGE]
-	if language == 'ja-JP':
-		# in case Japanese is used, last name comes first
-		return last_name + ' ' + first_name
-	else:
-		return first_name + ' ' + last_name
+	return get_locale().fullname(first_name, last_name)
 
-# this should be called after language is set
-# generage an expression in html according to the language choosen
-def generate_currency_expression(amount, currency):
-	language = session[cns.REDIS_LANGUAGE]
-	if language == 'ja-JP':
-		return "{:,}".format(amount) + ' ' + currency
-	else:
-		return currency + ' ' + "{:,.2f}".format(amount)
-
-
-# Invoke Pendo API to send a track event
+# Queue a track event to be sent to Pendo in the background
+# Only the session and request fields needed are copied, so the request returns immediately
 def send_track_event(event_name):
 	if cns.SESSION_EMAIL in session:
 		body = {
@@ -117,19 +176,6 @@ def send_track_event(event_name):
 				"userAgent": request.user_agent.string
 			}
 		}
-		header = {
-			"Content-Type":"application/json; charset=utf-8",
-			"x-pendo-integration-key":PENDO_TRACK_EVENT_SECRET_KEY
-		}
-
-		api_url = "https://app.pendo.io/data/track"
-
-		result = requests.post(api_url, json=body, headers=header)
-		try:
-			content = result.json()
-			return content
-		except Exception as exception:
-			print('exception:', exception)
-			return None
+		return getTrackEventShipper(PENDO_TRACK_EVENT_SECRET_KEY).enqueue(body)
 	else:
-		return redirect(url_for('login'))
+		return redirect(url_for('main.login'))
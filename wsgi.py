@@ -0,0 +1,4 @@
+from expense_report_demo import create_app
+
+# WSGI entry point of the app, e.g. gunicorn wsgi:app
+app = create_app()